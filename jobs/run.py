@@ -4,13 +4,36 @@ from Config import settings
 from multiprocessing import Pool
 from utils.radar import getFromFile
 from pyOPAWS.run import main as opaws
+from pyOPAWS.run import main_mosaic as opaws_mosaic
 from rass.run import main as rass
 
+def combineJob(name, run_time, directory, deadline):
+    # With a deadline (seconds) the combine job starts once the radar jobs ($JOBID) have started, so the
+    # deadline is not spent while they wait in the queue, and appends each radar as soon as its file is
+    # written.  Otherwise it starts once all the radar jobs are done
+    deadline = int(deadline or 0)
+    if deadline > 0:
+        return "sbatch --job-name=%s --time=%d:%02d --export=COMBINETIME=%s,DIR=%s,CYCLETIME=%s,DEADLINE=%d --depend=after:$JOBID jobs/combine.job" \
+               % (name, (deadline + 60)//60, (deadline + 60)%60, run_time.strftime("%Y%m%d_%H%M"), directory, \
+                  run_time.strftime("%Y%m%d%H%M"), deadline)
+    else:
+        return "sbatch --job-name=%s --export=COMBINETIME=%s,DIR=%s --depend=afterany:$JOBID jobs/combine.job" \
+               % (name, run_time.strftime("%Y%m%d_%H%M"), directory)
+
 def runOPAWSForTime(run_time, totalRadars):
     date = run_time.strftime("%Y%m%d%H%M")
-    if settings.default_slurm_enabled == True:
+    if settings.opaws_mosaic == True:
+        if settings.default_slurm_enabled == True:
+            cmd = "JOBID=$(sbatch --job-name=opaws_%s --parsable --export=CYCLETIME=%s jobs/opaws_mosaic.job) " % (date, date)
+            cmd += "&& sbatch --job-name=opaws_combine_%s --export=COMBINETIME=%s,DIR=%s --depend=afterany:$JOBID jobs/combine.job" % (date, run_time.strftime("%Y%m%d_%H%M"), settings.opaws_obs_seq)
+            print(cmd)
+            OPAWSret = subprocess.Popen([cmd],shell=True)
+            OPAWSret.wait()
+        else:
+            opaws_mosaic(run_time)
+    elif settings.default_slurm_enabled == True:
         cmd = "JOBID=$(sbatch --job-name=opaws_%s --parsable --array=0-%i --export=CYCLETIME=%s jobs/opaws.job) " % (date, totalRadars-1, date)
-        cmd += "&& sbatch --job-name=opaws_combine_%s --export=COMBINETIME=%s,DIR=%s --depend=afterany:$JOBID jobs/combine.job" % (date, run_time.strftime("%Y%m%d_%H%M"), settings.opaws_obs_seq)
+        cmd += "&& " + combineJob("opaws_combine_%s" % date, run_time, settings.opaws_obs_seq, settings.opaws_combine_deadline)
         print(cmd)
         OPAWSret = subprocess.Popen([cmd],shell=True)
         OPAWSret.wait()
@@ -26,7 +49,7 @@ def runRASSForTime(run_time, totalRadars):
     date = run_time.strftime("%Y%m%d%H%M")
     if settings.default_slurm_enabled == True:
         cmd = "JOBID=$(sbatch --job-name=rass_%s --parsable --array=0-%i --export=CYCLETIME=%s jobs/rass.job) " % (date, totalRadars-1, date)
-        cmd += "&& sbatch --job-name=rass_combine_%s --export=COMBINETIME=%s,DIR=%s --depend=afterany:$JOBID jobs/combine.job" % (date, run_time.strftime("%Y%m%d_%H%M"), settings.rass_output)
+        cmd += "&& " + combineJob("rass_combine_%s" % date, run_time, settings.rass_output, settings.rass_combine_deadline)
         print(cmd)
         RASSret = subprocess.Popen([cmd],shell=True)
         RASSret.wait()
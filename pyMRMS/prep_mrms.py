@@ -25,7 +25,10 @@ from builtins import object
 import os
 import sys
 import glob
+import gzip
 import time as timeit
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 # Need to set the backend BEFORE loading pyplot
 import matplotlib as mpl
@@ -50,8 +53,9 @@ from pyart.graph import cm
 import datetime as DT
 from numpy import ma
 from utils.dart_tools import mrms_write_DART_ascii
-import xarray as xr
-import pandas as pd
+from utils.obs_seq_netcdf import write_obs_seq_netcdf, obs_time
+from utils.catalog import get_catalog
+from utils.subdomain_cache import Subdomain, get_subdomain, grid_signature
 
 # missing value
 _missing = -9999.
@@ -67,7 +71,6 @@ _plot_format = 'png'
 # Radar information
 
 _dbz_name         = "MergedReflectivityQC_smoothed"
-_temp_netcdf_file = "./tmp.nc"
 
 # Grid stuff
 
@@ -97,6 +100,9 @@ _grid_dict = {
               'levels'          : ['00.50','01.00','01.50','02.00','02.50','03.00', \
                                    '04.00','05.00','06.00','07.00','08.00','09.00','10.00'],
               'QC_info'         : [[15.,5.],[20.,1.]],
+              'dart_format'     : 'ascii',       # obs_seq files are written as ascii or binary (DART unformatted obs sequence)
+              'nthreads'        : 4,             # level files read and decompressed at once (in memory, see assemble_3D_grid)
+              'subdomain_cache' : None,          # directory to also keep the MRMS window of the domain on disk, see utils/subdomain_cache.py
              }
 
 _obs_errors = { 'reflectivity'    : 7.0, '0reflectivity'   : 5.0 } 
@@ -170,38 +176,18 @@ def Get_Closest_Elevations(path, anal_time, sub_dir=None, window=_dt_window):
            window[0] = -window[0]
        lwindow = window
 
+   time0 = anal_time + DT.timedelta(0,minutes=lwindow[0])
+   time1 = anal_time + DT.timedelta(0,minutes=lwindow[1])
+
+   # This code finds the earliest file of each tilt within the window - using only a single tilt per volume.
+
    for elev in os.listdir(full_path):
-   
-       tilt_time = {}
-           
-       for fn in os.listdir(os.path.join(full_path,elev)):
-       
-           tempdate = DT.datetime(int(fn[0:4]),int(fn[4:6]),int(fn[6:8]),int(fn[9:11]),int(fn[11:13]),int(fn[13:15]))
 
-           timediff = anal_time - tempdate
-           time0    = anal_time + DT.timedelta(0,minutes=lwindow[0])
-           time1    = anal_time + DT.timedelta(0,minutes=lwindow[1])
-           
-           # Change this if you want +something -window instead of 0-900. if statement is +2-15
-           # if timediff >= datetime.timedelta(0,-120) and timediff < datetime.timedelta(0,window):
-
-         # if timediff >= DT.timedelta(0,minutes=lwindow[0]) and timediff < DT.timedelta(0,minutes=lwindow[1]):
-           if tempdate >= time0 and tempdate < time1:
-               tilt_time["%s/%s" % (elev,fn)] = timediff
-    #          print anal_time
-    #          print time0
-    #          print time1
-    #          print tilt_time
-           else:
-               continue
-
-       # This code finds the latest file that exists in the list - using only a single tilt per volume.
-       if bool(tilt_time):
-            maxtime = max(list(tilt_time.items()),key=lambda d:(d[1]))
-            ObsFileList.append(os.path.join(full_path,maxtime[0]))
-       del(tilt_time)
+       first = get_catalog(os.path.join(full_path,elev), 'mrms').first(time0, time1)
+
+       if first is not None:
+           ObsFileList.append(os.path.join(full_path,elev,os.path.basename(first)))
 
-       
    if len(ObsFileList) > 0:
        print("\n ============================================================================\n")
        print("\n Prep_MRMS.Get_Closest_Elevations:  found %i files in %s  \n" % (len(ObsFileList), path))
@@ -237,6 +223,63 @@ def get_dir_files(dir, pattern, debug=False):
 #=========================================================================================
 # Get the filenames out of the directory
 
+def read_level_file(filename):
+    """
+        Returns the contents of a gzipped MRMS level file decompressed in memory, or None
+        if the file is not gzipped (it is opened directly).
+    """
+
+    if filename[-2:] != "gz":
+        return None
+
+    with open(filename, 'rb') as f:
+        return gzip.decompress(f.read())
+
+def find_subdomain(f, loc=None, debug=False):
+    """
+        Returns the Subdomain (index window and lat/lon vectors) of the NX by NY domain
+        centered at loc on the grid of the open MRMS file f
+    """
+
+    nlons  = len(f.dimensions['Lon'])
+    nlats  = len(f.dimensions['Lat'])
+
+    try:
+        f_lats = f.variables['Lat'][...]
+        f_lons = f.variables['Lon'][...]
+    except:
+        f_lats = np.float(f.Latitude)  - np.float(f.LatGridSpacing) * np.arange(nlats)
+        f_lons = np.float(f.Longitude) + np.float(f.LonGridSpacing) * np.arange(nlons)
+
+    if loc != None:
+        ic     = get_loc(f_lons, loc[1], 0.5)[0]
+        jc     = get_loc(f_lats, loc[0], 0.5)[0]
+    else:
+        ic, jc = old_div(nlats,2), old_div(nlons,2)
+
+    i0, i1 = ic-old_div(NX,2), ic+old_div(NX,2)
+    j0, j1 = jc-old_div(NY,2), jc+old_div(NY,2)
+
+# Fixing things when the NEWSe domain goes out of bounds
+
+    if i0 < 0:  
+        print("\n West edge of requested domain outside of MRMS grid:  %d " % (i0))
+        print("\n Adjusting indices")
+        i0       = 0
+
+    if j0 < 0:  
+        print("\n South edge of requested domain outside of MRMS grid:  %d " % (i0))
+        print("\n Adjusting indices")
+        j0       = 0
+
+    if debug:
+        print("\n %d  %d" % (i0, i1))
+        print("\n %d  %d" % (j0, j1))
+        print("\n SW Lon:  %f  NE_Lon:  %f" % (f_lons[i0], f_lons[i1]))
+        print("\n SW Lat:  %f  NE_Lat:  %f" % (f_lats[j0], f_lats[j1]))
+
+    return Subdomain(i0, i1, j0, j1, f_lats[j0:j1], f_lons[i0:i1])
+
 def assemble_3D_grid(filenames, loc=None, debug=False):
 
     levels = _grid_dict['levels']
@@ -249,92 +292,75 @@ def assemble_3D_grid(filenames, loc=None, debug=False):
             if f.find(l) > -1:
                 file_list.append(f)
 
-    for n, filename in enumerate(file_list):
+    # The gzipped level files are decompressed in memory by nthreads threads (zlib releases the GIL),
+    # at most nthreads files ahead of the one opened by netCDF, which reads from the memory buffer
 
-        if debug:
-            print("\n Processing file:  %s" % (filename))
-      
-        if filename[-2:] == "gz":
-            cmd = "gunzip -c %s > %s" % (filename, _temp_netcdf_file)
-        else:
-            cmd = "ln -fs %s  %s" % (filename, _temp_netcdf_file)
+    nthreads = max(1, _grid_dict['nthreads'])
+    pool     = ThreadPoolExecutor(max_workers=nthreads)
+    pending  = deque()
+    files    = iter(file_list)
 
-        if debug:
-            print("\n Running......%s" % (cmd))
+    def buffers():
+        for filename in files:
+            pending.append((filename, pool.submit(read_level_file, filename)))
+            if len(pending) >= nthreads:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
 
-        os.system(cmd)
-        
-        try:
-            f = ncdf.Dataset(_temp_netcdf_file, "r")
-        except:
-            print('Could not open file %s' % _temp_netcdf_file)
-            continue
-
-        if n == 0:
-             
-            nlons  = len(f.dimensions['Lon'])
-            nlats  = len(f.dimensions['Lat'])
+    try:
+        for n, (filename, result) in enumerate(buffers()):
 
-            try:
-                f_lats = f.variables['Lat'][...]
-                f_lons = f.variables['Lon'][...]
-            except:
-                f_lats = np.float(f.Latitude)  - np.float(f.LatGridSpacing) * np.arange(nlats)
-                f_lons = np.float(f.Longitude) + np.float(f.LonGridSpacing) * np.arange(nlons)
-             
-            missingData = f.MissingData
+            if debug:
+                print("\n Processing file:  %s" % (filename))
 
             try:
-                time   = DT.datetime.fromtimestamp(f.variables['time'][0])
-            except:
-                time   = DT.datetime.fromtimestamp(np.float(f.Time))
-             
-            if loc != None:
-                ic     = get_loc(f_lons, loc[1], 0.5)[0]
-                jc     = get_loc(f_lats, loc[0], 0.5)[0]
-            else:
-                ic, jc = old_div(nlats,2), old_div(nlons,2)
+                buffer = result.result()
+                if buffer is None:
+                    f = ncdf.Dataset(filename, "r")
+                else:
+                    f = ncdf.Dataset(filename, "r", memory=buffer)
+            except Exception as e:
+                print('Could not open file %s:  %s' % (filename, str(e)))
+                continue
 
-            i0, i1 = ic-old_div(NX,2), ic+old_div(NX,2)
-            j0, j1 = jc-old_div(NY,2), jc+old_div(NY,2)
+            if n == 0:
 
-# Fixing things when the NEWSe domain goes out of bounds
+                missingData = f.MissingData
 
-            if i0 < 0:  
-                print("\n West edge of requested domain outside of MRMS grid:  %d " % (i0))
-                print("\n Adjusting indices")
-                i0       = 0
+                try:
+                    time   = DT.datetime.fromtimestamp(f.variables['time'][0])
+                except:
+                    time   = DT.datetime.fromtimestamp(np.float(f.Time))
 
-            if j0 < 0:  
-                print("\n South edge of requested domain outside of MRMS grid:  %d " % (i0))
-                print("\n Adjusting indices")
-                j0       = 0
+                # The window of the domain is found on the full MRMS lat/lon vectors once per grid / center
+                # (see utils/subdomain_cache.py), only that hyperslab of each level is read
 
-            if debug:
-                print("\n %d  %d" % (i0, i1))
-                print("\n %d  %d" % (j0, j1))
-                print("\n SW Lon:  %f  NE_Lon:  %f" % (f_lons[i0], f_lons[i1]))
-                print("\n SW Lat:  %f  NE_Lat:  %f" % (f_lats[j0], f_lats[j1]))
-                      
-            g_lats    = f_lats[j0:j1]
-            g_lons    = f_lons[i0:i1]
-            array     = missingData * np.ones((nlvls, g_lats.size, g_lons.size))
-            g_heights = np.zeros((nlvls,))
-
-        g_heights[n] = f.Height    
+                window = get_subdomain(grid_signature(f), loc, NX, NY, lambda: find_subdomain(f, loc, debug=debug), \
+                                       cache_dir=_grid_dict['subdomain_cache'])
 
-        try:
-            array[n,...] = f.variables[_dbz_name][0,j0:j1,i0:i1]
-        except:
-            array[n,...] = f.variables[_dbz_name][j0:j1,i0:i1]
-         
-        f.close()
+                i0, i1, j0, j1 = window.i0, window.i1, window.j0, window.j1
 
-    # remove tmp.nc file - this can cause problems with multiple users..
+                g_lats    = window.lats
+                g_lons    = window.lons
+                array     = missingData * np.ones((nlvls, g_lats.size, g_lons.size))
+                g_heights = np.zeros((nlvls,))
 
-        cmd = "rm -f %s" % (_temp_netcdf_file)
-        os.system(cmd)
+            g_heights[n] = f.Height    
 
+            try:
+                array[n,...] = f.variables[_dbz_name][0,j0:j1,i0:i1]
+            except:
+                array[n,...] = f.variables[_dbz_name][j0:j1,i0:i1]
+         
+            f.close()
+
+    finally:
+        # on an error the level files not read yet are dropped with their buffers
+        for filename, result in pending:
+            result.cancel()
+        pending.clear()
+        pool.shutdown()
   
     ref = ma.MaskedArray(array, mask = (array < missingData+1.))        
     
@@ -607,44 +633,11 @@ def plot_grid(ref, sweep, plot_filename=None, shapefiles=None, interactive=False
 #=========================================================================================
 # Defines the data frame for each observation type
 #
-def obs_seq_xarray(len):
-        
-    return (np.recarray(len, 
-                    dtype = [
-                             ('value',               'f8'),
-                             ('lat',                 'f8'),
-                             ('lon',                 'f8'),
-                             ('height',              'f8'),
-                             ('error_var',           'f4'),
-                             ('utime',               'f8'),          
-                             ('date',                'S128'),
-                             ('day',                 'i8'),
-                             ('second',              'i8'),
-                             ('platform_lat',        'f8'),
-                             ('platform_lon',        'f8'),
-                             ('platform_hgt',        'f8'),
-                             ('platform_dir1',       'f8'),
-                             ('platform_dir2',       'f8'),
-                             ('platform_dir3',       'f8'),
-                             ('platform_nyquist',    'f8')
-                            ]), \
-                         {
-                           'lat':   ["degrees", "latitude of observation"],
-                           'lon':   ["degrees", "longitude of observation (deg. west)"],
-                           'height':["meters",  "height above sea level"],
-                           'utime': ["seconds since 1970-01-01 00:00:00", "time of observation"],
-                           'date':  ["", "date and time of obsevation"]
-                          })
-                                 
 #=========================================================================================
 def write_obs_seq_xarray(field, filename=None, obs_error=None, 
                          zero_dbz_obtype=True,
                          levels = [], QC_info=[], zero_levels=[], volume_name=None):
 
-    
-   _time_units    = 'seconds since 1970-01-01 00:00:00'
-   _calendar      = 'standard'
-
    if filename == None:
        print("\n WRITE_DATA_XARRAY:  No output file name is given, writing to %s" % "obs_seq.nc")
        filename = "obs_seq.nc"
@@ -656,9 +649,6 @@ def write_obs_seq_xarray(field, filename=None, obs_error=None,
    if obs_error == None:
        obs_errors = { 'reflectivity': 5.0, '0reflectivity': 5.0 } 
 
-   _stringlen     = 8
-   _datelen       = 19
-     
 # Extract data.city data
   
    data          = field.data
@@ -666,106 +656,74 @@ def write_obs_seq_xarray(field, filename=None, obs_error=None,
    lons          = field.lons
    hgts          = field.zg[:]
 
+# Levels to write:  the data levels, then each zero level repeats the zero_dbz field
+
+   nz, ny, nx = data.shape
+
+   if len(levels) == 0:
+       dlevels = np.arange(nz)
+   else:
+       dlevels = np.arange(len(levels))
+
    try:
-       nz, ny, nx     = data.shape
-       if len(levels) == 0:
-           nz2        = nz + len(zero_levels)
-       else:
-           nz2        = len(levels) + len(zero_levels)
-           
-       new_data       = np.ma.zeros((nz2, ny, nx), dtype=np.float32)
-       new_hgts       = np.ma.zeros((nz2), dtype=np.float32)
-       
-       for n, k in enumerate(levels):
-           new_data[n,...] = data[n]
-           new_hgts[n]     = hgts[n]
-       
-       for n, lvl in enumerate(zero_levels):
-           new_data[nz+n] = field.zero_dbz.data
-           new_hgts[nz+n] = lvl
-           
-       data = new_data
-       hgts = new_hgts
+       zero_dbz  = field.zero_dbz.data
+       zero_hgts = np.asarray(zero_levels, dtype=np.float32)
+       dtype     = np.float32
        print("\n write_DART_ascii:  0-DBZ separate type added to reflectivity output\n")
        
    except AttributeError:
+       zero_dbz  = None
+       zero_hgts = np.zeros((0,), dtype=np.float32)
+       dtype     = np.float64
        print("\n write_DART_ascii:  No 0-DBZ separate type found\n")
        
-# Use the time of the volume
-
-   secs    = ncdf.date2num(field.time, units = _time_units)   
-   
-# Retain DART time stamps
+# Use the time of the volume, DART time stamps are retained
 
-   days    = ncdf.date2num(field.time, units = "days since 1601-01-01 00:00:00")
-   seconds = np.int(86400.*(days - np.floor(days)))  
+   secs, days, seconds = obs_time(field.time)
   
    print("\n -->  Writing %s as the radar file..." % (filename))
-    
-   nobs = np.sum(data.mask[:]==False)
+
+# Obs in (level, j, i) order:  data levels from the mask, then one pass over the zero_dbz
+# field whose obs are repeated at each of the zero levels
+
+   kk, jj, ii = np.nonzero(np.ma.getmaskarray(data)[dlevels] == False)
+
+   values = np.ma.getdata(data)[dlevels][kk,jj,ii].astype(dtype)
+   height = np.ma.getdata(hgts)[dlevels][kk].astype(dtype)
+
+   if zero_dbz is not None and zero_hgts.size > 0:
+       zj, zi = np.nonzero(np.ma.getmaskarray(zero_dbz) == False)
+       zval   = np.ma.getdata(zero_dbz)[zj,zi].astype(np.float32)
+
+       values = np.concatenate([values, np.tile(zval, zero_hgts.size)])
+       height = np.concatenate([height, np.repeat(zero_hgts, zj.size)])
+       jj     = np.concatenate([jj, np.tile(zj, zero_hgts.size)])
+       ii     = np.concatenate([ii, np.tile(zi, zero_hgts.size)])
+
+   nobs = values.size
    print("\n --> Number of good observations for xarray:  %d" % nobs)
-   
-   # Create numpy rec array that can be converted to a pandas table.
 
-   out, attributes = obs_seq_xarray(nobs)
+   nobs_clearair = np.sum(values < _grid_dict['min_dbz_zeros'])
 
-   nobs = 0
-   nobs_clearair = 0
-   
-   # There is a far better way to do this but this is fast enough for now...
+   print("\n -----> Total non-zero Obs: %d  0DBZ Obs: %d" % (nobs-nobs_clearair, nobs_clearair))
+
+   # Each column is written as it is computed
+
+   def columns():
+       yield 'value',     values
+       yield 'lat',       lats[jj]
+       yield 'lon',       lons[ii]
+       yield 'height',    height
+       yield 'error_var', np.where(values < _grid_dict['min_dbz_zeros'], obs_error[1]**2, obs_error[0]**2)
+
+   constants = {'utime': secs, 'day': days, 'second': seconds}
 
-   for k in np.arange(nz2): 
-       for j in np.arange(ny):
-           for i in np.arange(nx):
-         
-               if data.mask[k,j,i] == True:   # bad values
-                    pass     
-               else:          
-                   out.value[nobs]              = data[k,j,i]
-                   
-                   if out.value[nobs] < _grid_dict['min_dbz_zeros']:                   
-                       out.error_var[nobs]      = obs_error[1]**2
-                       nobs_clearair += 1                
-                   else:
-                       out.error_var[nobs]      = obs_error[0]**2
-                       
-                   out.lon[nobs]                = lons[i]
-                   out.lat[nobs]                = lats[j]
-                   out.height[nobs]             = hgts[k]
-                   out.date[nobs]               = field.time
-                   out.utime[nobs]              = secs
-                   out.day[nobs]                = days
-                   out.second[nobs]             = seconds
-         
-                   nobs = nobs + 1
-                   
-                   
-   print("\n -----> Total non-zero Obs: %d  0DBZ Obs: %d" % (nobs-nobs_clearair, nobs_clearair))           
-      
-   # Create an xarray dataset for file I/O
-   xa = xr.Dataset(pd.DataFrame.from_records(out))
-   
-   # reset index to be a master index across all obs
-   xa = xa.rename({'dim_0': 'index'})
-   
-   # Write the xarray file out (this is all there is, very nice guys!)
-   xa.to_netcdf(filename, mode='w')
-   xa.close()
-   
-   # Add attributes to the files
-    
-   fnc = ncdf.Dataset(filename, mode = 'a')
-   fnc.history = "Created " + DT.datetime.today().strftime("%Y%m%d_%H%M")
-   fnc.version = "Version 1.0a by Lou Wicker and Thomas Jones (NSSL)"
    if volume_name != None:
-       fnc.version = "Created from the MRMS radar volume:  %s" % volume_name
-    
-   for key in list(attributes.keys()):
-       fnc.variables[key].units = attributes[key][0]
-       fnc.variables[key].description = attributes[key][1]
+       version = "Created from the MRMS radar volume:  %s" % volume_name
+   else:
+       version = None
 
-   fnc.sync()  
-   fnc.close()
+   write_obs_seq_netcdf(filename, nobs, columns(), constants, date=field.time, version=version)
 
 def run(options):
    tMAIN = timeit.time()
@@ -787,6 +745,12 @@ def run(options):
 
    if options.thin > 1:
        _grid_dict['thin_grid'] = options.thin
+
+   if getattr(options, 'dart_format', None):
+       _grid_dict['dart_format'] = options.dart_format
+
+   if getattr(options, 'subdomain_cache', None):
+       _grid_dict['subdomain_cache'] = options.subdomain_cache
       
    if options.plot < 0:
        plot_grid_flag = False
@@ -871,7 +835,8 @@ def run(options):
        tDART = timeit.time()
        ret = mrms_write_DART_ascii(ref_obj, filename=out_filename, levels=np.arange(len(_grid_dict['levels'])),
                               obs_error=[_grid_dict['reflectivity'], _grid_dict['0reflectivity']], 
-                              QC_info=_grid_dict['QC_info'], zero_levels=_grid_dict['zero_levels'])
+                              QC_info=_grid_dict['QC_info'], zero_levels=_grid_dict['zero_levels'],
+                              dart_format=_grid_dict['dart_format'])
        print("\n --> Time for DART write: {} seconds".format(timeit.time() - tDART))
    
    if plot_grid_flag:
@@ -915,6 +880,12 @@ def main(argv=None):
                     
     parser.add_option(      "--thin",      dest="thin",      default=1,  type="int",      \
                         help = "Specify a number between 2 and 5 thin reflectivity")
+
+    parser.add_option(      "--dart_format", dest="dart_format", default=None, type="string", \
+                        help = "Format of the DART obs_seq files:  ascii (default) or binary")
+
+    parser.add_option(      "--subdomain_cache", dest="subdomain_cache", default=None, type="string", \
+                        help = "Directory to keep the MRMS window of the domain in, reused by later runs")
                     
     (options, args) = parser.parse_args()
 
@@ -17,6 +17,8 @@ def main(start_time):
     obj.plot = int(settings.opaws_plot)
     obj.loc = [lat, lon]
     obj.thin = 1    
+    obj.dart_format = settings.mrms_dart_format
+    obj.subdomain_cache = settings.mrms_subdomain_cache
     run(obj)
 
 if __name__ == "__main__":
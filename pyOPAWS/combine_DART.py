@@ -0,0 +1,72 @@
+import sys, os, glob
+import time
+from optparse import OptionParser
+from Config import settings
+from utils.dart_tools import merge_DART_obs_seq
+
+#=========================================================================================
+# Merge the DART obs_seq files of the radars of a cycle (and the MRMS reflectivity file)
+# into one obs_seq file for DART (see utils.dart_tools.merge_DART_obs_seq)
+#-------------------------------------------------------------------------------
+# Main function defined to return correct sys.exit() calls
+
+def main(argv=None):
+    if argv is None:
+           argv = sys.argv
+
+    parser = OptionParser()
+
+    parser.add_option("-d", "--dir",  dest="dir",  default=None, type="string",
+                       help = "Directory of the radar obs_seq files")
+
+    parser.add_option("-f", "--file",  dest="file",  default=None, type="string",
+                       help = "Suffix of the radar obs_seq files, e.g. _VR_20200302_2200.out")
+
+    parser.add_option("-m", "--mrms",  dest="mrms",  default=None, type="string",
+                       help = "MRMS obs_seq_RF file to merge with the radar files")
+
+    parser.add_option("-o", "--output", dest="output",  default=None, type="string",
+                       help = "Merged obs_seq file, default is obs_seq<suffix> in the directory")
+
+    (options, args) = parser.parse_args(argv[1:])
+
+    if options.dir == None:
+        options.dir = settings.opaws_obs_seq
+
+    if options.file == None:
+        print("\n combine_DART:  ERROR --> No file suffix specified!!!\n")
+        parser.print_help()
+        return -1
+
+    wild  = os.path.abspath(options.dir)+"/obs_seq_K*"+options.file
+    files = sorted(glob.glob(wild))
+
+    if options.mrms != None:
+        files.append(options.mrms)
+
+    if len(files) == 0:
+        print("\n combine_DART:  No files found matching %s, exiting" % wild)
+        return -1
+
+    if options.output == None:
+        options.output = os.path.join(options.dir, "obs_seq%s" % options.file)
+
+    print("\n combine_DART:  Merging %d files into %s\n" % (len(files), options.output))
+    for file in files:
+        print(" %s" % file)
+
+    begin_time = time.time()
+
+    nobs = merge_DART_obs_seq(files, options.output)
+
+    print("\n combine_DART:  %d observations merged in %f seconds \n" % (nobs, time.time() - begin_time))
+
+    return 0
+
+#-------------------------------------------------------------------------------
+# Main program for testing...
+#
+if __name__ == "__main__":
+    sys.exit(main())
+
+# End of file
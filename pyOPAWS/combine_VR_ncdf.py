@@ -1,19 +1,334 @@
-import pandas as pd
 import numpy as np
 from netcdftime import utime
-import matplotlib.pyplot as plt
 import sys, os, glob
 import time
 import datetime as DT
 from optparse import OptionParser
 from Config import settings
-import xarray as xr
-import netCDF4 as ncdf
+from utils.radar import getFromFile, getLatLonFromFile
+from multiprocessing import Pool
+from collections import deque
+from utils.obs_seq_netcdf import read_obs_seq_netcdf, create_obs_seq_netcdf, append_obs_seq_netcdf, \
+                                 copy_obs_seq_netcdf, _compression
+from utils.grid_cache import get_grid
 
 time_format = "%Y%m%d_%H:%M:%S"
 day_utime   = utime("days since 1601-01-01 00:00:00")
 sec_utime   = utime("seconds since 1970-01-01 00:00:00")
 
+# Maximum number of reader processes (one cpu is left to the writer) and files read ahead of
+# the writer (per process)
+
+_nprocs     = 4
+_read_ahead = 2
+
+# Seconds between two looks at the directory when combining the radars as they finish (--deadline)
+
+_poll       = 5.
+
+# Cross-radar thinning (--thin_dx):  the bins are the columns of the WoFS model grid (the
+# LatLon grid of pyOPAWS/opaws2d) centered on the domain center, and the default depth of a bin (m)
+
+_model_grid = {
+               'projection' : 'lcc',
+               'truelat1'   : 30.0,
+               'truelat2'   : 60.0,
+               'size'       : [900000., 900000.],
+              }
+
+_thin_dz    = 500.
+
+#=========================================================================================
+# read_file runs in the reader processes, a file that cannot be read is returned as None
+
+def read_file(file):
+
+    try:
+        return read_obs_seq_netcdf(file)
+    except Exception as e:
+        print(" Dart_cc:  cannot read %s:  %s" % (file, str(e)))
+        return None
+
+#=========================================================================================
+# radar_name returns the radar of a per-radar file (obs_seq_KTLX_VR_20200302_2200.nc)
+
+def radar_name(file):
+
+    return os.path.basename(file)[len("obs_seq_"):].split("_")[0]
+
+# obs_type returns the type of the obs of a per-radar file (VR for the file above)
+
+def obs_type(file):
+
+    return (os.path.basename(file)[len("obs_seq_"):].split("_") + [""])[1]
+
+#=========================================================================================
+# thin_mask is the cross-radar thinning:  the obs are binned by model column (i, j), height
+# bin and obs type, and in each bin only the obs of the radar closest to the bin (the radar
+# of the ob at the shortest range) are kept.  All arrays are per ob, radar and kind are
+# integer labels.  Returns the boolean array of the obs kept.
+
+def thin_mask(i, j, k, kind, radar, rng):
+
+    nobs = radar.size
+
+    if nobs == 0:
+        return np.zeros((0,), dtype=bool)
+
+    # one integer key per bin, then the obs sorted by bin and range:  the first ob of a bin
+    # is the closest one and its radar wins the bin
+
+    labels = [np.asarray(a, dtype=np.int64) for a in (i, j, k, kind)]
+    shape  = [int(a.max() - a.min()) + 1 for a in labels]
+    key    = np.ravel_multi_index([a - a.min() for a in labels], shape)
+
+    order  = np.lexsort((rng, key))
+    first  = np.ones((nobs,), dtype=bool)
+    first[1:] = key[order][1:] != key[order][:-1]
+
+    winner = radar[order][first][np.cumsum(first) - 1]
+
+    keep   = np.empty((nobs,), dtype=bool)
+    keep[order] = radar[order] == winner
+
+    return keep
+
+#=========================================================================================
+# Combined_File:  the combined netCDF file the radar files are appended to.
+#
+# The file is created with an unlimited index dimension from the first radar file with obs,
+# and is written under a temporary name.  close() renames it to netcdf_file, so a complete
+# combined file is published at once, with the radars it includes as global attributes.
+# With thin = (dx, dz, (lat, lon)) the obs are thinned across the radars (see thin_mask) in the
+# columns of the model grid with spacing dx centered at lat, lon before the file is published,
+# and the obs kept of each radar are reported.
+
+class Combined_File(object):
+
+    def __init__(self, netcdf_file, thin=None):
+
+        self.netcdf_file = netcdf_file
+        self.tmpfile     = "%s.tmp" % netcdf_file
+        self.fnc         = None
+        self.names       = None
+        self.nobs        = 0
+        self.radars      = []
+        self.counts      = []
+        self.kinds       = []
+        self.thin        = thin
+        self.kept        = None
+
+    def append(self, file, obs):
+
+        nobs, columns, attributes, gattrs = obs
+
+        if nobs > 0 and self.fnc is None:
+            gattrs.pop('date', None)       # the date of each ob is a column of the combined file
+            self.fnc      = create_obs_seq_netcdf(self.tmpfile, columns, attributes, gattrs)
+            self.names    = set(attributes)
+            self.template = ([(name, column[:0]) for name, column in columns], attributes, gattrs)
+
+        if nobs > 0 and set(attributes) != self.names:
+            print(" Dart_cc:  %s does not have the same variables as the first file, skipping it" % file)
+            return
+
+        if nobs > 0:
+            append_obs_seq_netcdf(self.fnc, columns)
+
+        self.nobs = self.nobs + nobs
+        self.radars.append(radar_name(file))
+        self.counts.append(nobs)
+        self.kinds.append(obs_type(file))
+        print("%s has %d observations, total is now %d" % (file, nobs, self.nobs))
+
+    def close(self, missing=None):
+
+        if self.fnc is None:
+            print("\n Dart_cc:  no observations found, %s not written" % self.netcdf_file)
+            return False
+
+        if self.thin is not None:
+            self.thin_obs(*self.thin)
+
+        self.fnc.history         = "Created " + DT.datetime.today().strftime(time_format)
+        self.fnc.radars_included = " ".join(self.radars)
+        if missing is not None:
+            self.fnc.radars_missing = " ".join(missing)
+        if self.kept is not None:
+            self.fnc.thinning    = "dx = %g m, dz = %g m, center = %g, %g" % (self.thin[0], self.thin[1], \
+                                                                             self.thin[2][0], self.thin[2][1])
+            self.fnc.radars_kept = " ".join(["%s:%d/%d" % r for r in zip(self.radars, self.kept, self.counts)])
+
+        self.fnc.close()
+        self.fnc = None
+
+        os.replace(self.tmpfile, self.netcdf_file)
+
+        return True
+
+    def thin_obs(self, dx, dz, center):
+
+        # the obs are binned in the columns of the model grid, read back one chunk at a time
+        # so only the bins and ranges of the obs are held
+
+        fnc   = self.fnc
+        nobs  = len(fnc.dimensions['index'])
+        chunk = max(1, _compression['chunk_size'])
+
+        nx    = 1 + int(_model_grid['size'][0] / dx)
+        ny    = 1 + int(_model_grid['size'][1] / dx)
+        grid  = get_grid(_model_grid['projection'], center[0], center[1], dx, -0.5*_model_grid['size'][0], \
+                         -0.5*_model_grid['size'][1], nx, ny, lat_1=_model_grid['truelat1'], lat_2=_model_grid['truelat2'])
+        map   = grid.map
+
+        plat  = fnc.variables['platform_lat']
+        plon  = fnc.variables['platform_lon']
+
+        i     = np.empty((nobs,), dtype=np.int32)
+        j     = np.empty((nobs,), dtype=np.int32)
+        k     = np.empty((nobs,), dtype=np.int32)
+        rng   = np.empty((nobs,), dtype=np.float32)
+
+        for m in range(0, nobs, chunk):
+            block  = slice(m, m+chunk)
+            x,  y  = map(fnc.variables['lon'][block], fnc.variables['lat'][block])
+            xr, yr = map(plon[block], plat[block])
+            z      = fnc.variables['height'][block]
+            i[block]   = np.floor((x - grid.xg[0])/dx + 0.5)
+            j[block]   = np.floor((y - grid.yg[0])/dx + 0.5)
+            k[block]   = np.floor(z/dz)
+            rng[block] = np.sqrt((x - xr)**2 + (y - yr)**2 + (z - fnc.variables['platform_hgt'][block])**2)
+
+        kinds = dict([(kind, n) for n, kind in enumerate(sorted(set(self.kinds)))])
+        radar = np.repeat(np.arange(len(self.radars)), self.counts)
+        kind  = np.repeat([kinds[kind] for kind in self.kinds], self.counts)
+
+        keep  = thin_mask(i, j, k, kind, radar, rng)
+
+        del i, j, k, rng
+
+        # the obs kept are copied to a new file, which replaces the temporary file
+
+        thinfile = "%s.thin.tmp" % self.netcdf_file
+        out      = create_obs_seq_netcdf(thinfile, *self.template)
+
+        try:
+            self.nobs = copy_obs_seq_netcdf(fnc, out, keep)
+        except:
+            out.close()
+            os.remove(thinfile)
+            raise
+
+        fnc.close()
+        os.replace(thinfile, self.tmpfile)
+        self.fnc  = out
+        self.kept = np.bincount(radar[keep], minlength=len(self.radars)).tolist()
+
+        print("\n Dart_cc:  thinning with dx = %g m, dz = %g m kept %d of %d observations" % (dx, dz, self.nobs, nobs))
+        for name, kept, count in zip(self.radars, self.kept, self.counts):
+            print(" %s:  %d observations, %d kept, %d thinned" % (name, count, kept, count - kept))
+
+    def abort(self):
+
+        if self.fnc is not None:
+            self.fnc.close()
+            self.fnc = None
+            os.remove(self.tmpfile)
+
+#=========================================================================================
+# combine_obs_seq_netcdf appends the obs of files (in order) to one new netCDF file.
+#
+# The output is created once with an unlimited index dimension from the first file with
+# obs, each file is then appended in chunks as soon as it has been read.  The files are read
+# by nprocs processes (the netCDF/HDF5 libraries are not thread safe), at most
+# _read_ahead*nprocs files ahead of the writer, so memory is bounded by a few radars.
+# thin = (dx, dz, (lat, lon)) thins the obs across the radars (see Combined_File).
+
+def combine_obs_seq_netcdf(files, netcdf_file, nprocs=None, thin=None):
+
+    if nprocs is None:
+        nprocs = min(_nprocs, (os.cpu_count() or 1) - 1)
+
+    combined = Combined_File(netcdf_file, thin=thin)
+
+    if nprocs > 0:
+        pool    = Pool(processes=nprocs)
+        pending = deque()
+        files   = iter(files)
+
+        def results():
+            for file in files:
+                pending.append((file, pool.apply_async(read_file, (file,))))
+                if len(pending) >= _read_ahead*nprocs:
+                    file, result = pending.popleft()
+                    yield file, result.get()
+            while pending:
+                file, result = pending.popleft()
+                yield file, result.get()
+    else:
+        pool    = None
+        results = lambda: ((file, read_file(file)) for file in files)
+
+    try:
+        for file, obs in results():
+            if obs is not None:
+                combined.append(file, obs)
+
+        combined.close()
+
+    finally:
+        if pool is not None:
+            pool.terminate()
+        combined.abort()
+
+    return combined.nobs
+
+#=========================================================================================
+# watch_obs_seq_netcdf is the incremental combiner of a cycle:  the files matching wild are
+# appended as the radar jobs write them (each file is renamed into place when complete) until
+# all the radars expected have been appended or deadline seconds have passed.  The combined
+# file is then published (thinned if thin is set) with the radars included and missing.
+
+def watch_obs_seq_netcdf(wild, netcdf_file, deadline, radars=None, poll=_poll, thin=None):
+
+    stop_time = time.time() + deadline
+    combined  = Combined_File(netcdf_file, thin=thin)
+    seen      = set()
+
+    try:
+        while True:
+
+            files = [file for file in glob.glob(wild) if file not in seen and file.find(".out") == -1]
+            files = sorted(files, key = lambda file: os.path.getmtime(file))
+
+            for file in files:
+                seen.add(file)
+                obs = read_file(file)
+                if obs is not None:
+                    combined.append(file, obs)
+
+            if radars is not None and set(radars) <= set(combined.radars):
+                print("\n Dart_cc:  all %d radars have been combined" % len(radars))
+                break
+
+            if time.time() >= stop_time:
+                print("\n Dart_cc:  deadline reached with %d radars combined" % len(combined.radars))
+                break
+
+            time.sleep(max(0., min(poll, stop_time - time.time())))
+
+        missing = None if radars is None else [radar for radar in radars if radar not in combined.radars]
+
+        if missing:
+            print(" Dart_cc:  %d radars dropped at the deadline:  %s" % (len(missing), " ".join(missing)))
+
+        combined.close(missing=missing)
+
+    finally:
+        combined.abort()
+
+    return combined.nobs, combined.radars, missing
+
 #=========================================================================================
 # Write out obs_seq files to netCDF for faster inspection
 #-------------------------------------------------------------------------------
@@ -36,29 +351,82 @@ def main(argv=None):
     parser.add_option("-p", "--prefix", dest="fprefix",  default=None, type="string",
                        help = "Preappend this string to the netcdf object filename")
 
-                       
+    parser.add_option("-n", "--nprocs", dest="nprocs",  default=None, type="int",
+                       help = "Number of processes reading the files (0 = read them in this process)")
+
+    parser.add_option(      "--deadline", dest="deadline",  default=None, type="int",
+                       help = "Combine the radars as their files are written, for at most this many seconds")
+
+    parser.add_option(      "--cycle", dest="cycle",  default=None, type="string",
+                       help = "Cycle time YYYYMMDDHHMM, with --deadline stop as soon as all its radars are combined")
+
+    parser.add_option(      "--thin_dx", dest="thin_dx",  default=None, type="float",
+                       help = "Thin the obs of overlapping radars in the columns of the model grid with this spacing (m), keeping the closest radar")
+
+    parser.add_option(      "--thin_dz", dest="thin_dz",  default=_thin_dz, type="float",
+                       help = "Depth of the thinning bins (m), default is %default")
+
+    parser.add_option(      "--loc", dest="loc",  default=None, type="float", nargs=2,
+                       help = "Center (lat, lon) of the model grid used by --thin_dx, default is the center for --cycle")
+
     (options, args) = parser.parse_args()
     
+    thin = None
+
+    if options.thin_dx != None:
+        if options.loc == None and options.cycle != None:
+            options.loc = getLatLonFromFile(DT.datetime.strptime(options.cycle, "%Y%m%d%H%M"))
+        if options.loc == None:
+            print("\n Dart_cc:  ERROR --> --thin_dx needs the model grid center, use --loc or --cycle\n")
+            parser.print_help()
+            return -1
+        thin = (options.thin_dx, options.thin_dz, tuple(options.loc))
+
     if options.dir == None:
         options.dir = settings.opaws_obs_seq
 
     suffix = options.file
     wild = os.path.abspath(options.dir)+"/obs_seq_K*"+suffix
     print(wild)
+
+    if options.deadline != None:
+
+        if options.fprefix == None:
+            netcdf_file = os.path.join(options.dir, "obs_seq%s" % suffix)
+        else:
+            netcdf_file = ("%s.%s" % (options.fprefix, suffix[-12:-4]+".nc"))
+
+        radars = None
+        if options.cycle != None:
+            radars = getFromFile(DT.datetime.strptime(options.cycle, "%Y%m%d%H%M"))
+
+        print("\n Dart_cc:  combining the radar files for %d seconds into %s\n" % (options.deadline, netcdf_file))
+
+        nobs_total, included, missing = watch_obs_seq_netcdf(wild, netcdf_file, options.deadline, radars=radars, \
+                                                              thin=thin)
+
+        print("\n Dart_cc:  %d observations from %d radars combined\n" % (nobs_total, len(included)))
+
+        return 0
+
     rawlist = glob.glob(wild)
     print(rawlist)
     
-    files = sorted( rawlist, key = lambda file: os.path.getmtime(file))
-    
-    print("\n Obs_seq.final files sorted by modification time\n")
-    for file in files:
-        print(" {} - {}".format(file, time.ctime(os.path.getmtime(file))) )
-    
     # Fix in case we picked up some none obs_seq files
-    for n, file in enumerate(files):
-        if file.find(".out") != -1:  
+    for file in rawlist:
+        if file.find(".out") != -1:
             print("\n Removing file:  %s from list" % file)
-            del files[n]
+
+    mtimes = dict([(file, os.path.getmtime(file)) for file in rawlist if file.find(".out") == -1])
+    files  = sorted(mtimes, key = lambda file: mtimes[file])
+
+    print("\n Obs_seq.final files sorted by modification time\n")
+    for file in files:
+        print(" {} - {}".format(file, time.ctime(mtimes[file])) )
+
+    if len(files) == 0:
+        print("\n Dart_cc:  No files found matching %s, exiting" % wild)
+        return -1
 
     print("\n Dart_cc:  Processing %d files in the directory:  %s" % (len(files), options.dir))
     print(" Dart_cc:  First file is %s" % (files[0]))
@@ -71,44 +439,15 @@ def main(argv=None):
         netcdf_file = ("%s.%s" % (options.fprefix, os.path.split(files[0])[1][-12:-4]+".nc"))
 
     print("\n Dart_cc:  netCDF4 file to be written is %s\n" % (netcdf_file))
-                
-    dataset = []
-    nobs_total = 0
 
     begin_time = time.time()
-        
-    for file in files:
-       try:
-          infile = xr.open_dataset(file)
-          nobs_total = nobs_total + len(infile.index)
-          print("%s has %d observations, total is now %d" % (file, len(infile.index), nobs_total))
-       except:
-          continue
-
-       if len(infile.index) > 0:
-           dataset.append(infile)
-       infile.close()
-            
+
+    nobs_total = combine_obs_seq_netcdf(files, netcdf_file, nprocs=options.nprocs, thin=thin)
+
     end_time = time.time()
-    
-    print("\n Reading took {0} seconds since the loop started \n".format(end_time - begin_time))
-    
-    # Create an xarray dataset for file I/O
-    xa = xr.concat(dataset, dim='index')
-    
-    # Write the xarray file out (this is all there is, very nice guys!)
-    xa.to_netcdf(netcdf_file, mode='w')
-    xa.close()
-    
-#   Add attributes to the files
-    
-    fnc = ncdf.Dataset(netcdf_file, mode = 'a')
-    fnc.history = "Created " + DT.datetime.today().strftime(time_format)
-    
-    fnc.sync()  
-    fnc.close()
-    
-   
+
+    print("\n Combining %d observations took %f seconds \n" % (nobs_total, end_time - begin_time))
+
 #-------------------------------------------------------------------------------
 # Main program for testing...
 #
@@ -1,27 +1,92 @@
 import os
 import sys
+import time
 from multiprocessing import Pool
 from optparse import OptionParser
 
-_default_NCKS = "/home/louis.wicker/anaconda2/bin/ncks"
+import netCDF4 as ncdf
 
-_default_compression = 3
+from utils.obs_seq_netcdf import _compression, variable_options
+
+# Recompresses the netCDF files of an archive with netCDF4 (zlib + shuffle), the obs_seq
+# variables are also quantized as the writers do it (see utils/obs_seq_netcdf.py)
+
+_default_compression = _compression['complevel']
 
-ncks_cmd = '%s --ovr -4 --ppc default=%d %s %s >> ncks.log'
 nthreads = 5
 
 #=======================================================================================================================
-# RunMember is a function that runs a system command
+# compress_file rewrites one netCDF file compressed, the new file is written to a temporary
+# file and renamed when complete
+
+def compress_file(fname, newfname, complevel=_default_compression, quantize=True):
+
+    tmpfile = "%s.%d.tmp" % (newfname, os.getpid())
+
+    try:
+        src = ncdf.Dataset(fname, 'r')
+    except (IOError, OSError) as e:
+        return "Skipping %s (not a netCDF file):  %s" % (fname, str(e))
+
+    try:
+        src.set_auto_maskandscale(False)
+
+        dst = ncdf.Dataset(tmpfile, 'w', format='NETCDF4')
+
+        try:
+            dst.setncatts(dict([(a, src.getncattr(a)) for a in src.ncattrs()]))
+
+            for name, dim in src.dimensions.items():
+                dst.createDimension(name, None if dim.isunlimited() else len(dim))
+
+            for name, var in src.variables.items():
+
+                options = {}
+
+                if var.ndim > 0 and var.dtype != str:
+                    if var.dimensions == ('index',):
+                        options = variable_options(name, len(var))
+                        if not quantize:
+                            options.pop('least_significant_digit', None)
+                    else:
+                        options = {'zlib': True, 'shuffle': True}
+                    if 'zlib' in options:
+                        options['complevel'] = complevel
+                    if complevel <= 0:
+                        options = {}
+
+                attrs = dict([(a, var.getncattr(a)) for a in var.ncattrs() if a != '_FillValue'])
+
+                out = dst.createVariable(name, var.datatype, var.dimensions,
+                                         fill_value=getattr(var, '_FillValue', None), **options)
+                out.setncatts(attrs)
+                out.set_auto_maskandscale(False)
 
-def RunMember(cmd):
-    print("\n Executing command:  %s " % cmd)
-    os.system(cmd)
-    print("\n %s completed...." % cmd)
-    return
+                # copy the data in blocks along the first dimension
 
+                if var.ndim == 0:
+                    out.assignValue(var.getValue())
+                else:
+                    block = max(1, _compression['chunk_size'])
+                    for n0 in range(0, var.shape[0], block):
+                        out[n0:n0+block] = var[n0:n0+block]
+        finally:
+            dst.close()
+
+        os.replace(tmpfile, newfname)
+
+    except Exception as e:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        return "ERROR compressing %s:  %s" % (fname, str(e))
+
+    finally:
+        src.close()
+
+    return "%s:  %d -> %d bytes" % (newfname, os.path.getsize(fname), os.path.getsize(newfname))
 
 #=======================================================================================================================
-# 
+#
 def get_all_files(rootdir, mindepth = 1, maxdepth = float('inf')):
     """
     Usage:
@@ -31,14 +96,14 @@ def get_all_files(rootdir, mindepth = 1, maxdepth = float('inf')):
     This returns a list of all files of a directory, including all files in
     subdirectories. Full paths are returned.
 
-    WARNING: this may create a very large list if many files exists in the 
+    WARNING: this may create a very large list if many files exists in the
     directory and subdirectories. Make sure you set the maxdepth appropriately.
 
     rootdir  = existing directory to start
-    mindepth = int: the level to start, 1 is start at root dir, 2 is start 
+    mindepth = int: the level to start, 1 is start at root dir, 2 is start
                at the sub direcories of the root dir, and-so-on-so-forth.
-    maxdepth = int: the level which to report to. Example, if you only want 
-               in the files of the sub directories of the root dir, 
+    maxdepth = int: the level which to report to. Example, if you only want
+               in the files of the sub directories of the root dir,
                set mindepth = 2 and maxdepth = 2. If you only want the files
                of the root dir itself, set mindepth = 1 and maxdepth = 1
     """
@@ -51,58 +116,80 @@ def get_all_files(rootdir, mindepth = 1, maxdepth = float('inf')):
             for filename in files:
                 file_paths.append(os.path.join(dirpath, filename))
         elif depth > maxdepth:
-            del dirs[:]  
+            del dirs[:]
     return file_paths
 
 #=======================================================================================================================
 # Main
 
-# Process command lines
+def main(argv=None):
+
+    # Process command lines
+
+    parser = OptionParser()
+
+    parser.add_option("-i",  "--input",  dest="srcDir", type="string", help = "Path to files needing to be compressed")
+    parser.add_option("-o",  "--output", dest="outDir", type="string", help = "Path to compressed directory")
+
+    parser.add_option("-c",  "--complevel", dest="complevel", type="int", default=_default_compression, \
+                      help = "zlib compression level (1-9, 0 = copy uncompressed)")
+
+    parser.add_option("-n",  "--nprocs", dest="nprocs", type="int", default=nthreads, \
+                      help = "Number of files compressed at the same time")
+
+    parser.add_option(       "--lossless", dest="quantize", default=True, action="store_false", \
+                      help = "Do not quantize the obs_seq variables")
+
+    (options, args) = parser.parse_args(argv)
+
+    if options.srcDir == None:
+        print("\n ==> compress_ncdf: ERROR --> No source directory specified!!!\n")
+        parser.print_help()
+        return -1
+    else:
+        srcDir = options.srcDir
+        print("\n ==> compress_ncdf: Reading files from directory %s\n" % srcDir)
+
+    if options.outDir == None:
+        print("\n ==> compress_ncdf: ERROR --> No output directory specified!!!\n")
+        print("\n ==> compress_ncdf: Creating a directory automatically!!\n")
+        outDir = "%s_compressed" % srcDir.rstrip(os.path.sep)
+        print("\n ==> compress_ncdf: Writing files into directory %s\n" % outDir)
+    else:
+        outDir = options.outDir
+        print("\n ==> compress_ncdf: Writing files into directory %s\n" % outDir)
 
-parser = OptionParser()
+    # body code
 
-parser.add_option("-i",  "--input",  dest="srcDir", type="string", help = "Path to files needing to be compressed")
-parser.add_option("-o",  "--output", dest="outDir", type="string", help = "Path to compressed directory")
+    t0 = time.time()
 
-(options, args) = parser.parse_args()
+    fileList = get_all_files(srcDir)
 
-if options.srcDir == None:
-    print("\n ==> compress_ncdf: ERROR --> No source directory specified!!!\n")
-    parser.print_help()
-    sys.exit(-1)
-else:
-    srcDir = options.srcDir
-    print("\n ==> compress_ncdf: Reading files from directory %s\n" % srcDir)
+    pool = Pool(processes=options.nprocs)              # set up a queue to run
 
-if options.outDir == None:
-    print("\n ==> compress_ncdf: ERROR --> No output directory specified!!!\n")
-    print("\n ==> compress_ncdf: Creating a directory automatically!!\n")
-    outDir = "%s_compressed" % srcDir
-    print("\n ==> compress_ncdf: Writing files into directory %s\n" % outDir)
-else:
-    outDir = options.outDir
-    print("\n ==> compress_ncdf: Writing files into directory %s\n" % outDir)
+    results = []
 
+    for fname in fileList:
 
-# body code
+        if fname.count('fcst_end') == 0 and not fname.endswith('.tmp'):
+            # Construct new filename, the directory tree below srcDir is kept
+            newfname = os.path.join(outDir, os.path.relpath(fname, srcDir))
+            # check to see if new directory exists
+            if not os.path.exists(os.path.dirname(newfname)):
+                print("\nCreating new directory:  %s\n" % os.path.dirname(newfname))
+                os.makedirs(os.path.dirname(newfname))
+            results.append(pool.apply_async(compress_file, (fname, newfname, options.complevel, options.quantize)))
 
-fileList = get_all_files(srcDir)
+    pool.close()
 
-pool = Pool(processes=nthreads)              # set up a queue to run
+    for result in results:
+        print(" %s" % result.get())
 
-for fname in fileList:
+    pool.join()
 
-    if fname.count('fcst_end') == 0:
-        # Construct new filename
-        mystr = fname.split('/',4)
-        newfname = os.path.join(outDir, mystr[-1])
-        # check to see if new directory exists
-        if not os.path.exists(os.path.dirname(newfname)):
-            print("\nCreating new directory:  %s\n" % os.path.dirname(newfname))
-            os.makedirs(os.path.dirname(newfname))
-        cmd = ncks_cmd % (_default_NCKS, _default_compression, fname, newfname)
-        pool.apply_async(RunMember, (cmd,))
+    print("\n ==> compress_ncdf: %d files in %f seconds\n" % (len(results), time.time() - t0))
 
-pool.close()
-pool.join()
+    return 0
 
+if __name__ == "__main__":
+    sys.exit(main())
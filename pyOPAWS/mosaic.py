@@ -0,0 +1,304 @@
+#############################################################
+# mosaic:  grid all the radars for a cycle onto the common  #
+#          (model centered) grid in one job.                #
+#                                                           #
+#          Radial velocities are written per radar, as      #
+#          opaws2d does.  Reflectivity can be superobbed    #
+#          across radars into a single mosaic, so columns   #
+#          seen by overlapping radars only produce one set  #
+#          of obs.                                          #
+#############################################################
+from __future__ import print_function
+
+import os
+import sys
+import time as timeit
+import datetime as DT
+
+import numpy as np
+import scipy.ndimage as ndimage
+from optparse import OptionParser
+
+from utils.dart_tools import opaws_write_DART_ascii
+from utils.process_pool import map_processes
+from pyOPAWS.opaws2d import Gridded_Field, configure, find_closest_file, read_volume, analyzeVolume, \
+                            write_obs_seq_xarray, plot_gridded, _grid_dict, _radar_parameters, _obs_errors
+
+# Parameter dict for the reflectivity mosaic
+
+_mosaic_dict = {
+                'layer_depth'  : 1000.,    # meters, reflectivity from all radars is superobbed in MSL height layers
+                'max_height'   : 20000.,   # meters MSL, top of the highest layer
+               }
+
+#=========================================================================================
+# Reflectivity mosaic
+
+def mosaic_reflectivity(refs, analysis_time):
+    """
+        Superobs the masked reflectivity grids (output of opaws2d.dbz_masking) of several
+        radars gridded onto the same LatLon grid.
+
+        The obs in each grid column are binned into MSL height layers of depth
+        _mosaic_dict['layer_depth'], and each layer keeps the mean of the echo obs
+        (or the mean of the 0 dBZ obs if no radar sees echo there).  With the MRMS_zeros
+        option the 0 dBZ level is the union of the radars' 0 dBZ points, removed
+        near any radar's echo and outside the range of all the radars.
+
+        Returns a Gridded_Field that can be written by opaws_write_DART_ascii, the
+        heights are MSL (radar_hgt = 0) and the obs are valid at analysis_time.
+    """
+
+    ref0    = refs[0]
+    nz, ny, nx = ref0.data.shape
+
+    nlayer  = 1 + int(_mosaic_dict['max_height'] / _mosaic_dict['layer_depth'])
+    ncell   = nlayer * ny * nx
+
+    echo_sum = np.zeros((ncell,))
+    echo_hgt = np.zeros((ncell,))
+    echo_cnt = np.zeros((ncell,))
+    zero_hgt = np.zeros((ncell,))
+    zero_cnt = np.zeros((ncell,))
+
+    column  = np.arange(ny*nx).reshape(ny, nx)
+    covered = np.full((ny, nx), False)
+
+    for ref in refs:
+
+        valid  = (np.ma.getmaskarray(ref.data) == False)
+        values = np.ma.getdata(ref.data)[valid]
+        hgts   = np.ma.getdata(ref.zg)[valid] + ref.radar_hgt
+
+        layer  = np.clip((hgts / _mosaic_dict['layer_depth']).astype(np.int64), 0, nlayer-1)
+        cell   = layer * ny * nx + np.broadcast_to(column, valid.shape)[valid]
+
+        echo   = (values > 0.1)
+
+        echo_sum += np.bincount(cell[echo],  weights=values[echo], minlength=ncell)
+        echo_hgt += np.bincount(cell[echo],  weights=hgts[echo],   minlength=ncell)
+        echo_cnt += np.bincount(cell[echo],  minlength=ncell)
+        zero_hgt += np.bincount(cell[~echo], weights=hgts[~echo],  minlength=ncell)
+        zero_cnt += np.bincount(cell[~echo], minlength=ncell)
+
+        # grid points within range of this radar
+
+        xoffset, yoffset = ref.basemap(ref.radar_lon, ref.radar_lat)
+        covered |= (np.hypot(ref.xg[np.newaxis,:] - xoffset, ref.yg[:,np.newaxis] - yoffset) \
+                    <= _radar_parameters['max_range'])
+
+    # echo wins over 0 dBZ in a layer
+
+    has_echo = (echo_cnt > 0)
+    has_zero = (zero_cnt > 0) & (~has_echo)
+
+    data = np.zeros((ncell,), dtype=np.float32)
+    zg   = np.zeros((ncell,), dtype=np.float32)
+
+    data[has_echo] = echo_sum[has_echo] / echo_cnt[has_echo]
+    zg[has_echo]   = echo_hgt[has_echo] / echo_cnt[has_echo]
+    zg[has_zero]   = zero_hgt[has_zero] / zero_cnt[has_zero]
+
+    mask = ~(has_echo | has_zero)
+
+    # only keep the layers that have obs
+
+    layers = np.nonzero(np.any(~mask.reshape(nlayer, ny*nx), axis=1))[0]
+
+    data = data.reshape(nlayer, ny, nx)[layers]
+    zg   = zg.reshape(nlayer, ny, nx)[layers]
+    mask = mask.reshape(nlayer, ny, nx)[layers]
+
+    time = {'data':  np.zeros((1,)),
+            'units': analysis_time.strftime("seconds since %Y-%m-%dT%H:%M:%SZ")}
+
+    mosaic = Gridded_Field("data_grid", field = "reflectivity", data = np.ma.array(data, mask=mask), basemap = ref0.basemap,
+                           xg = ref0.xg, yg = ref0.yg, zg = np.ma.array(zg, mask=mask),
+                           lats = ref0.lats, lons = ref0.lons, elevations = np.zeros((layers.size,)),
+                           radar_lat = ref0.lats[ny//2], radar_lon = ref0.lons[nx//2], radar_hgt = 0.0,
+                           time = time, sweep_time = np.zeros((layers.size,)), metadata = {'instrument_name': 'MOSAIC'},
+                           nyquist = np.zeros((layers.size,)))
+
+    # 0 dBZ level from the composite of all the radars
+
+    if _grid_dict['MRMS_zeros'][0] == True and all([hasattr(ref, 'zero_dbz') for ref in refs]):
+
+        c_ref = np.zeros((ny, nx))
+        zero_mask = np.full((ny, nx), True)
+
+        for ref in refs:
+            c_ref = np.maximum(c_ref, np.ma.filled(ref.cref, 0.0))
+            zero_mask &= np.ma.getmaskarray(ref.zero_dbz)
+
+        max_neighbor = (ndimage.maximum_filter(c_ref, size=_grid_dict['halo_footprint']) > 0.1)
+
+        mosaic.zero_dbz    = np.ma.array(np.zeros((ny, nx), dtype=np.float32), \
+                                         mask = zero_mask | max_neighbor | (~covered))
+        mosaic.zero_dbz_zg = ref0.zero_dbz_zg
+        mosaic.cref        = np.ma.array(c_ref, mask=(~covered))
+
+    print("\n Reflectivity mosaic from %d radars:  %d layers, %d obs (%d before the mosaic)\n" \
+          % (len(refs), layers.size, np.sum(mask == False), sum([np.sum(np.ma.getmaskarray(r.data) == False) for r in refs])))
+
+    return mosaic
+
+########################################################################
+# Main function
+
+def run(options):
+    """
+        Processes the closest volume of each radar in options.radars (subdirectories of
+        options.feed) onto the grid centered at options.LatLon.
+    """
+
+    print(' ================================================================================')
+    print('')
+    print('                   BEGIN PROGRAM opaws2D MOSAIC                     ')
+    print('')
+    print(' ================================================================================')
+
+    if not os.path.exists(options.out_dir):
+        os.mkdir(options.out_dir)
+
+    unfold_type, cLatLon, sweep_num = configure(options)
+
+    if cLatLon is None:
+        cLatLon = options.LatLon
+
+    analysisT = DT.datetime.strptime(options.window, "%Y,%m,%d,%H,%M")
+
+    t0 = timeit.time()
+
+    def process_radar(radar):
+        """
+            Grids the closest volume of radar and writes its obs, returns its masked
+            reflectivity grid if it goes into the mosaic (else None)
+        """
+
+        fname = find_closest_file(os.path.join(options.feed, radar), analysisT)
+
+        if fname is None:
+            print("\n COULD NOT find any files for radar %s near %s, skipping" % (radar, analysisT.strftime("%Y,%m,%d,%H,%M")))
+            return None
+
+        print("\n FOUND CLOSEST FILE:   %s" % fname)
+
+        volume = read_volume(fname)
+
+        if volume is None:
+            return None
+
+        ref, vel = analyzeVolume(volume, unfold_type, options, cLatLon)
+
+        out_filename = os.path.join(options.out_dir, "%s_VR_%s" % (radar, analysisT.strftime("%Y%m%d_%H%M")))
+
+        if options.write == True:
+            print('\n WRITING XARRAY: {}\n'.format(out_filename))
+            ret = write_obs_seq_xarray(vel, filename=out_filename, obs_error= _obs_errors['velocity'], \
+                                       volume_name=os.path.basename(fname))
+
+            print('\n WRITING DART: {}\n'.format(out_filename))
+            ret = opaws_write_DART_ascii(vel, filename=out_filename, grid_dict=_grid_dict, \
+                                         obs_error=[_obs_errors['velocity']], dart_format=_grid_dict['dart_format'] )
+
+            if options.onlyVR != True and not options.superob_ref:
+                ret = opaws_write_DART_ascii(ref, filename=out_filename+"_RF", grid_dict=_grid_dict, \
+                                             obs_error=[_obs_errors['reflectivity'], _obs_errors['0reflectivity']], \
+                                             dart_format=_grid_dict['dart_format'])
+
+        for pl in sweep_num:
+            plottime = plot_gridded(ref, vel, pl, fsuffix=os.path.basename(out_filename), dir=options.out_dir, \
+                                    shapefiles=options.shapefiles, interactive=options.interactive, LatLon=cLatLon)
+
+        if options.onlyVR != True and options.superob_ref:
+            return ref
+
+        return None
+
+    # The radars are processed by options.nprocs processes (the SLURM allocation, see pyOPAWS/run.py),
+    # with a single radar left the sweeps are gridded by those processes instead (opaws2d.grid_fields)
+
+    refs = [ref for ref in map_processes(process_radar, options.radars, getattr(options, 'nprocs', None)) if ref is not None]
+
+    if len(refs) > 0:
+
+        mosaic = mosaic_reflectivity(refs, analysisT)
+
+        if options.write == True:
+            out_filename = os.path.join(options.out_dir, "MOSAIC_RF_%s" % analysisT.strftime("%Y%m%d_%H%M"))
+            print('\n WRITING DART: {}\n'.format(out_filename))
+            ret = opaws_write_DART_ascii(mosaic, filename=out_filename, grid_dict=_grid_dict, \
+                                         obs_error=[_obs_errors['reflectivity'], _obs_errors['0reflectivity']], \
+                                         dart_format=_grid_dict['dart_format'])
+
+    print("\n Time for opaws2D mosaic operations: {} seconds".format(timeit.time() - t0))
+
+    print("\n PROGRAM opaws2D MOSAIC COMPLETED\n")
+
+if __name__ == "__main__":
+   parser = OptionParser()
+   parser.add_option("-d", "--dir",       dest="feed",      default=None,  type="string", \
+           help = "Directory containing a sub-directory of level II files for each radar")
+
+   parser.add_option("-r", "--radars",    dest="radars",    default=None,  type="string", \
+           help = "Comma separated list of radars to process, e.g. KTLX,KINX,KVNX")
+
+   parser.add_option(      "--latlon",    dest="latlon",    default=None,  type="string", \
+           help = "Lat,Lon of the center of the common grid")
+
+   parser.add_option("-o", "--out",       dest="out_dir",   default="opaws_files",  type="string", \
+           help = "Directory to place output files in")
+
+   parser.add_option(      "--window",    dest="window",    type="string", default=None,  \
+           help = "Time of window location in YYYY,MM,DD,HH,MM")
+
+   parser.add_option("-u", "--unfold",    dest="unfold",    default="region",  type="string", \
+           help = "dealiasing method to use (phase or region, default = region)")
+
+   parser.add_option("-w", "--write",     dest="write",     default=False, \
+           help = "Boolean flag to write DART ascii file", action="store_true")
+
+   parser.add_option(      "--onlyVR",    dest="onlyVR",    default=False, \
+           help = "Boolean flag to only write VR to DART ascii file", action="store_true")
+
+   parser.add_option(      "--nosuperob", dest="superob_ref", default=True, \
+           help = "Boolean flag to write the reflectivity of each radar instead of the mosaic", action="store_false")
+
+   parser.add_option(     "--method",     dest="method",    default=None, type="string", \
+           help = "Function to use for the weight process, valid strings are:  Cressman, Barnes, Cressman-binned or Barnes-binned")
+
+   parser.add_option("-q", "--qc",        dest="qc",        default="Minimal",  type="string",     \
+           help = "Type of QC corrections on reflectivity or velocity.  Valid:  None, Minimal, MetSignal, A1")
+
+   parser.add_option(     "--dx",         dest="dx",        default=None, type="float", \
+           help = "Analysis grid spacing in meters for superob resolution")
+
+   parser.add_option(     "--roi",        dest="roi",       default=None, type="float", \
+           help = "Radius of influence in meters for superob regrid")
+
+   parser.add_option(     "--weight_cache", dest="weight_cache", default=None, type="string", \
+           help = "Directory to cache the grid geometry (and the superob weights if _grid_dict weight_cache is on) in between runs")
+
+   parser.add_option(     "--nprocs",     dest="nprocs",    default=None, type="int", \
+           help = "Number of processes used to grid the sweeps")
+
+   parser.add_option(     "--dart_format", dest="dart_format", default=None, type="string", \
+           help = "Format of the DART obs_seq files:  ascii (default) or binary")
+
+   parser.add_option("-p", "--plot",      dest="plot",      default=0,  type="int",      \
+           help = "Specify a number between 0 and # elevations to plot ref and vr in that co-plane")
+
+   (options, args) = parser.parse_args()
+
+   if options.feed == None or options.radars == None or options.latlon == None or options.window == None:
+       print("\n\n ***** USER MUST SPECIFY --dir, --radars, --latlon AND --window *****\n")
+       parser.print_help()
+       sys.exit(1)
+
+   options.radars      = options.radars.split(",")
+   options.LatLon      = tuple([float(s) for s in options.latlon.split(",")])
+   options.newse       = None
+   options.shapefiles  = None
+   options.interactive = False
+
+   run(options)
@@ -47,20 +47,24 @@ import scipy.ndimage as ndimage
 import scipy.spatial
 from optparse import OptionParser
 from matplotlib.offsetbox import AnchoredText
-from utils.dart_tools import opaws_write_DART_ascii
+from utils.dart_tools import opaws_write_DART_ascii, beam_hgt_grid
+from utils.obs_seq_netcdf import write_obs_seq_netcdf, obs_time
 from pyOPAWS.radar_QC import *
 
 import netCDF4 as ncdf
 import datetime as DT
-import xarray as xr
 import pandas as pd
 import metpy.calc as mpcalc
 from metpy.units import units
 
-from utils.cressman import *
+from utils.superob import get_superob_engine, superob_weights, apply_superob_weights, obs_2_grid2d_binned, \
+                          active_window, in_reach
+from utils.weight_cache import get_weight_cache, sweep_key
+from utils.grid_cache import get_grid
+from utils.process_pool import shared_array, map_processes
+from utils.catalog import get_catalog
 import pyart
 
-from pyproj import Proj
 import pylab as plt  
 from mpl_toolkits.basemap import Basemap
 from pyart.graph import cm
@@ -98,11 +102,16 @@ _vr_scale  = (-50.,50.)
 # Need for Lambert conformal (default) coordinate projection
 truelat1, truelat2 = 30.0, 60.0
 
+# Fields measured on the surveillance cut of a split cut (gridded on the reflectivity sweeps),
+# all other fields are gridded on the velocity sweeps
+
+_surveillance_fields = ['reflectivity', 'differential_reflectivity', 'cross_correlation_ratio', 'differential_phase']
+
 # Parameter dict for Gridding
 _grid_dict = {
               'grid_spacing_xy' : 3000.,         # meters
               'domain_radius_xy': 150000.,       # meters
-              'anal_method'     : 'Cressman',    # options are Cressman, Barnes (1-pass)
+              'anal_method'     : 'Cressman',    # options are Cressman, Barnes (1-pass), Cressman-binned, Barnes-binned (fast, approximate)
               'ROI'             : 1000.,         # Cressman ~ analysis_grid * sqrt(2), Barnes ~ largest data spacing in radar
               'min_count'       : 3,             # regular radar data ~3, high-res radar data ~ 10
               'min_weight'      : 0.2,           # min weight for analysis Cressman ~ 0.3, Barnes ~ 2
@@ -112,7 +121,12 @@ _grid_dict = {
               '0dbz_obtype'     : True,
               'thin_zeros'      : 4,
               'halo_footprint'  : 3,
-              'nthreads'        : 1,
+              'nprocs'          : 1,
+              'superob_engine'  : 'numpy',       # options are numpy (utils/superob.py) or fortran (f2py utils/cressman.f90)
+              'weight_cache'    : False,         # reuse sparse superob weights per radar/VCP/sweep/grid, approximate (utils/weight_cache.py)
+              'weight_cache_dir': None,          # directory to also keep the weights on disk, None = in memory only
+              'grid_cache_dir'  : None,          # directory to also keep the grid geometry on disk (memory-mapped), see utils/grid_cache.py
+              'dart_format'     : 'ascii',       # obs_seq files are written as ascii or binary (DART unformatted obs sequence)
               'max_height'      : 10000.,
               'MRMS_zeros'      : [True,      6000.], # True: creates a single level of zeros where composite DBZ < _dbz_min
               'model_grid_size' : [900000., 900000.]  # Used to create a common grid for all observations (special option) 
@@ -278,9 +292,15 @@ def vel_masking(vel, ref, volume):
         
     return vel
 
-def grid_data(volume, field, LatLon=None):
+def grid_fields(volume, fields, LatLon=None):
     """
-        Grid data using parameters defined above in grid_dict 
+        Grid several fields at once using parameters defined above in grid_dict.
+
+        Fields on the same sweep share one set of superob weights, so e.g. reflectivity
+        and velocity on a single-cut tilt (or velocity and spectrum width on the Doppler
+        cut of a split cut) only pay for the gate geometry and weights once.
+
+        Returns a dict of Gridded_Field objects keyed by field name.
     """
 
     # Two ways to grid the data:  radar centered or external grid
@@ -292,12 +312,9 @@ def grid_data(volume, field, LatLon=None):
         nx, ny          = (grid_pts_xy, grid_pts_xy)
         radar_lat       = volume.latitude['data'][0]
         radar_lon       = volume.longitude['data'][0]
-        xg              = -domain_length + grid_spacing_xy * np.arange(grid_pts_xy)
-        yg              = -domain_length + grid_spacing_xy * np.arange(grid_pts_xy)
-        
-        map = Proj(proj='lcc', ellps='WGS84', datum='WGS84', lat_1=truelat1, lat_2=truelat2, lat_0=radar_lat, lon_0=radar_lon)
-        xoffset, yoffset = list(map(radar_lon, radar_lat)) 
-        lons, lats = list(map(xg, yg, inverse=True))
+
+        grid = get_grid(_grid_dict['projection'], radar_lat, radar_lon, grid_spacing_xy, -domain_length, -domain_length, \
+                        nx, ny, lat_1=truelat1, lat_2=truelat2, cache_dir=_grid_dict['grid_cache_dir'])
         
     else:  # grid based on model grid center LatLon
 
@@ -305,27 +322,66 @@ def grid_data(volume, field, LatLon=None):
         nx              = 1 + np.int(_grid_dict['model_grid_size'][0] / grid_spacing_xy)
         ny              = 1 + np.int(_grid_dict['model_grid_size'][1] / grid_spacing_xy)
         grid_pts_xy     = max(nx, ny)
-        xg              = -0.5*_grid_dict['model_grid_size'][0] + grid_spacing_xy * np.arange(nx)
-        yg              = -0.5*_grid_dict['model_grid_size'][1] + grid_spacing_xy * np.arange(ny)
         radar_lat       = volume.latitude['data'][0]
         radar_lon       = volume.longitude['data'][0]
-        
-        map = Proj(proj='lcc', ellps='WGS84', datum='WGS84', lat_1=truelat1, lat_2=truelat2, lat_0=LatLon[0], lon_0=LatLon[1])
-        
-        xoffset, yoffset = list(map(radar_lon, radar_lat))
-        lons, lats = list(map(xg, yg, inverse=True))
 
-    if _grid_dict['anal_method'] == 'Cressman':
+        grid = get_grid(_grid_dict['projection'], LatLon[0], LatLon[1], grid_spacing_xy, -0.5*_grid_dict['model_grid_size'][0], \
+                        -0.5*_grid_dict['model_grid_size'][1], nx, ny, lat_1=truelat1, lat_2=truelat2, \
+                        cache_dir=_grid_dict['grid_cache_dir'])
+
+    # Projection, grid coordinates and radar location on the grid (cached per grid, see utils/grid_cache.py)
+
+    map        = grid.map
+    xg, yg     = grid.xg, grid.yg
+    lons, lats = grid.lons, grid.lats
+
+    xoffset, yoffset = grid.offset(np.ravel(radar_lat)[0], np.ravel(radar_lon)[0])
+
+    if _grid_dict['anal_method'] in ['Cressman', 'Cressman-binned']:
         anal_method = 1
     else:
         anal_method = 2
 
+    # binned methods:  histogram + kernel convolution on the grid, see utils/superob.obs_2_grid2d_binned
+
+    binned = _grid_dict['anal_method'].endswith('-binned')
+
+    # sparse weight matrices (cached or shared between fields) are only used for Cressman,
+    # the Barnes footprint (5*roi) makes them ~25 times larger
+
+    use_weights = (anal_method == 1) and not binned
+
     roi        = _grid_dict['ROI']
-    nthreads   = _grid_dict['nthreads']
+    nprocs     = _grid_dict['nprocs']
     min_count  = _grid_dict['min_count']
     min_weight = _grid_dict['min_weight']
     min_range  = _grid_dict['min_range']
 
+    # Active window:  only the part of the grid that the radar's gates can reach is gridded,
+    # (all of a radar centered grid, usually a small part of the model grid in LatLon mode)
+
+    window = active_window(xg, yg, xoffset, yoffset, volume.range['data'][-1], anal_method, 2.0*grid_spacing_xy)
+
+    if window is None:
+        print("\n Radar does not reach the analysis grid, no data will be gridded\n")
+        rows, cols = slice(0, 0), slice(0, 0)
+    else:
+        rows, cols = window
+
+    xs, ys = xg[cols], yg[rows]
+
+    if binned:
+        obs_2_grid2d = obs_2_grid2d_binned
+    else:
+        obs_2_grid2d = get_superob_engine(_grid_dict['superob_engine'])
+
+    if _grid_dict['weight_cache'] and use_weights and window is not None:
+        weight_cache = get_weight_cache(_grid_dict['weight_cache_dir'])
+        grid_spec    = (float(xs[0]), float(ys[0]), float(grid_spacing_xy), int(xs.size), int(ys.size), \
+                        float(xoffset), float(yoffset), anal_method, float(2.0*grid_spacing_xy), float(min_range))
+    else:
+        weight_cache = None
+
     ########################################################################
 
     print('\n Gridding radar data with following parameters')
@@ -333,15 +389,18 @@ def grid_data(volume, field, LatLon=None):
     print(' Method of Analysis:      {}'.format(_grid_dict['anal_method']))
     print(' Horizontal grid spacing: {} km'.format(grid_spacing_xy/1000.))
     print(' Grid points in x,y:      {},{}'.format(int(nx),int(ny)))
+    print(' Active grid window x,y:  {},{}'.format(xs.size, ys.size))
     print(' Weighting function:      {}'.format(_grid_dict['anal_method']))
     print(' Radius of Influence:     {} km'.format(_grid_dict['ROI']/1000.))
     print(' Minimum gates:           {}'.format(min_count))
     print(' Minimum weight:          {}'.format(min_weight))
     print(' Minimum range:           {} km'.format(min_range/1000.))
     print(' Map projection:          {}'.format(_grid_dict['projection']))
+    print(' Processes:               {}'.format(nprocs))
+    print(' Weight cache:            {}'.format((_grid_dict['weight_cache_dir'] or 'memory') if weight_cache is not None else 'off'))
     print(' Xoffset:                 {} km'.format(np.round(xoffset/1000.)))
     print(' Yoffset:                 {} km'.format(np.round(yoffset/1000.)))
-    print(' Field to be gridded:     {}\n'.format(field)) 
+    print(' Fields to be gridded:    {}\n'.format(', '.join(fields))) 
     print(' Min / Max X grid loc:    {} <-> {} km\n'.format(0.001*xg[0], 0.001*xg[-1]))
     print(' Min / Max Y grid loc:    {} <-> {} km\n'.format(0.001*yg[0], 0.001*yg[-1]))
     print(' Min / Max Longitude:     {} <-> {} deg\n'.format(lons[0], lons[-1]))
@@ -381,99 +440,166 @@ def grid_data(volume, field, LatLon=None):
             return gc
 
 
+    def build_weights(x, y):
+        """
+            Sparse superob weights for all the gates in a sweep
+        """
+
+        xob = x.ravel() + xoffset
+        yob = y.ravel() + yoffset
+
+        return superob_weights(xob, yob, xs, ys, np.searchsorted(xs, xob), np.searchsorted(ys, yob), \
+                               anal_method, min_range, 2.0*grid_spacing_xy)
+
     tt = timeit.clock()
 
     #####################################################################################   
-    try:
-        v_iter = volume.iter_field(field)
-        field_name = field
-    except KeyError:
-        print("\n No dealiased velocity present, gridding RAW radial velocity\n")
-        v_iter = volume.iter_field("velocity")
-        field_name = "velocity"
-        
-    if field == "reflectivity":
-        sweeps = volume.reflectivity
-    else:
-        sweeps = volume.velocity
+    # Field names and sweeps:  surveillance moments come from the reflectivity sweeps,
+    # the rest from the velocity sweeps (the same sweep except for split cuts)
+
+    field_names = {}
+    sweeps      = {}
+
+    for field in fields:
+        if field in volume.fields:
+            field_names[field] = field
+        elif field in _surveillance_fields:
+            raise KeyError("GRID_FIELDS:  %s is not present in the volume" % field)
+        else:
+            print("\n No dealiased velocity present, gridding RAW radial velocity\n")
+            field_names[field] = "velocity"
+
+        if field in _surveillance_fields:
+            sweeps[field] = volume.reflectivity
+        else:
+            sweeps[field] = volume.velocity
 
     #####################################################################################
     # Create 3D arrays for analysis grid, the vertical dimension is the number of tilts
 
-    new_grid    = np.zeros((len(sweeps), ny, nx))
-    new_mask    = np.full((len(sweeps), ny, nx), False)
-    elevations  = np.zeros((len(sweeps),))
-    sweep_time  = np.zeros((len(sweeps),))
-    zgrid       = np.zeros((len(sweeps), ny, nx))
-    nyquist     = np.zeros((len(sweeps),))
-        
-    # Grid only those valid sweeps 
-    
-    total = 0
-    for n, sweep_level in enumerate(sweeps):
-    
-        sweep_data = volume.get_field(sweep_level, field_name)
+    new_grid    = {}
+    new_mask    = {}
+    elevations  = {}
+    sweep_time  = {}
+    zgrid       = {}
+    nyquist     = {}
+
+    # (in shared memory, the sweeps are gridded by nprocs processes)
+
+    for field in fields:
+        new_grid[field]    = shared_array((len(sweeps[field]), ny, nx))
+        new_mask[field]    = shared_array((len(sweeps[field]), ny, nx), bool, False)
+        elevations[field]  = shared_array((len(sweeps[field]),))
+        sweep_time[field]  = shared_array((len(sweeps[field]),))
+        zgrid[field]       = shared_array((len(sweeps[field]), ny, nx))
+        nyquist[field]     = shared_array((len(sweeps[field]),))
+
+    def grid_sweep(sweep_level):
+        """
+            Grid every field that uses this sweep
+        """
+
+        users   = [(field, sweeps[field].index(sweep_level)) for field in fields if sweep_level in sweeps[field]]
+
+        weights = None
+        order   = None
 
         begin, end = volume.get_start_end(sweep_level)
-        
-        sweep_time[n] = volume.time['data'][begin:end].mean()
-        elevations[n] = volume.get_elevation(sweep_level).mean()
-        nyquist[n]    = volume.get_nyquist_vel(sweep_level)
-        
-        omask = (sweep_data.mask == False)
-        
-        x, y, z = volume.get_gate_x_y_z(sweep_level)
-        
-        obs = sweep_data[omask].ravel()
-        xob = x[omask].ravel() + xoffset
-        yob = y[omask].ravel() + yoffset
-        
-        ix = np.searchsorted(xg, xob)
-        iy = np.searchsorted(yg, yob)
-        
-        if obs.size > 0:
-            tmp = obs_2_grid2d(obs, xob, yob, xg, yg, ix, iy, anal_method, min_count, min_weight, min_range, \
-                                        2.0*grid_spacing_xy, _missing)
-            new_grid[n] = tmp
-            new_mask[n] = (tmp <= _missing)
-            total = total + np.sum(new_mask[n] == False)
-        else:
-            new_grid[n] = np.full((ny,nx), _missing)
-            new_mask[n] = np.full((ny,nx), True)
-            
-        if field == "reflectivity":
-            new_mask[n] = np.logical_or(new_mask[n], new_grid[n] < _radar_parameters['min_dbz_analysis'])
-            print(" Sweep: %2.2d Elevation: %5.2f  Number of valid reflectivity points:  %d" % (n, elevations[n],np.sum(new_mask[n]==False)))
-        else:
-            print(" Sweep: %2.2d Elevation: %5.2f  Number of valid grid points:  %d" % (n, elevations[n],np.sum(new_mask[n]==False)))
 
-        # Create z-field
+        for field, n in users:
 
-        zobs= z.ravel()
-        xob = x.ravel() + xoffset
-        yob = y.ravel() + yoffset
+            sweep_data = volume.get_field(sweep_level, field_names[field])
 
-        zobs = np.where( zobs < 0.0, 0.0, zobs)
-        
-        ix = np.searchsorted(xg, xob)
-        iy = np.searchsorted(yg, yob)
+            sweep_time[field][n] = volume.time['data'][begin:end].mean()
+            elevations[field][n] = volume.get_elevation(sweep_level).mean()
+            nyquist[field][n]    = volume.get_nyquist_vel(sweep_level)
 
-        #      tmp=inverse_distance(xob, yob, zobs, xg, yg, 2.0*grid_spacing_xy, gamma=None, kappa=None,
-        #                    min_neighbors=min_count, kind='cressman')
+            omask = (np.ma.getmaskarray(sweep_data) == False)
+
+            if window is None:
+                omask = np.full(omask.shape, False)
+
+            obs = sweep_data[omask].ravel()
+
+            # weights for the whole sweep when they are cached or shared between fields
+
+            if obs.size > 0 and weights is None:
+                if weight_cache is not None:
+                    weights, order = weight_cache.get(sweep_key(volume, sweep_level, grid_spec), volume.get_azimuth(sweep_level), \
+                                                      volume.get_elevation(sweep_level), \
+                                                      lambda: build_weights(*volume.get_gate_x_y_z(sweep_level)[0:2]))
+                elif len(users) > 1 and use_weights:
+                    weights = build_weights(*volume.get_gate_x_y_z(sweep_level)[0:2])
+                    order   = np.arange(sweep_data.shape[0])
+
+            if obs.size > 0 and weights is not None:
+                tmp = apply_superob_weights(weights, np.ma.getdata(sweep_data)[order], omask[order], ys.size, xs.size, \
+                                            min_count, min_weight, _missing)
+
+            elif obs.size > 0:
+                x, y, z = volume.get_gate_x_y_z(sweep_level)
+
+                xob = x[omask].ravel() + xoffset
+                yob = y[omask].ravel() + yoffset
+
+                ix = np.searchsorted(xs, xob)
+                iy = np.searchsorted(ys, yob)
+
+                # drop the gates that cannot reach the grid window
+
+                keep = in_reach(xob, yob, xs, ys, anal_method, 2.0*grid_spacing_xy)
+
+                tmp = obs_2_grid2d(obs[keep], xob[keep], yob[keep], xs, ys, ix[keep], iy[keep], anal_method, \
+                                   min_count, min_weight, min_range, 2.0*grid_spacing_xy, _missing)
+
+            if obs.size > 0:
+                new_grid[field][n] = np.full((ny,nx), _missing)
+                new_grid[field][n][rows, cols] = tmp
+                new_mask[field][n] = (new_grid[field][n] <= _missing)
+            else:
+                new_grid[field][n] = np.full((ny,nx), _missing)
+                new_mask[field][n] = np.full((ny,nx), True)
+
+            if field == "reflectivity":
+                new_mask[field][n] = np.logical_or(new_mask[field][n], new_grid[field][n] < _radar_parameters['min_dbz_analysis'])
+                print(" Sweep: %2.2d Elevation: %5.2f  Number of valid reflectivity points:  %d" % (n, elevations[field][n],np.sum(new_mask[field][n]==False)))
+            else:
+                print(" Sweep: %2.2d Elevation: %5.2f  Number of valid %s grid points:  %d" % (n, elevations[field][n], field, np.sum(new_mask[field][n]==False)))
+
+            # Create z-field:  beam height above the radar at each grid point (4/3 earth model)
+
+            zgrid[field][n] = beam_hgt_grid(xg, yg, xoffset, yoffset, elevations[field][n])
+
+    # Grid only those valid sweeps, nprocs processes at a time (see utils/process_pool.py)
+
+    sweep_list = sorted(set([s for field in fields for s in sweeps[field]]))
+
+    map_processes(grid_sweep, sweep_list, nprocs)
 
-        tmp = obs_2_grid2d(zobs, xob, yob, xg, yg, ix, iy, 1, 1, 0.1, min_range, 2.0*grid_spacing_xy, -99999.)
-        zgrid[n] = tmp
-        
     print("\n %f secs to run superob analysis for all levels \n" % (timeit.clock()-tt))
 
-    print('\n Total number of valid obs in volume: %d \n' % total)
-    print('\n Total number of valid obs in volume: %d \n' % np.sum(new_mask == False))
+    grids = {}
 
-    return Gridded_Field("data_grid", field = field, data = np.ma.array(new_grid, mask=new_mask), basemap = map, 
-                            xg = xg, yg = yg, zg = np.ma.array(zgrid, mask=new_mask),                   
-                            lats = lats, lons = lons, elevations=elevations,
-                            radar_lat = radar_lat, radar_lon = radar_lon, radar_hgt=volume.altitude['data'][0],
-                            time = volume.time, sweep_time = sweep_time, metadata = volume.metadata, nyquist = nyquist  ) 
+    for field in fields:
+
+        print('\n Total number of valid %s obs in volume: %d \n' % (field, np.sum(new_mask[field] == False)))
+
+        grids[field] = Gridded_Field("data_grid", field = field, data = np.ma.array(new_grid[field], mask=new_mask[field]), basemap = map, 
+                                     xg = xg, yg = yg, zg = np.ma.array(zgrid[field], mask=new_mask[field]),                   
+                                     lats = lats, lons = lons, elevations=elevations[field],
+                                     radar_lat = radar_lat, radar_lon = radar_lon, radar_hgt=volume.altitude['data'][0],
+                                     time = volume.time, sweep_time = sweep_time[field], metadata = volume.metadata, nyquist = nyquist[field]  ) 
+
+    return grids
+
+########################################################################
+
+def grid_data(volume, field, LatLon=None):
+    """
+        Grid data using parameters defined above in grid_dict 
+    """
+
+    return grid_fields(volume, [field], LatLon=LatLon)[field]
 
 ###########################################################################################
 #
@@ -787,41 +913,8 @@ def write_radar_file(ref, vel, filename=None):
 #=========================================================================================
 # Defines the data frame for each observation type
 #
-def obs_seq_xarray(len):
-
-    return (np.recarray(len,
-                    dtype = [
-                             ('value',               'f8'),
-                             ('lat',                 'f8'),
-                             ('lon',                 'f8'),
-                             ('height',              'f8'),
-                             ('error_var',           'f4'),
-                             ('utime',               'f8'),
-                             ('date',                'S128'),
-                             ('day',                 'i8'),
-                             ('second',              'i8'),
-                             ('platform_lat',        'f8'),
-                             ('platform_lon',        'f8'),
-                             ('platform_hgt',        'f8'),
-                             ('platform_dir1',       'f8'),
-                             ('platform_dir2',       'f8'),
-                             ('platform_dir3',       'f8'),
-                             ('platform_nyquist',    'f8')
-                            ]), \
-                         {
-                           'lat':   ["degrees", "latitude of observation"],
-                           'lon':   ["degrees", "longitude of observation (deg. west)"],
-                           'height':["meters",  "height above sea level"],
-                           'utime': ["seconds since 1970-01-01 00:00:00", "time of observation"],
-                           'date':  ["", "date and time of obsevation"]
-                          })
-
-#####################################################################################################
 def write_obs_seq_xarray(field, filename=None, obs_error=3., volume_name=None):
 
-   _time_units    = 'seconds since 1970-01-01 00:00:00'
-   _calendar      = 'standard'
-
    if filename == None:
       print("\n WRITE_DATA_XARRAY:  No output file name is given, writing to %s" % "obs_seq.txt")
       filename = "obs_seq.nc"
@@ -830,9 +923,6 @@ def write_obs_seq_xarray(field, filename=None, obs_error=3., volume_name=None):
       basename = "%s_%s.nc" % ("obs_seq", os.path.basename(filename))
       filename =  os.path.join(dirname, basename)
 
-   _stringlen     = 8
-   _datelen       = 19
-
 # Extract data.city data
 
    fld           = field.data.data[:,:,:]
@@ -842,91 +932,48 @@ def write_obs_seq_xarray(field, filename=None, obs_error=3., volume_name=None):
    xgrid         = field.xg[:]
    ygrid         = field.yg[:]
    zgrid         = field.zg[:,:,:]
-   msl_hgt       = field.zg[:,:,:] + field.radar_hgt
 
-   platform_lat  = field.radar_lat
-   platform_lon  = field.radar_lon
-   platform_hgt  = field.radar_hgt
+# Use the volume mean time for the time of the volume, DART time stamps are retained
 
-# Use the volume mean time for the time of the volume
-
-   utime   = ncdf.num2date(field.time['data'].mean(), field.time['units'])
-   secs    = ncdf.date2num(utime, units = _time_units)
-# Retain DART time stamps
-   days    = ncdf.date2num(utime, units = "days since 1601-01-01 00:00:00")
-   seconds = np.int(86400.*(days - np.floor(days)))
+   utime                = ncdf.num2date(field.time['data'].mean(), field.time['units'])
+   secs, days, seconds  = obs_time(utime)
 
    print("\n -->  Writing %s as the radar file..." % (filename))
-#  mask_check = data.mask && numpy.isnan().any()
 
    nobs = np.sum(mask==False)
    print("\n -----> Number of good observations for xarray:  %d" % nobs)
 
-   # Create numpy rec array that can be converted to a pandas table.
-
-   out, attributes = obs_seq_xarray(nobs)
-
-   # There is a far better way to do this but this is fast enough for now...
-
-   n = 0
-
-   for k in np.arange(fld.shape[0]):
-      for j in np.arange(fld.shape[1]):
-         for i in np.arange(fld.shape[2]):
-
-            if mask[k,j,i] == False:
-
-               dx    = xgrid[i]
-               dy    = ygrid[j]
-               dz    = zgrid[k,j,i]
-               range = np.sqrt(dx**2 + dy**2 + dz**2)
-               dir1  = dx / range
-               dir2  = dy / range
-               dir3  = dz / range
-
-               out.value[n]              = fld[k,j,i]
-               out.error_var[n]          = obs_error**2
-               out.lon[n]                = lons[i]
-               out.lat[n]                = lats[j]
-               out.height[n]             = msl_hgt[k,j,i]
-               out.date[n]               = utime
-               out.utime[n]              = secs
-               out.day[n]                = days
-               out.second[n]             = seconds
-               out.platform_lon[n]       = platform_lon
-               out.platform_lat[n]       = platform_lat
-               out.platform_hgt[n]       = platform_hgt
-               out.platform_dir1[n]      = dir1
-               out.platform_dir2[n]      = dir2
-               out.platform_dir3[n]      = dir3
-               out.platform_nyquist[n]   = field.nyquist[k]
-
-               n = n + 1
-  
-   # Create an xarray dataset for file I/O
-   xa = xr.Dataset(pd.DataFrame.from_records(out))
+   # The obs in the (k,j,i) order of the grid, each column is written as it is computed
 
-#  # reset index to be a master index across all obs
-   xa = xa.rename({'dim_0': 'index'})
+   kk, jj, ii = np.nonzero(mask == False)
 
-   # Write the xarray file out (this is all there is, very nice guys!)
-   xa.to_netcdf(filename, mode='w')
-   xa.close()
+   dz    = np.ma.getdata(zgrid)[kk,jj,ii]
 
-   # Add attributes to the files
+   def columns():
+       dis = np.sqrt(xgrid[ii]**2 + ygrid[jj]**2 + dz**2)
+       yield 'value',            fld[kk,jj,ii]
+       yield 'lat',              lats[jj]
+       yield 'lon',              lons[ii]
+       yield 'height',           dz + field.radar_hgt
+       yield 'error_var',        np.full((nobs,), obs_error**2, dtype=np.float32)
+       yield 'platform_dir1',    xgrid[ii] / dis
+       yield 'platform_dir2',    ygrid[jj] / dis
+       yield 'platform_dir3',    dz / dis
+       yield 'platform_nyquist', np.asarray(field.nyquist, dtype=np.float64)[kk]
 
-   fnc = ncdf.Dataset(filename, mode = 'a')
-   fnc.history = "Created " + DT.datetime.today().strftime("%Y%m%d_%H%M")
-   fnc.version = "Version 1.0a by Lou Wicker and Thomas Jones (NSSL)"
-   if volume_name != None:
-       fnc.version = "Created from the WSR88D radar volume:  %s" % volume_name
+   constants = {'utime':        secs,
+                'day':          days,
+                'second':       seconds,
+                'platform_lat': field.radar_lat,
+                'platform_lon': field.radar_lon,
+                'platform_hgt': field.radar_hgt}
 
-   for key in list(attributes.keys()):
-       fnc.variables[key].units = attributes[key][0]
-       fnc.variables[key].description = attributes[key][1]
+   if volume_name != None:
+       version = "Created from the WSR88D radar volume:  %s" % volume_name
+   else:
+       version = None
 
-   fnc.sync()
-   fnc.close()
+   write_obs_seq_netcdf(filename, nobs, columns(), constants, date=utime, version=version)
 
 #######################################################################
 def clock_string():
@@ -938,7 +985,11 @@ def clock_string():
                                          local_time.tm_min)
 
 
-def processVolume(volume, unfold_type, options, cLatLon, sweep_num, out_filename, fname):
+def analyzeVolume(volume, unfold_type, options, cLatLon):
+    """
+        QC the volume, unfold the velocities, grid and mask reflectivity and radial velocity.
+        Returns the (ref, vel) Gridded_Field objects.
+    """
     # Modern level-II files need to be mapped to figure out where the super-res velocity and reflectivity fields are located in file
 
     ret = volume_mapping(volume)
@@ -985,11 +1036,13 @@ def processVolume(volume, unfold_type, options, cLatLon, sweep_num, out_filename
 
     # Now grid the reflectivity (embedded call) and then mask it off based on parameters set at top
 
-    ref = dbz_masking(grid_data(volume, "reflectivity", LatLon=cLatLon), thin_zeros=_grid_dict['thin_zeros'])
+    grids = grid_fields(volume, ["reflectivity", vr_field], LatLon=cLatLon)
+
+    ref = dbz_masking(grids["reflectivity"], thin_zeros=_grid_dict['thin_zeros'])
 
-    # Finally, regrid the radial velocity
+    # Finally, the regridded radial velocity
 
-    vel = grid_data(volume, vr_field, LatLon=cLatLon)
+    vel = grids[vr_field]
     
     # Mask it off based on dictionary parameters set at top
 
@@ -1002,6 +1055,13 @@ def processVolume(volume, unfold_type, options, cLatLon, sweep_num, out_filename
     
     print('\n ================================================================================')
 
+    return ref, vel
+
+
+def processVolume(volume, unfold_type, options, cLatLon, sweep_num, out_filename, fname):
+
+    ref, vel = analyzeVolume(volume, unfold_type, options, cLatLon)
+
     if options.write == True:      
         print('\n WRITING XARRAY: {}\n'.format(out_filename))
         ret = write_obs_seq_xarray(vel, filename=out_filename, obs_error= _obs_errors['velocity'], \
@@ -1009,12 +1069,13 @@ def processVolume(volume, unfold_type, options, cLatLon, sweep_num, out_filename
 
         print('\n WRITING DART: {}\n'.format(out_filename))
         ret = opaws_write_DART_ascii(vel, filename=out_filename, grid_dict=_grid_dict, \
-                                obs_error=[_obs_errors['velocity']] )
+                                obs_error=[_obs_errors['velocity']], dart_format=_grid_dict['dart_format'] )
 
         if options.onlyVR != True:
             print('\n WRITING DART ONLY VR: {}\n'.format(out_filename))
             ret = opaws_write_DART_ascii(ref, filename=out_filename+"_RF", grid_dict=_grid_dict, \
-                                obs_error=[_obs_errors['reflectivity'], _obs_errors['0reflectivity']])
+                                obs_error=[_obs_errors['reflectivity'], _obs_errors['0reflectivity']], \
+                                dart_format=_grid_dict['dart_format'])
         
     if len(sweep_num) > 0:
         fplotname = os.path.basename(out_filename)
@@ -1023,7 +1084,12 @@ def processVolume(volume, unfold_type, options, cLatLon, sweep_num, out_filename
                         shapefiles=options.shapefiles, interactive=options.interactive, LatLon=cLatLon)
 
 
-def processVolumes(radar, run_time, options):
+def configure(options):
+    """
+        Sets the gridding parameters from the run options.
+        Returns (unfold_type, cLatLon, sweep_num)
+    """
+
     if options.unfold == "phase":
         print("\n opaws2D dealias_unwrap_phase unfolding will be used\n")
         unfold_type = "phase"
@@ -1051,6 +1117,16 @@ def processVolumes(radar, run_time, options):
     if options.roi:
         _grid_dict['ROI'] = options.roi
 
+    if getattr(options, 'weight_cache', None):
+        _grid_dict['weight_cache_dir'] = options.weight_cache
+        _grid_dict['grid_cache_dir']   = options.weight_cache
+
+    if getattr(options, 'nprocs', None):
+        _grid_dict['nprocs'] = options.nprocs
+
+    if getattr(options, 'dart_format', None):
+        _grid_dict['dart_format'] = options.dart_format
+
     if options.plot == 0:
         sweep_num = []
     elif options.plot > 0:
@@ -1062,6 +1138,65 @@ def processVolumes(radar, run_time, options):
         if not os.path.exists("images"):
             os.mkdir("images")
 
+    return unfold_type, cLatLon, sweep_num
+
+########################################################################
+
+def find_closest_file(dname, analysis_time):
+    """
+        Returns the level-II file in the radar directory dname closest to analysis_time,
+        searching the hours spanned by _window_param, or None if there is none.
+    """
+
+    start_time = analysis_time + DT.timedelta(minutes=_window_param[0])
+    stop_time  = analysis_time + DT.timedelta(minutes=_window_param[1])
+
+    catalog    = get_catalog(dname, 'nexrad' if _AWS_L2Files else 'nexrad_ldm')
+
+    return catalog.closest(analysis_time, start=start_time.replace(minute=0, second=0, microsecond=0), \
+                           stop=stop_time.replace(minute=0, second=0, microsecond=0) + DT.timedelta(hours=1))
+
+########################################################################
+
+def read_volume(fname):
+    """
+        Reads a level-II or cfradial file, returns None if the file is too small or cannot be read
+    """
+
+    # the check for file size is to make sure there is data in the LVL2 file
+    try:
+        if os.path.getsize(fname) < 2048000:
+            print('\n File {} is less than 2 mb, skipping...'.format(fname))
+            return None
+    except:
+        return None
+
+    print('\n READING: {}\n'.format(fname))
+
+    if fname[-3:] == ".nc":
+        if _radar_parameters['field_label_trans'][0] == True:
+            REF_LABEL = _radar_parameters['field_label_trans'][1]
+            VEL_LABEL = _radar_parameters['field_label_trans'][2]
+            volume = pyart.io.read_cfradial(fname, field_names={REF_LABEL:"reflectivity", VEL_LABEL:"velocity"})
+        else:
+            volume = pyart.io.read_cfradial(fname)
+    else:
+        try:
+            volume = pyart.io.read_nexrad_archive(fname, field_names=None, 
+                                                    additional_metadata=None, file_field_names=False, 
+                                                    delay_field_loading=False, 
+                                                    station=None, scans=None, linear_interp=True)
+        except:
+            print('\n File {} cannot be read, skipping...\n'.format(fname))
+            return None
+
+    return volume
+
+########################################################################
+
+def processVolumes(radar, run_time, options):
+    unfold_type, cLatLon, sweep_num = configure(options)
+
     # Read input file and create radar object
 
     t0 = timeit.time()
@@ -1111,22 +1246,20 @@ def run(options):
             start_time = DT.datetime.strptime(options.window, "%Y,%m,%d,%H,%M") + DT.timedelta(minutes=_window_param[0])
             stop_time  = DT.datetime.strptime(options.window, "%Y,%m,%d,%H,%M") + DT.timedelta(minutes=_window_param[1])
 
-            if _AWS_L2Files:
-                in_filenames = glob.glob(_AWS_L2Name_Style % (os.path.abspath(options.dname),start_time.strftime("%Y%m%d_%H"))) \
-                            + glob.glob(_AWS_L2Name_Style % (os.path.abspath(options.dname),stop_time.strftime("%Y%m%d_%H")))
-            else:
-                in_filenames = glob.glob(_LDM_L2Name_Style % (os.path.abspath(options.dname),start_time.strftime("%Y%m%d_%H"))) \
-                            + glob.glob(_LDM_L2Name_Style % (os.path.abspath(options.dname),stop_time.strftime("%Y%m%d_%H")))
+            print("\n WINDOW IS SUPPLIED, WILL LOOK FOR AN INDIVIDUAL FILE.... \n ")
+            print("\n WINDOW_START:  %s" % start_time.strftime("%Y,%m,%d,%H,%M") )
+            print(" WINDOW_END:    %s, will search the radar catalog for the closest time " \
+                    % stop_time.strftime("%Y,%m,%d,%H,%M") )
 
-            if len(in_filenames) == 0:
+            closest = find_closest_file(options.dname, ttime)
+
+            if closest is None:
                 print("\n COULD NOT find any files for radar %s between %s and %s, EXITING" \
                         % (os.path.abspath(options.dname),start_time.strftime("%Y%m%d_%H"),stop_time.strftime("%Y%m%d_%H")))
                 sys.exit(0)
             else:
-                print("\n WINDOW IS SUPPLIED, WILL LOOK FOR AN INDIVIDUAL FILE.... \n ")
-                print("\n WINDOW_START:  %s" % start_time.strftime("%Y,%m,%d,%H,%M") )
-                print(" WINDOW_END:    %s, will search %d files for closest time " \
-                        % (stop_time.strftime("%Y,%m,%d,%H,%M"), len(in_filenames)) )
+                in_filenames = [closest]
+                print("\n FOUND CLOSEST FILE:   %s" % in_filenames[0] )
         else:
             in_filenames = glob.glob("%s/*" % os.path.abspath(options.dname))
             if len(in_filenames) == 0:
@@ -1160,95 +1293,20 @@ def run(options):
                     strng = os.path.join(options.out_dir, strng)
                     out_filenames.append(strng)
 
-    if options.unfold == "phase":
-        print("\n opaws2D dealias_unwrap_phase unfolding will be used\n")
-        unfold_type = "phase"
-    elif options.unfold == "region":
-        print("\n opaws2D dealias_region_based unfolding will be used\n")
-        unfold_type = "region"
-    else:
-        print("\n ***** INVALID OR NO VELOCITY DEALIASING METHOD SPECIFIED *****")
-        print("\n          NO VELOCITY UNFOLDING DONE...\n\n")
-        unfold_type = None
-
-    if options.newse:
-        print(" \n now processing NEWSe radar file....\n ")
-        cLatLon = parse_NEWSe_radar_file(options.newse, getLatLon=True)
-    else:
-        cLatLon = None
-
-    if options.method:
-        _grid_dict['anal_method'] = options.method
-
-    if options.dx:
-        _grid_dict['grid_spacing_xy'] = options.dx
-        _grid_dict['ROI'] = options.dx / 0.707
-        
-    if options.roi:
-        _grid_dict['ROI'] = options.roi
-
-    if options.plot == 0:
-        sweep_num = []
-    elif options.plot > 0:
-        sweep_num = [options.plot]
-        if not os.path.exists("images"):
-            os.mkdir("images")
-    else:
-        sweep_num = _plevels
-        if not os.path.exists("images"):
-            os.mkdir("images")
+    unfold_type, cLatLon, sweep_num = configure(options)
 
     # Read input file and create radar object
 
     t0 = timeit.time()
 
-    # Preprocessing to find closest file....
-
-    if options.window:
-        try:
-            analysisT     = DT.datetime.strptime(options.window, "%Y,%m,%d,%H,%M")
-            xfiles        = [os.path.basename(f) for f in in_filenames]
-            if _AWS_L2Files:
-                xfiles_DT     = [DT.datetime.strptime("%s" % f[4:19], "%Y%m%d_%H%M%S") for f in xfiles]
-            else:
-                xfiles_DT     = [DT.datetime.strptime("%s" % f[5:20], "%Y%m%d_%H%M%S") for f in xfiles]
-            in_filenames  = [in_filenames[xfiles_DT.index(min(xfiles_DT, key=lambda d:  abs(d - analysisT)))]]
-            out_filenames = [out_filenames[xfiles_DT.index(min(xfiles_DT, key=lambda d:  abs(d - analysisT)))]]
-            print("\n FOUND CLOSEST FILE:   %s" % in_filenames[0] )
-        except:
-            print("\n COULD NOT FILE CLOSEST FILE, exiting: %s <----> %s" % (in_filenames[0], in_filenames[-1]) )
-            sys.exit(0)
-
     for n, fname in enumerate(in_filenames):
 
-        # the check for file size is to make sure there is data in the LVL2 file
-        try:
-            if os.path.getsize(fname) < 2048000:
-                print('\n File {} is less than 2 mb, skipping...'.format(fname))
-                continue
-        except:
-            continue
-
         tim0 = timeit.time() 
 
-        print('\n READING: {}\n'.format(fname))
+        volume = read_volume(fname)
 
-        if fname[-3:] == ".nc":
-            if _radar_parameters['field_label_trans'][0] == True:
-                REF_LABEL = _radar_parameters['field_label_trans'][1]
-                VEL_LABEL = _radar_parameters['field_label_trans'][2]
-                volume = pyart.io.read_cfradial(fname, field_names={REF_LABEL:"reflectivity", VEL_LABEL:"velocity"})
-            else:
-                volume = pyart.io.read_cfradial(fname)
-        else:
-            try:
-                volume = pyart.io.read_nexrad_archive(fname, field_names=None, 
-                                                        additional_metadata=None, file_field_names=False, 
-                                                        delay_field_loading=False, 
-                                                        station=None, scans=None, linear_interp=True)
-            except:
-                print('\n File {} cannot be read, skipping...\n'.format(fname))
-                continue
+        if volume is None:
+            continue
 
         opaws2D_io_cpu = timeit.time() - tim0
 
@@ -1286,7 +1344,7 @@ if __name__ == "__main__":
            help = "Boolean flag to only write VR to DART ascii file", action="store_true")
                      
    parser.add_option(     "--method",     dest="method",   default=None, type="string", \
-           help = "Function to use for the weight process, valid strings are:  Cressman or Barnes")
+           help = "Function to use for the weight process, valid strings are:  Cressman, Barnes, Cressman-binned or Barnes-binned")
           
    parser.add_option("-q", "--qc", dest="qc", default="Minimal",  type="string",     \
            help = "Type of QC corrections on reflectivity or velocity.  Valid:  None, Minimal, MetSignal, A1")  
@@ -1297,6 +1355,15 @@ if __name__ == "__main__":
    parser.add_option(     "--roi",     dest="roi",   default=None, type="float", \
            help = "Radius of influence in meters for superob regrid")
 
+   parser.add_option(     "--weight_cache", dest="weight_cache", default=None, type="string", \
+           help = "Directory to cache the grid geometry (and the superob weights if _grid_dict weight_cache is on) in between runs")
+
+   parser.add_option(     "--nprocs",   dest="nprocs",   default=None, type="int", \
+           help = "Number of processes used to grid the sweeps")
+
+   parser.add_option(     "--dart_format", dest="dart_format", default=None, type="string", \
+           help = "Format of the DART obs_seq files:  ascii (default) or binary")
+
    parser.add_option("-p", "--plot",      dest="plot",      default=0,  type="int",      \
            help = "Specify a number between 0 and # elevations to plot ref and vr in that co-plane")
                      
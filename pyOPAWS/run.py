@@ -2,8 +2,9 @@ import types, os
 import datetime as DT
 from optparse import OptionParser
 from Config import settings
-from utils.radar import getFromFile
+from utils.radar import getFromFile, getLatLonFromFile
 from pyOPAWS.opaws2d import run 
+from pyOPAWS.mosaic import run as run_mosaic
 
 def main(start_time, radarIndex):
     radars = getFromFile(start_time)
@@ -21,6 +22,9 @@ def main(start_time, radarIndex):
     obj.plot = int(settings.opaws_plot)
     obj.dx = float(settings.opaws_dx)
     obj.roi = float(settings.opaws_roi)
+    obj.weight_cache = settings.opaws_weight_cache
+    obj.nprocs   = int(os.environ.get('SLURM_CPUS_PER_TASK', 1))
+    obj.dart_format = settings.opaws_dart_format
     obj.qc = settings.opaws_qc
     obj.unfold = settings.opaws_unfold
     obj.newse = None
@@ -29,6 +33,34 @@ def main(start_time, radarIndex):
     obj.interactive = None
     run(obj)
 
+def main_mosaic(start_time):
+    radars = getFromFile(start_time)
+
+    print('Mosaic of %d radars: %s' % (len(radars), ' '.join(radars)))
+
+    obj = types.SimpleNamespace()
+    obj.feed = settings.opaws_feed
+    obj.radars = radars
+    obj.LatLon = getLatLonFromFile(start_time)
+    obj.out_dir = settings.opaws_obs_seq
+    obj.write = settings.opaws_write
+    obj.window = start_time.strftime("%Y,%m,%d,%H,%M")
+    obj.onlyVR = settings.opaws_onlyvr
+    obj.superob_ref = settings.opaws_superob_ref
+    obj.plot = int(settings.opaws_plot)
+    obj.dx = float(settings.opaws_dx)
+    obj.roi = float(settings.opaws_roi)
+    obj.weight_cache = settings.opaws_weight_cache
+    obj.nprocs   = int(os.environ.get('SLURM_CPUS_PER_TASK', 1))
+    obj.dart_format = settings.opaws_dart_format
+    obj.qc = settings.opaws_qc
+    obj.unfold = settings.opaws_unfold
+    obj.newse = None
+    obj.method = None
+    obj.shapefiles = None
+    obj.interactive = None
+    run_mosaic(obj)
+
 if __name__ == "__main__":
     parser = OptionParser()
 
@@ -38,5 +70,11 @@ if __name__ == "__main__":
     parser.add_option("--radarIndex",    dest="radarIndex",    type="int", default=None,  \
                                 help = "Radar")                                   
 
+    parser.add_option("--mosaic",    dest="mosaic",    default=False, action="store_true", \
+                                help = "Process all the radars onto the common grid in one job")
+
     (options, args) = parser.parse_args()
-    main(DT.datetime.strptime(options.cycle, "%Y%m%d%H%M"), options.radarIndex)
\ No newline at end of file
+    if options.mosaic:
+        main_mosaic(DT.datetime.strptime(options.cycle, "%Y%m%d%H%M"))
+    else:
+        main(DT.datetime.strptime(options.cycle, "%Y%m%d%H%M"), options.radarIndex)
\ No newline at end of file
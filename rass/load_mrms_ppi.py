@@ -1,5 +1,7 @@
 import netCDF4 as ncdf
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import pyart
 import numpy as np
 import matplotlib.pyplot as plt
@@ -9,7 +11,9 @@ import datetime
 from pyart.config import FileMetadata
 from pyart.config import get_metadata, get_fillvalue
 from pyart.core.radar import Radar
+from pyart.core.transforms import antenna_vectors_to_cartesian
 from Config import settings
+from utils.catalog import get_catalog
 
 def __get_radar_time_path__(radar, run_time): return os.path.join(settings.rass_input, run_time.strftime("%Y%m%d"), radar)
 
@@ -21,175 +25,282 @@ def __get_path_velocity__(radar, run_time): return os.path.join(__get_radar_time
 
 def __get_path_velocity_tilt__(radar, run_time, tilt): return os.path.join(__get_path_velocity__(radar, run_time), tilt)
 
-def load_mrms_ppi(fdict, **kwargs):
+# The tilts are read by a pool of threads:  each thread reads its file into memory (so the file
+# system waits of the tilts overlap) and decodes it under _netcdf_lock (the netCDF/HDF5 libraries
+# are not thread safe).  _max_gates is the maximum number of gates we ever need.
+
+_load_threads = 8
+_max_gates    = 1192
+_netcdf_lock  = threading.Lock()
+
+def read_mrms_file(d):
+    """
+    Read the variables of d (an entry of the fdict of load_mrms_ppi) from an MRMS radar netCDF file.
+    The file is opened once and only the first _max_gates-1 gates of the 2D variables are read.
+
+    Returns a dict with the dimensions, global attributes, azimuths, gate width and the (masked)
+    variables of the file.
+    """
+
+    try:
+        with open(d['file'], 'rb') as f:
+            buffer = f.read()
+    except IOError:
+        print('LOAD_PPI cannot open netCDF file: ', d['file'])
+        raise
+
+    with _netcdf_lock:
+
+        ncfile  = ncdf.Dataset(d['file'], memory=buffer)
+
+        try:
+            n_gates = len(ncfile.dimensions['Gate'])
+            attrs   = dict([(a, ncfile.getncattr(a)) for a in ncfile.ncattrs()])
+            content = {'n_gates':   n_gates,
+                       'n_rays':    len(ncfile.dimensions['Azimuth']),
+                       'attrs':     attrs,
+                       'azimuth':   np.array(ncfile.variables['Azimuth'][:]),
+                       'gatewidth': ncfile.variables['GateWidth'][0],
+                       'variables': {}}
+
+            for varset in d['variables']:
+                ncvar = varset['ncvar']
+                if len(ncfile.variables[ncvar].shape) == 2:
+                    data = np.ma.array(ncfile.variables[ncvar][:,0:min(n_gates, _max_gates)-1])
+                else:
+                    data = np.ma.array(ncfile.variables[ncvar][:])
+
+                if 'MissingData' in attrs:
+                    data[data == attrs['MissingData']] = np.ma.masked
+                if 'RangeFolded' in attrs:
+                    data[data == attrs['RangeFolded']] = np.ma.masked
+
+                content['variables'][ncvar] = data
+        finally:
+            ncfile.close()  # important to do this.
+
+    return content
+
+class Tilt(object):
+    """
+    One tilt (sweep) of MRMS radar data, the fields of the velocity and reflectivity files of the tilt.
+
+    The fields are float32 masked arrays (rays x gates) keyed by their pyART name, azimuth and
+    elevation are per ray, gate_range per gate (m) and nyquist per ray (or None).  The tilt has the
+    part of the pyART Radar interface used to grid a sweep (get_field, get_gate_x_y_z, ...) for
+    sweep 0, the gate x/y/z are computed when first asked for.  to_pyart() builds the pyART Radar.
     """
-    Read multiple field sweeps from an MRMS radar file NetCDF file.
+
+    __slots__ = ('fields', 'units', 'azimuth', 'elevation', 'gate_range', 'time', 'nyquist',
+                 'lat', 'lon', 'hgt', 'metadata', '_xyz')
+
+    def __init__(self, fields, units, azimuth, elevation, gate_range, time, nyquist, lat, lon, hgt, metadata):
+
+        self.fields     = fields
+        self.units      = units
+        self.azimuth    = azimuth
+        self.elevation  = elevation
+        self.gate_range = gate_range
+        self.time       = time
+        self.nyquist    = nyquist
+        self.lat        = lat
+        self.lon        = lon
+        self.hgt        = hgt
+        self.metadata   = metadata
+        self._xyz       = None
+
+    # pyART style attributes
+
+    @property
+    def range(self):        return {'data': self.gate_range}
+
+    @property
+    def latitude(self):     return {'data': np.array([self.lat], 'float64')}
+
+    @property
+    def longitude(self):    return {'data': np.array([self.lon], 'float64')}
+
+    @property
+    def altitude(self):     return {'data': np.array([self.hgt], 'float64')}
+
+    @property
+    def fixed_angle(self):  return {'data': self.elevation[:1]}
+
+    # pyART style methods, the tilt is sweep 0
+
+    def get_start_end(self, sweep):
+
+        return 0, self.azimuth.size - 1
+
+    def get_field(self, sweep, field_name):
+
+        return self.fields[field_name]
+
+    def get_azimuth(self, sweep):
+
+        return self.azimuth
+
+    def get_elevation(self, sweep):
+
+        return self.elevation
+
+    def get_nyquist_vel(self, sweep):
+
+        if self.nyquist is None:
+            raise LookupError('nyquist_velocity is not available for this tilt')
+
+        return float(self.nyquist[0])
+
+    def get_gate_x_y_z(self, sweep, edges=False):
+
+        if edges:
+            return antenna_vectors_to_cartesian(self.gate_range, self.azimuth, self.elevation, edges=True)
+
+        if self._xyz is None:
+            self._xyz = antenna_vectors_to_cartesian(self.gate_range, self.azimuth, self.elevation)
+
+        return self._xyz
+
+    def to_pyart(self):
+        """
+        Returns the tilt as a (one sweep) pyART Radar, with the gate lat/lon/altitude initialized.
+        """
+
+        filemetadata = FileMetadata('cfradial')
+
+        _latitude              = filemetadata('latitude')
+        _longitude             = filemetadata('longitude')
+        _altitude              = filemetadata('altitude')
+        _metadata              = filemetadata('metadata')
+        _sweep_start_ray_index = filemetadata('sweep_start_ray_index')
+        _sweep_end_ray_index   = filemetadata('sweep_end_ray_index')
+        _sweep_number          = filemetadata('sweep_number')
+        _sweep_mode            = filemetadata('sweep_mode')
+        _fixed_angle           = filemetadata('fixed_angle')
+        _time                  = filemetadata('time')
+        _elevation             = filemetadata('elevation')
+        _azimuth               = filemetadata('azimuth')
+        _range                 = filemetadata('range')
+
+        _time.update(self.time)
+        _latitude['data']              = self.latitude['data']
+        _longitude['data']             = self.longitude['data']
+        _altitude['data']              = self.altitude['data']
+        _range['data']                 = self.gate_range
+        _sweep_mode['data']            = np.array(['ppi'])
+        _azimuth['data']               = self.azimuth
+        _fixed_angle['data']           = self.fixed_angle['data']
+        _elevation['data']             = self.elevation
+        _sweep_number['data']          = np.arange(1, dtype='int32')
+        _sweep_start_ray_index['data'] = np.array([0], dtype='int32')
+        _sweep_end_ray_index['data']   = np.array([self.azimuth.size - 1], dtype='int32')
+        _metadata.update(self.metadata)
+
+        _fields = {}
+        for pvar, data in self.fields.items():
+            _fields[pvar] = get_metadata(pvar)
+            _fields[pvar]['data']  = data
+            _fields[pvar]['units'] = self.units[pvar]
+
+        _instr_params = None
+        if self.nyquist is not None:
+            _instr_params = {'nyquist_velocity': get_metadata('nyquist_velocity')}
+            _instr_params['nyquist_velocity']['data']  = self.nyquist
+            _instr_params['nyquist_velocity']['units'] = self.units['nyquist_velocity']
+
+        radar = Radar( _time, _range, _fields, _metadata, 'other',                  \
+                       _latitude, _longitude, _altitude,                            \
+                       _sweep_number, _sweep_mode, _fixed_angle, _sweep_start_ray_index, \
+                       _sweep_end_ray_index,                                        \
+                       _azimuth, _elevation, instrument_parameters=_instr_params)
+
+        radar.init_gate_altitude()
+        radar.init_gate_longitude_latitude()
+
+        return radar
+
+def load_mrms_tilt(fdict, contents=None):
+    """
+    Read the field sweeps of one tilt from MRMS radar NetCDF files.
     
     Input parameters
     ----------------
-    fdict : (list)  --> list of dicts [{file: file1, ncvar: "Reflectivity", pvar: "reflecitity"},
-                                       {file: file2, ncvar: "Velocity",     pvar: "corrected_velocity"}]
+    fdict : (list)  --> list of dicts [{file: file1, variables: [{ncvar: "Velocity", pvar: "velocity"}, ...]},
+                                       {file: file2, variables: [{ncvar: "ReflectivityQC", pvar: "reflectivity"}]}]
                
-       filename : (str) --> name of netCDF MRMS file to read from
+       file :     (str) --> name of netCDF MRMS file to read from
        ncvar :    (str) --> name of variable to read from that file
        pvar :     (str) --> mapped name of ncvar into pyART
+
+    contents : (list) --> read_mrms_file of each entry of fdict, if the files have been read already
     
     Returns
     -------
-    radar : Radar  --> pyArt radar object
-    
-    TODO:  For a given set of tilts, all the tilts will be set to the smallest number of gates in the
-           tilts.  The data structure is not quite correct.
+    tilt : Tilt
 
+    The fields are set to the smallest number of gates of the files, the time, location and azimuths
+    are those of the first file.
     """
-    
-    _debug = 0
 
-    # Loop over files to find the dimensions of the data.
-    
-    n_gates = [1192]  # choose this to be the maximum number of gates we ever need.
-    n_rays  = []
-    n_elev  = []
-    gates   = []
-    
-    for n, d in enumerate(fdict):
-        
-        try:
-            ncfile = ncdf.Dataset(d['file'])
-        except IOError:
-            print('LOAD_PPI cannot open netCDF file: ', d['file'])
-            break
-            
-        n_gates.append(len(ncfile.dimensions['Gate']))
-        n_rays.append(len(ncfile.dimensions['Azimuth']))
-        n_elev.append(ncfile.Elevation)
-                
-        ncfile.close()  # important to do this.
-        
-    _mygate = min(n_gates)
-
-    if _debug > 0:
-        print(n_gates)
-        print('LOAD_PPI --> Number of files to read: %d' % len(fdict))
-        print('LOAD_PPI --> _mygate: %d' % _mygate)
-        
-    # if we get this far, go ahead get to creating the radar object
-    
-    # this does not do anything yet except uses the object to create other objects
-    # the default configuration is cfradial - for later.
-    
-    filemetadata = FileMetadata('cfradial')  
+    # Each file is opened once, the dimensions of the data are those of the files read.
 
-    # create all the objects needed below
-    
-    _latitude              = filemetadata('latitude')
-    _longitude             = filemetadata('longitude')
-    _altitude              = filemetadata('altitude')
-    _metadata              = filemetadata('metadata')
-    _sweep_start_ray_index = filemetadata('sweep_start_ray_index')
-    _sweep_end_ray_index   = filemetadata('sweep_end_ray_index')
-    _sweep_number          = filemetadata('sweep_number')
-    
-    _sweep_mode            = filemetadata('sweep_mode')
-    _fixed_angle           = filemetadata('fixed_angle')
-    _time                  = filemetadata('time')
-    _elevation             = filemetadata('elevation')
-    _azimuth               = filemetadata('azimuth')
-    _range                 = filemetadata('range')
-    
-    _scan_type             = 'other'
+    if contents is None:
+        contents = [read_mrms_file(d) for d in fdict]
 
-    _fields                = {}  # dict to hold data
+    _mygate = min([_max_gates] + [c['n_gates'] for c in contents])
 
-    _instr_params = None
+    attrs   = contents[0]['attrs']
 
-    # loop through files..
+    start_time = datetime.datetime.utcfromtimestamp(attrs['Time'])
+    time       = {'data':  np.array([attrs['FractionalTime']]),
+                  'units': make_time_unit_str(start_time)}
 
-    for n, d in enumerate(fdict):
+    gate_range = attrs['RangeToFirstGate'] + contents[0]['gatewidth'] * (np.arange(_mygate-1) + 0.5)
+    azimuth    = contents[0]['azimuth']
+    elevation  = np.full(azimuth.shape, attrs['Elevation'])
 
-        ncfile                     = ncdf.Dataset(d['file'])                      
-        gwidth                     = ncfile.variables['GateWidth'][:].mean()        
+    # copy meta data once
 
-        if n == 0:  # do these things once
-            
-            start_time                     = datetime.datetime.utcfromtimestamp(ncfile.Time)
-            _time['data']                  = np.array([ncfile.FractionalTime][:])
-            _time['units']                 = make_time_unit_str(start_time)
+    metadata_mapping = {
+                        'vcp-value': 'vcp-value',
+                        'radarName-value': 'instrument_name',
+                        }
 
-            _latitude['data']              = ncfile.Latitude
-            _longitude['data']             = ncfile.Longitude
-            _altitude['data']              = np.array([ncfile.Height], 'float64')
-            
-            _range['data']                 = ncfile.RangeToFirstGate + ncfile.variables['GateWidth'][0] \
-                                           * (np.arange(_mygate-1) + 0.5)
-            _sweep_mode['data']            = np.array(['ppi'])
-            _azimuth['data']               = np.array(ncfile.variables['Azimuth'][:])
-            _fixed_angle['data']           = np.array(n_elev)
-            _elevation['data']             = np.array(n_rays[n]*[n_elev[n]])
+    metadata = {}
+    for netcdf_attr, metadata_key in metadata_mapping.items():
+        if netcdf_attr in attrs:
+            print(metadata_key, attrs[netcdf_attr])
+            metadata[metadata_key] = attrs[netcdf_attr]
 
-            _sweep_number['data']          = np.arange(len(fdict), dtype='int32')
-            _sweep_start_ray_index['data'] = np.cumsum(np.append([0], n_rays[:-1]).astype('int32'))
-            _sweep_end_ray_index['data']   = np.cumsum(n_rays).astype('int32') - 1
+    # the 2D variables were read for at most _max_gates-1 gates
 
-            # copy meta data once
+    fields  = {}
+    units   = {}
+    nyquist = None
 
-            metadata_mapping = {
-                                'vcp-value': 'vcp-value',
-                                'radarName-value': 'instrument_name',
-                                }
-
-            for netcdf_attr, metadata_key in metadata_mapping.items():
-                if netcdf_attr in ncfile.ncattrs():
-                    print(metadata_key, ncfile.getncattr(netcdf_attr))
-                    _metadata[metadata_key] = ncfile.getncattr(netcdf_attr)
-  
-        # Okay do the big stuff.
+    for d, content in zip(fdict, contents):
         for varset in d['variables']:
-            pvar                       = varset['pvar']
-            ncvar                      = varset['ncvar']
-            _dict         = get_metadata(pvar)
-
-            if len(ncfile.variables[ncvar].shape) == 2:
-                _dict['data'] = np.ma.array(ncfile.variables[ncvar][:,0:_mygate-1])
-            else: 
-                _dict['data'] = np.ma.array(ncfile.variables[ncvar][:])
-                
-            sw = ncfile.variables 
-
-            if 'MissingData' in ncfile.ncattrs():
-                _dict['data'][_dict['data'] == ncfile.MissingData] = np.ma.masked
-            if 'RangeFolded' in ncfile.ncattrs():
-                _dict['data'][_dict['data'] == ncfile.RangeFolded] = np.ma.masked
-                
-            _dict['units'] = ncfile.getncattr('Unit-value')
-
-            if _debug > 299:
-                print(ncfile.variables[ncvar][:,0:_mygate-1].shape)
-                print(_dict['data'].shape)
+            pvar = varset['pvar']
+            data = content['variables'][varset['ncvar']]
+
+            units[pvar] = content['attrs']['Unit-value']
 
             if pvar == 'nyquist_velocity':
-                _instr_params = {'nyquist_velocity': _dict}
+                nyquist = np.asarray(data, dtype=np.float32)
+            elif data.ndim == 2:
+                fields[pvar] = np.ma.array(data[:,0:_mygate-1], dtype=np.float32)
             else:
-                _fields[pvar] = _dict
- 
-    # With elevation and azimuth in the radar object, lets recalculate
-    # gate latitude, longitude and altitude,
+                fields[pvar] = np.ma.array(data, dtype=np.float32)
 
-    if _debug > 0:
-        print('LOAD_PPI:  Volume mean time:  ',start_time)
-    
-    if _debug > 100:
-        print('LOAD_PPI: final field dictionary: \n', _fields)
-        print('LOAD_PPI: ngates.shape: ', _range['data'].shape)
-        print('LOAD_PPI: nrays.shape: ', _azimuth['data'].shape)
-        print('LOAD_PPI: sweep_start/stop: ', _sweep_start_ray_index['data'], _sweep_end_ray_index['data'])
-        print('LOAD_PPI: sweeps: ', _sweep_number['data'])
-    
-    return Radar( _time, _range, _fields, _metadata, _scan_type,                    \
-                  _latitude, _longitude, _altitude,                                 \
-                  _sweep_number, _sweep_mode, _fixed_angle, _sweep_start_ray_index, \
-                  _sweep_end_ray_index,                                              \
-                  _azimuth, _elevation, instrument_parameters=_instr_params)
+    return Tilt(fields, units, azimuth, elevation, gate_range, time, nyquist,
+                float(attrs['Latitude']), float(attrs['Longitude']), float(attrs['Height']), metadata)
+
+def load_mrms_ppi(fdict, contents=None, **kwargs):
+    """
+    Read one tilt from MRMS radar NetCDF files (see load_mrms_tilt) as a pyART Radar.
+    """
+
+    return load_mrms_tilt(fdict, contents=contents).to_pyart()
 
 def getProducts(radar, run_time, tilt):
     """
@@ -200,21 +311,15 @@ def getProducts(radar, run_time, tilt):
     refl_path = __get_path_reflectivity_tilt__(radar, run_time, tilt)
     vel_path = __get_path_velocity_tilt__(radar, run_time, tilt)
 
-    def getNearestFile(time, files):
-        win = int(settings.rass_window)
-        #TODO: clean this up. initial lambda should do the filter check and return None if beyond window for less looping
-        files = map(lambda x: (abs((time - datetime.datetime.strptime(os.path.splitext(x)[0], "%Y%m%d-%H%M%S")).total_seconds()), x), files)
-        s = sorted(files, key = lambda x: x[0])
-        s = list(filter(lambda x: x[0] <= win, s))
-        return s[0] if len(s) > 0 else None
+    win = int(settings.rass_window)
 
-    v = getNearestFile(run_time, os.listdir(vel_path))
+    v = get_catalog(vel_path, 'mrms').closest(run_time, max_dt=win)
     if v is not None:
-        yield {'file': os.path.join(vel_path, v[1]), 'variables': [{'ncvar': 'Velocity', 'pvar': 'velocity'}, {'ncvar': 'NyquistVelocity', 'pvar': 'nyquist_velocity'}]}
+        yield {'file': os.path.join(vel_path, os.path.basename(v)), 'variables': [{'ncvar': 'Velocity', 'pvar': 'velocity'}, {'ncvar': 'NyquistVelocity', 'pvar': 'nyquist_velocity'}]}
 
-    r = getNearestFile(run_time, os.listdir(refl_path))
+    r = get_catalog(refl_path, 'mrms').closest(run_time, max_dt=win)
     if r is not None:
-        yield {'file': os.path.join(refl_path, r[1]), 'variables': [{'ncvar': 'ReflectivityQC', 'pvar': "reflectivity"}]}
+        yield {'file': os.path.join(refl_path, os.path.basename(r)), 'variables': [{'ncvar': 'ReflectivityQC', 'pvar': "reflectivity"}]}
 
 def getTiltProducts(radar, run_time):
     refl_tilts = os.listdir(__get_path_reflectivity__(radar, run_time))
@@ -224,14 +329,18 @@ def getTiltProducts(radar, run_time):
     for tilt in tilts:
         yield { "tilt": tilt, "files": list(getProducts(radar, run_time, tilt)) }
 
-def getRadarProducts(radar, run_time):
-    for fileset in getTiltProducts(radar, run_time):
+def getRadarProducts(radar, run_time, nthreads=_load_threads):
+
+    # cannot process vr without reflectivity
+    filesets = [fileset for fileset in getTiltProducts(radar, run_time) if len(fileset['files']) >= 2]
+
+    # the files of all the tilts are read at once by nthreads threads, the tilts are built in order
+
+    with ThreadPoolExecutor(max_workers=max(1, nthreads)) as pool:
+
+        reads = [[pool.submit(read_mrms_file, d) for d in fileset['files']] for fileset in filesets]
 
-        # cannot process vr without reflectivity
-        if len(fileset['files']) < 2: 
-            continue
+        for fileset, futures in zip(filesets, reads):
 
-        myradar = load_mrms_ppi(fileset['files'])
-        myradar.init_gate_altitude()
-        myradar.init_gate_longitude_latitude()
-        yield { "tilt": fileset['tilt'], "radar": myradar }
\ No newline at end of file
+            mytilt = load_mrms_tilt(fileset['files'], contents=[future.result() for future in futures])
+            yield { "tilt": fileset['tilt'], "radar": mytilt }
@@ -47,20 +47,23 @@ import scipy.ndimage as ndimage
 import scipy.spatial
 from optparse import OptionParser
 from matplotlib.offsetbox import AnchoredText
-from utils.dart_tools import opaws_write_DART_ascii
+from utils.dart_tools import opaws_write_DART_ascii, beam_hgt_grid
+from utils.obs_seq_netcdf import write_obs_seq_netcdf, obs_time
 from pyOPAWS.radar_QC import *
 
 import netCDF4 as ncdf
 import datetime as DT
-import xarray as xr
 import pandas as pd
 import metpy.calc as mpcalc
 from metpy.units import units
 
-from utils.cressman import *
+from utils.superob import get_superob_engine, superob_weights, apply_superob_weights, obs_2_grid2d_binned, \
+                          active_window, in_reach
+from utils.weight_cache import get_weight_cache, sweep_key
+from utils.grid_cache import get_grid
+from utils.process_pool import shared_array, map_processes
 import pyart
 
-from pyproj import Proj
 import pylab as plt  
 from mpl_toolkits.basemap import Basemap
 from pyart.graph import cm
@@ -103,7 +106,7 @@ truelat1, truelat2 = 30.0, 60.0
 _grid_dict = {
               'grid_spacing_xy' : 3000.,         # meters
               'domain_radius_xy': 150000.,       # meters
-              'anal_method'     : 'Cressman',    # options are Cressman, Barnes (1-pass)
+              'anal_method'     : 'Cressman',    # options are Cressman, Barnes (1-pass), Cressman-binned, Barnes-binned (fast, approximate)
               'ROI'             : 1000.,         # Cressman ~ analysis_grid * sqrt(2), Barnes ~ largest data spacing in radar
               'min_count'       : 3,             # regular radar data ~3, high-res radar data ~ 10
               'min_weight'      : 0.2,           # min weight for analysis Cressman ~ 0.3, Barnes ~ 2
@@ -113,7 +116,12 @@ _grid_dict = {
               '0dbz_obtype'     : True,
               'thin_zeros'      : 4,
               'halo_footprint'  : 3,
-              'nthreads'        : 1,
+              'nprocs'          : 1,
+              'superob_engine'  : 'numpy',       # options are numpy (utils/superob.py) or fortran (f2py utils/cressman.f90)
+              'weight_cache'    : False,         # reuse sparse superob weights per radar/VCP/sweep/grid, approximate (utils/weight_cache.py)
+              'weight_cache_dir': None,          # directory to also keep the weights on disk, None = in memory only
+              'grid_cache_dir'  : None,          # directory to also keep the grid geometry on disk (memory-mapped), see utils/grid_cache.py
+              'dart_format'     : 'ascii',       # obs_seq files are written as ascii or binary (DART unformatted obs sequence)
               'max_height'      : 10000.,
               'MRMS_zeros'      : [True,      6000.], # True: creates a single level of zeros where composite DBZ < _dbz_min
               'model_grid_size' : [900000., 900000.]  # Used to create a common grid for all observations (special option) 
@@ -279,9 +287,17 @@ def vel_masking(vel, ref):
         
     return vel
 
-def grid_data(volumes, field, LatLon=None):
+def grid_fields(volumes, fields, LatLon=None):
     """
-        Grid data using parameters defined above in grid_dict 
+        Grid several fields at once using parameters defined above in grid_dict.
+
+        volumes are the tilts, rass.load_mrms_ppi.Tilt (or pyART Radar) objects, only
+        their sweep 0 is gridded.
+
+        Each tilt's fields share the gate geometry, so the superob weights of a tilt
+        are computed (or fetched from the weight cache) once and used for all fields.
+
+        Returns a dict of Gridded_Field objects keyed by field name.
     """
 
     # Two ways to grid the data:  radar centered or external grid
@@ -293,12 +309,9 @@ def grid_data(volumes, field, LatLon=None):
         nx, ny          = (grid_pts_xy, grid_pts_xy)
         radar_lat       = volumes[0].latitude['data']
         radar_lon       = volumes[0].longitude['data']
-        xg              = -domain_length + grid_spacing_xy * np.arange(grid_pts_xy)
-        yg              = -domain_length + grid_spacing_xy * np.arange(grid_pts_xy)
-        
-        map = Proj(proj='lcc', ellps='WGS84', datum='WGS84', lat_1=truelat1, lat_2=truelat2, lat_0=radar_lat, lon_0=radar_lon)
-        xoffset, yoffset = list(map(radar_lon, radar_lat)) 
-        lons, lats = list(map(xg, yg, inverse=True))
+
+        grid = get_grid(_grid_dict['projection'], radar_lat[0], radar_lon[0], grid_spacing_xy, -domain_length, -domain_length, \
+                        nx, ny, lat_1=truelat1, lat_2=truelat2, cache_dir=_grid_dict['grid_cache_dir'])
         
     else:  # grid based on model grid center LatLon
 
@@ -306,27 +319,66 @@ def grid_data(volumes, field, LatLon=None):
         nx              = 1 + np.int(_grid_dict['model_grid_size'][0] / grid_spacing_xy)
         ny              = 1 + np.int(_grid_dict['model_grid_size'][1] / grid_spacing_xy)
         grid_pts_xy     = max(nx, ny)
-        xg              = -0.5*_grid_dict['model_grid_size'][0] + grid_spacing_xy * np.arange(nx)
-        yg              = -0.5*_grid_dict['model_grid_size'][1] + grid_spacing_xy * np.arange(ny)
         radar_lat       = volumes[0].latitude['data'][0]
         radar_lon       = volumes[0].longitude['data'][0]
-        
-        map = Proj(proj='lcc', ellps='WGS84', datum='WGS84', lat_1=truelat1, lat_2=truelat2, lat_0=LatLon[0], lon_0=LatLon[1])
-        
-        xoffset, yoffset = list(map(radar_lon, radar_lat))
-        lons, lats = list(map(xg, yg, inverse=True))
 
-    if _grid_dict['anal_method'] == 'Cressman':
+        grid = get_grid(_grid_dict['projection'], LatLon[0], LatLon[1], grid_spacing_xy, -0.5*_grid_dict['model_grid_size'][0], \
+                        -0.5*_grid_dict['model_grid_size'][1], nx, ny, lat_1=truelat1, lat_2=truelat2, \
+                        cache_dir=_grid_dict['grid_cache_dir'])
+
+    # Projection, grid coordinates and radar location on the grid (cached per grid, see utils/grid_cache.py)
+
+    map        = grid.map
+    xg, yg     = grid.xg, grid.yg
+    lons, lats = grid.lons, grid.lats
+
+    xoffset, yoffset = grid.offset(np.ravel(radar_lat)[0], np.ravel(radar_lon)[0])
+
+    if _grid_dict['anal_method'] in ['Cressman', 'Cressman-binned']:
         anal_method = 1
     else:
         anal_method = 2
 
+    # binned methods:  histogram + kernel convolution on the grid, see utils/superob.obs_2_grid2d_binned
+
+    binned = _grid_dict['anal_method'].endswith('-binned')
+
+    # sparse weight matrices (cached or shared between fields) are only used for Cressman,
+    # the Barnes footprint (5*roi) makes them ~25 times larger
+
+    use_weights = (anal_method == 1) and not binned
+
     roi        = _grid_dict['ROI']
-    nthreads   = _grid_dict['nthreads']
+    nprocs     = _grid_dict['nprocs']
     min_count  = _grid_dict['min_count']
     min_weight = _grid_dict['min_weight']
     min_range  = _grid_dict['min_range']
 
+    # Active window:  only the part of the grid that the radar's gates can reach is gridded,
+    # (all of a radar centered grid, usually a small part of the model grid in LatLon mode)
+
+    window = active_window(xg, yg, xoffset, yoffset, max([v.range['data'][-1] for v in volumes]), anal_method, 2.0*grid_spacing_xy)
+
+    if window is None:
+        print("\n Radar does not reach the analysis grid, no data will be gridded\n")
+        rows, cols = slice(0, 0), slice(0, 0)
+    else:
+        rows, cols = window
+
+    xs, ys = xg[cols], yg[rows]
+
+    if binned:
+        obs_2_grid2d = obs_2_grid2d_binned
+    else:
+        obs_2_grid2d = get_superob_engine(_grid_dict['superob_engine'])
+
+    if _grid_dict['weight_cache'] and use_weights and window is not None:
+        weight_cache = get_weight_cache(_grid_dict['weight_cache_dir'])
+        grid_spec    = (float(xs[0]), float(ys[0]), float(grid_spacing_xy), int(xs.size), int(ys.size), \
+                        float(xoffset), float(yoffset), anal_method, float(2.0*grid_spacing_xy), float(min_range))
+    else:
+        weight_cache = None
+
     ########################################################################
 
     print('\n Gridding radar data with following parameters')
@@ -334,15 +386,18 @@ def grid_data(volumes, field, LatLon=None):
     print(' Method of Analysis:      {}'.format(_grid_dict['anal_method']))
     print(' Horizontal grid spacing: {} km'.format(grid_spacing_xy/1000.))
     print(' Grid points in x,y:      {},{}'.format(int(nx),int(ny)))
+    print(' Active grid window x,y:  {},{}'.format(xs.size, ys.size))
     print(' Weighting function:      {}'.format(_grid_dict['anal_method']))
     print(' Radius of Influence:     {} km'.format(_grid_dict['ROI']/1000.))
     print(' Minimum gates:           {}'.format(min_count))
     print(' Minimum weight:          {}'.format(min_weight))
     print(' Minimum range:           {} km'.format(min_range/1000.))
     print(' Map projection:          {}'.format(_grid_dict['projection']))
+    print(' Processes:               {}'.format(nprocs))
+    print(' Weight cache:            {}'.format((_grid_dict['weight_cache_dir'] or 'memory') if weight_cache is not None else 'off'))
     print(' Xoffset:                 {} km'.format(np.round(xoffset/1000.)))
     print(' Yoffset:                 {} km'.format(np.round(yoffset/1000.)))
-    print(' Field to be gridded:     {}\n'.format(field)) 
+    print(' Fields to be gridded:    {}\n'.format(', '.join(fields))) 
     print(' Min / Max X grid loc:    {} <-> {} km\n'.format(0.001*xg[0], 0.001*xg[-1]))
     print(' Min / Max Y grid loc:    {} <-> {} km\n'.format(0.001*yg[0], 0.001*yg[-1]))
     print(' Min / Max Longitude:     {} <-> {} deg\n'.format(lons[0], lons[-1]))
@@ -382,97 +437,148 @@ def grid_data(volumes, field, LatLon=None):
             return gc
 
 
-    tt = timeit.clock()
+    def build_weights(x, y):
+        """
+            Sparse superob weights for all the gates in a sweep
+        """
 
+        xob = x.ravel() + xoffset
+        yob = y.ravel() + yoffset
 
+        return superob_weights(xob, yob, xs, ys, np.searchsorted(xs, xob), np.searchsorted(ys, yob), \
+                               anal_method, min_range, 2.0*grid_spacing_xy)
 
-    # sweeps = list(sorted(lambda x: x.gus, volumes))
+    tt = timeit.clock()
 
     # Create 3D arrays for analysis grid, the vertical dimension is the number of tilts
 
-    new_grid    = np.zeros((len(volumes), ny, nx))
-    new_mask    = np.full((len(volumes), ny, nx), False)
-    elevations  = np.zeros((len(volumes),))
-    sweep_time  = np.zeros((len(volumes),))
-    zgrid       = np.zeros((len(volumes), ny, nx))
-    nyquist     = np.zeros((len(volumes),))
-        
-    # Grid only those valid sweeps 
-    
-    total = 0
-    for n, volume in enumerate(volumes):
+    new_grid    = {}
+    new_mask    = {}
+    elevations  = {}
+    sweep_time  = {}
+    zgrid       = {}
+    nyquist     = {}
 
-        try:
-            v_iter = volume.iter_field(field)
-            field_name = field
-        except KeyError:
-            print("\n No dealiased velocity present, gridding RAW radial velocity\n")
-            v_iter = volume.iter_field("velocity")
-            field_name = "velocity"
+    # (in shared memory, the tilts are gridded by nprocs processes)
+
+    for field in fields:
+        new_grid[field]    = shared_array((len(volumes), ny, nx))
+        new_mask[field]    = shared_array((len(volumes), ny, nx), bool, False)
+        elevations[field]  = shared_array((len(volumes),))
+        sweep_time[field]  = shared_array((len(volumes),))
+        zgrid[field]       = shared_array((len(volumes), ny, nx))
+        nyquist[field]     = shared_array((len(volumes),))
+
+    def grid_tilt(n, volume):
+        """
+            Grid every field of a tilt
+        """
 
         sweep_level = 0
-        sweep_data = volume.get_field(sweep_level, field_name)
+
+        weights = None
+        order   = None
 
         begin, end = volume.get_start_end(sweep_level)
-        
-        sweep_time[n] = volume.time['data'][begin:end].mean()
-        elevations[n] = volume.get_elevation(sweep_level).mean()
-        nyquist[n]    = volume.get_nyquist_vel(sweep_level)
-        
-        omask = (sweep_data.mask == False)
-        
-        x, y, z = volume.get_gate_x_y_z(sweep_level)
-        
-        obs = sweep_data[omask].ravel()
-        xob = x[omask].ravel() + xoffset
-        yob = y[omask].ravel() + yoffset
-        
-        ix = np.searchsorted(xg, xob)
-        iy = np.searchsorted(yg, yob)
-        
-        if obs.size > 0:
-            tmp = obs_2_grid2d(obs, xob, yob, xg, yg, ix, iy, anal_method, min_count, min_weight, min_range, \
-                                        2.0*grid_spacing_xy, _missing)
-            new_grid[n] = tmp
-            new_mask[n] = (tmp <= _missing)
-            total = total + np.sum(new_mask[n] == False)
-        else:
-            new_grid[n] = np.full((ny,nx), _missing)
-            new_mask[n] = np.full((ny,nx), True)
-            
-        if field == "reflectivity":
-            new_mask[n] = np.logical_or(new_mask[n], new_grid[n] < _radar_parameters['min_dbz_analysis'])
-            print(" Sweep: %2.2d Elevation: %5.2f  Number of valid reflectivity points:  %d" % (n, elevations[n],np.sum(new_mask[n]==False)))
-        else:
-            print(" Sweep: %2.2d Elevation: %5.2f  Number of valid grid points:  %d" % (n, elevations[n],np.sum(new_mask[n]==False)))
 
-        # Create z-field
+        for field in fields:
 
-        zobs= z.ravel()
-        xob = x.ravel() + xoffset
-        yob = y.ravel() + yoffset
+            if field in volume.fields:
+                field_name = field
+            else:
+                print("\n No dealiased velocity present, gridding RAW radial velocity\n")
+                field_name = "velocity"
 
-        zobs = np.where( zobs < 0.0, 0.0, zobs)
-        
-        ix = np.searchsorted(xg, xob)
-        iy = np.searchsorted(yg, yob)
+            sweep_data = volume.get_field(sweep_level, field_name)
 
-        #      tmp=inverse_distance(xob, yob, zobs, xg, yg, 2.0*grid_spacing_xy, gamma=None, kappa=None,
-        #                    min_neighbors=min_count, kind='cressman')
+            sweep_time[field][n] = volume.time['data'][begin:end].mean()
+            elevations[field][n] = volume.get_elevation(sweep_level).mean()
+            nyquist[field][n]    = volume.get_nyquist_vel(sweep_level)
+
+            omask = (np.ma.getmaskarray(sweep_data) == False)
+
+            if window is None:
+                omask = np.full(omask.shape, False)
+
+            obs = sweep_data[omask].ravel()
+
+            # weights for the whole tilt when they are cached or shared between fields
+
+            if obs.size > 0 and weights is None:
+                if weight_cache is not None:
+                    weights, order = weight_cache.get(sweep_key(volume, sweep_level, grid_spec), volume.get_azimuth(sweep_level), \
+                                                      volume.get_elevation(sweep_level), \
+                                                      lambda: build_weights(*volume.get_gate_x_y_z(sweep_level)[0:2]))
+                elif len(fields) > 1 and use_weights:
+                    weights = build_weights(*volume.get_gate_x_y_z(sweep_level)[0:2])
+                    order   = np.arange(sweep_data.shape[0])
+
+            if obs.size > 0 and weights is not None:
+                tmp = apply_superob_weights(weights, np.ma.getdata(sweep_data)[order], omask[order], ys.size, xs.size, \
+                                            min_count, min_weight, _missing)
+
+            elif obs.size > 0:
+                x, y, z = volume.get_gate_x_y_z(sweep_level)
+
+                xob = x[omask].ravel() + xoffset
+                yob = y[omask].ravel() + yoffset
+
+                ix = np.searchsorted(xs, xob)
+                iy = np.searchsorted(ys, yob)
+
+                # drop the gates that cannot reach the grid window
+
+                keep = in_reach(xob, yob, xs, ys, anal_method, 2.0*grid_spacing_xy)
+
+                tmp = obs_2_grid2d(obs[keep], xob[keep], yob[keep], xs, ys, ix[keep], iy[keep], anal_method, \
+                                   min_count, min_weight, min_range, 2.0*grid_spacing_xy, _missing)
+
+            if obs.size > 0:
+                new_grid[field][n] = np.full((ny,nx), _missing)
+                new_grid[field][n][rows, cols] = tmp
+                new_mask[field][n] = (new_grid[field][n] <= _missing)
+            else:
+                new_grid[field][n] = np.full((ny,nx), _missing)
+                new_mask[field][n] = np.full((ny,nx), True)
+
+            if field == "reflectivity":
+                new_mask[field][n] = np.logical_or(new_mask[field][n], new_grid[field][n] < _radar_parameters['min_dbz_analysis'])
+                print(" Sweep: %2.2d Elevation: %5.2f  Number of valid reflectivity points:  %d" % (n, elevations[field][n],np.sum(new_mask[field][n]==False)))
+            else:
+                print(" Sweep: %2.2d Elevation: %5.2f  Number of valid %s grid points:  %d" % (n, elevations[field][n], field, np.sum(new_mask[field][n]==False)))
+
+            # Create z-field:  beam height above the radar at each grid point (4/3 earth model)
+
+            zgrid[field][n] = beam_hgt_grid(xg, yg, xoffset, yoffset, elevations[field][n])
+
+    # Grid only those valid sweeps, nprocs processes at a time (see utils/process_pool.py)
+
+    map_processes(lambda n: grid_tilt(n, volumes[n]), range(len(volumes)), nprocs)
 
-        tmp = obs_2_grid2d(zobs, xob, yob, xg, yg, ix, iy, 1, 1, 0.1, min_range, 2.0*grid_spacing_xy, -99999.)
-        zgrid[n] = tmp
-        
     print("\n %f secs to run superob analysis for all levels \n" % (timeit.clock()-tt))
 
-    print('\n Total number of valid obs in volume: %d \n' % total)
-    print('\n Total number of valid obs in volume: %d \n' % np.sum(new_mask == False))
+    grids = {}
+
+    for field in fields:
+
+        print('\n Total number of valid %s obs in volume: %d \n' % (field, np.sum(new_mask[field] == False)))
+
+        grids[field] = Gridded_Field("data_grid", field = field, data = np.ma.array(new_grid[field], mask=new_mask[field]), basemap = map, 
+                                     xg = xg, yg = yg, zg = np.ma.array(zgrid[field], mask=new_mask[field]),                   
+                                     lats = lats, lons = lons, elevations=elevations[field],
+                                     radar_lat = radar_lat, radar_lon = radar_lon, radar_hgt=volumes[-1].altitude['data'][0],
+                                     time = volumes[-1].time, sweep_time = sweep_time[field], metadata = volumes[-1].metadata, nyquist = nyquist[field])
 
-    return Gridded_Field("data_grid", field = field, data = np.ma.array(new_grid, mask=new_mask), basemap = map, 
-                            xg = xg, yg = yg, zg = np.ma.array(zgrid, mask=new_mask),                   
-                            lats = lats, lons = lons, elevations=elevations,
-                            radar_lat = radar_lat, radar_lon = radar_lon, radar_hgt=volume.altitude['data'][0],
-                            time = volume.time, sweep_time = sweep_time, metadata = volume.metadata, nyquist = nyquist) #
+    return grids
+
+########################################################################
+
+def grid_data(volumes, field, LatLon=None):
+    """
+        Grid data using parameters defined above in grid_dict 
+    """
+
+    return grid_fields(volumes, [field], LatLon=LatLon)[field]
 
 ###########################################################################################
 #
@@ -786,41 +892,8 @@ def write_radar_file(ref, vel, filename=None):
 #=========================================================================================
 # Defines the data frame for each observation type
 #
-def obs_seq_xarray(len):
-
-    return (np.recarray(len,
-                    dtype = [
-                             ('value',               'f8'),
-                             ('lat',                 'f8'),
-                             ('lon',                 'f8'),
-                             ('height',              'f8'),
-                             ('error_var',           'f4'),
-                             ('utime',               'f8'),
-                             ('date',                'S128'),
-                             ('day',                 'i8'),
-                             ('second',              'i8'),
-                             ('platform_lat',        'f8'),
-                             ('platform_lon',        'f8'),
-                             ('platform_hgt',        'f8'),
-                             ('platform_dir1',       'f8'),
-                             ('platform_dir2',       'f8'),
-                             ('platform_dir3',       'f8'),
-                             ('platform_nyquist',    'f8')
-                            ]), \
-                         {
-                           'lat':   ["degrees", "latitude of observation"],
-                           'lon':   ["degrees", "longitude of observation (deg. west)"],
-                           'height':["meters",  "height above sea level"],
-                           'utime': ["seconds since 1970-01-01 00:00:00", "time of observation"],
-                           'date':  ["", "date and time of obsevation"]
-                          })
-
-#####################################################################################################
 def write_obs_seq_xarray(field, filename=None, obs_error=3., volume_name=None):
 
-    _time_units    = 'seconds since 1970-01-01 00:00:00'
-    _calendar      = 'standard'
-
     if filename == None:
         print("\n WRITE_DATA_XARRAY:  No output file name is given, writing to %s" % "obs_seq.txt")
         filename = "obs_seq.nc"
@@ -829,9 +902,6 @@ def write_obs_seq_xarray(field, filename=None, obs_error=3., volume_name=None):
         basename = "%s_%s.nc" % ("obs_seq", os.path.basename(filename))
         filename =  os.path.join(dirname, basename)
 
-    _stringlen     = 8
-    _datelen       = 19
-
     # Extract data.city data
 
     fld           = field.data.data[:,:,:]
@@ -841,91 +911,48 @@ def write_obs_seq_xarray(field, filename=None, obs_error=3., volume_name=None):
     xgrid         = field.xg[:]
     ygrid         = field.yg[:]
     zgrid         = field.zg[:,:,:]
-    msl_hgt       = field.zg[:,:,:] + field.radar_hgt
 
-    platform_lat  = field.radar_lat
-    platform_lon  = field.radar_lon
-    platform_hgt  = field.radar_hgt
+    # Use the volume mean time for the time of the volume, DART time stamps are retained
 
-    # Use the volume mean time for the time of the volume
-
-    utime   = ncdf.num2date(field.time['data'].mean(), field.time['units'])
-    secs    = ncdf.date2num(utime, units = _time_units)
-    # Retain DART time stamps
-    days    = ncdf.date2num(utime, units = "days since 1601-01-01 00:00:00")
-    seconds = np.int(86400.*(days - np.floor(days)))
+    utime                = ncdf.num2date(field.time['data'].mean(), field.time['units'])
+    secs, days, seconds  = obs_time(utime)
 
     print("\n -->  Writing %s as the radar file..." % (filename))
-    #  mask_check = data.mask && numpy.isnan().any()
 
     nobs = np.sum(mask==False)
     print("\n -----> Number of good observations for xarray:  %d" % nobs)
 
-    # Create numpy rec array that can be converted to a pandas table.
-
-    out, attributes = obs_seq_xarray(nobs)
-
-    # There is a far better way to do this but this is fast enough for now...
-
-    n = 0
-
-    for k in np.arange(fld.shape[0]):
-        for j in np.arange(fld.shape[1]):
-            for i in np.arange(fld.shape[2]):
-
-                if mask[k,j,i] == True: continue
-
-                dx    = xgrid[i]
-                dy    = ygrid[j]
-                dz    = zgrid[k,j,i]
-                range = np.sqrt(dx**2 + dy**2 + dz**2)
-                dir1  = dx / range
-                dir2  = dy / range
-                dir3  = dz / range
-
-                out.value[n]              = fld[k,j,i]
-                out.error_var[n]          = obs_error**2
-                out.lon[n]                = lons[i]
-                out.lat[n]                = lats[j]
-                out.height[n]             = msl_hgt[k,j,i]
-                out.date[n]               = utime
-                out.utime[n]              = secs
-                out.day[n]                = days
-                out.second[n]             = seconds
-                out.platform_lon[n]       = platform_lon
-                out.platform_lat[n]       = platform_lat
-                out.platform_hgt[n]       = platform_hgt
-                out.platform_dir1[n]      = dir1
-                out.platform_dir2[n]      = dir2
-                out.platform_dir3[n]      = dir3
-                out.platform_nyquist[n]   = field.nyquist[k]
-
-                n = n + 1
-    
-    # Create an xarray dataset for file I/O
-    xa = xr.Dataset(pd.DataFrame.from_records(out))
+    # The obs in the (k,j,i) order of the grid, each column is written as it is computed
 
-    #  # reset index to be a master index across all obs
-    xa = xa.rename({'dim_0': 'index'})
+    kk, jj, ii = np.nonzero(mask == False)
 
-    # Write the xarray file out (this is all there is, very nice guys!)
-    xa.to_netcdf(filename, mode='w')
-    xa.close()
+    dz    = np.ma.getdata(zgrid)[kk,jj,ii]
 
-    # Add attributes to the files
+    def columns():
+        dis = np.sqrt(xgrid[ii]**2 + ygrid[jj]**2 + dz**2)
+        yield 'value',            fld[kk,jj,ii]
+        yield 'lat',              lats[jj]
+        yield 'lon',              lons[ii]
+        yield 'height',           dz + field.radar_hgt
+        yield 'error_var',        np.full((nobs,), obs_error**2, dtype=np.float32)
+        yield 'platform_dir1',    xgrid[ii] / dis
+        yield 'platform_dir2',    ygrid[jj] / dis
+        yield 'platform_dir3',    dz / dis
+        yield 'platform_nyquist', np.asarray(field.nyquist, dtype=np.float64)[kk]
 
-    fnc = ncdf.Dataset(filename, mode = 'a')
-    fnc.history = "Created " + DT.datetime.today().strftime("%Y%m%d_%H%M")
-    fnc.version = "Version 1.0a by Lou Wicker and Thomas Jones (NSSL)"
-    if volume_name != None:
-        fnc.version = "Created from the WSR88D radar volume:  %s" % volume_name
+    constants = {'utime':        secs,
+                 'day':          days,
+                 'second':       seconds,
+                 'platform_lat': field.radar_lat,
+                 'platform_lon': field.radar_lon,
+                 'platform_hgt': field.radar_hgt}
 
-    for key in list(attributes.keys()):
-        fnc.variables[key].units = attributes[key][0]
-        fnc.variables[key].description = attributes[key][1]
+    if volume_name != None:
+        version = "Created from the WSR88D radar volume:  %s" % volume_name
+    else:
+        version = None
 
-    fnc.sync()
-    fnc.close()
+    write_obs_seq_netcdf(filename, nobs, columns(), constants, date=utime, version=version)
 
 #######################################################################
 def clock_string():
@@ -962,6 +989,16 @@ def run(radar, run_time, options):
     if options.roi:
         _grid_dict['ROI'] = options.roi
 
+    if getattr(options, 'weight_cache', None):
+        _grid_dict['weight_cache_dir'] = options.weight_cache
+        _grid_dict['grid_cache_dir']   = options.weight_cache
+
+    if getattr(options, 'nprocs', None):
+        _grid_dict['nprocs'] = options.nprocs
+
+    if getattr(options, 'dart_format', None):
+        _grid_dict['dart_format'] = options.dart_format
+
     if options.plot == None:
         sweep_num = []
     elif options.plot >= 0:
@@ -981,8 +1018,10 @@ def run(radar, run_time, options):
         print("Exiting for radar %s. No radar files found." % radar)
         return
 
-    ref = dbz_masking(grid_data(volumes, "reflectivity", LatLon=cLatLon), thin_zeros=_grid_dict['thin_zeros'])
-    vel = grid_data(volumes, "velocity", LatLon=cLatLon)
+    grids = grid_fields(volumes, ["reflectivity", "velocity"], LatLon=cLatLon)
+
+    ref = dbz_masking(grids["reflectivity"], thin_zeros=_grid_dict['thin_zeros'])
+    vel = grids["velocity"]
     
     # Mask it off based on dictionary parameters set at top
 
@@ -998,6 +1037,16 @@ def run(radar, run_time, options):
 
     write_obs_seq_xarray(vel, filename=out_filename, obs_error= _obs_errors['velocity'])
 
+    if options.write == True:
+        print('\n WRITING DART: {}\n'.format(out_filename))
+        opaws_write_DART_ascii(vel, filename=out_filename, grid_dict=_grid_dict, \
+                               obs_error=[_obs_errors['velocity']], dart_format=_grid_dict['dart_format'])
+
+        if options.onlyVR != True:
+            opaws_write_DART_ascii(ref, filename=out_filename+"_RF", grid_dict=_grid_dict, \
+                                   obs_error=[_obs_errors['reflectivity'], _obs_errors['0reflectivity']], \
+                                   dart_format=_grid_dict['dart_format'])
+
     if len(sweep_num) > 0:
         fplotname = os.path.basename(out_filename)
         for pl in sweep_num:
@@ -1027,7 +1076,7 @@ if __name__ == "__main__":
            help = "Boolean flag to only write VR to DART ascii file", action="store_true")
                      
    parser.add_option(     "--method",     dest="method",   default=None, type="string", \
-           help = "Function to use for the weight process, valid strings are:  Cressman or Barnes")
+           help = "Function to use for the weight process, valid strings are:  Cressman, Barnes, Cressman-binned or Barnes-binned")
           
    parser.add_option("-q", "--qc", dest="qc", default="Minimal",  type="string",     \
            help = "Type of QC corrections on reflectivity or velocity.  Valid:  None, Minimal, MetSignal, A1")  
@@ -1038,6 +1087,15 @@ if __name__ == "__main__":
    parser.add_option(     "--roi",     dest="roi",   default=None, type="float", \
            help = "Radius of influence in meters for superob regrid")
 
+   parser.add_option(     "--weight_cache", dest="weight_cache", default=None, type="string", \
+           help = "Directory to cache the grid geometry (and the superob weights if _grid_dict weight_cache is on) in between runs")
+
+   parser.add_option(     "--nprocs",   dest="nprocs",   default=None, type="int", \
+           help = "Number of processes used to grid the sweeps")
+
+   parser.add_option(     "--dart_format", dest="dart_format", default=None, type="string", \
+           help = "Format of the DART obs_seq files:  ascii (default) or binary")
+
    parser.add_option("-p", "--plot",      dest="plot",      default=0,  type="int",      \
            help = "Specify a number between 0 and # elevations to plot ref and vr in that co-plane")
                      
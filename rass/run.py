@@ -21,6 +21,9 @@ def main(start_time, radarIndex):
     obj.plot = int(settings.rass_plot)
     obj.dx = float(settings.rass_dx)
     obj.roi = float(settings.rass_roi)
+    obj.weight_cache = settings.rass_weight_cache
+    obj.nprocs   = int(os.environ.get('SLURM_CPUS_PER_TASK', 1))
+    obj.dart_format = settings.rass_dart_format
     obj.newse = None
     obj.method = None
     obj.shapefiles = None
@@ -0,0 +1,66 @@
+import unittest
+import os, shutil, tempfile
+import datetime as DT
+
+import utils.catalog as catalog
+
+class TestCatalog(unittest.TestCase):
+
+    def setUp(self):
+
+        self.feed      = tempfile.mkdtemp()
+        self.cache_dir = tempfile.mkdtemp()
+
+        for name in ["20200303-055830.netcdf", "20200303-060030.netcdf", "20200303-060230.netcdf",
+                     "20200303-060430.netcdf", "README", "code_index.fam"]:
+            open(os.path.join(self.feed, name), 'w').close()
+
+    def tearDown(self):
+
+        catalog._catalogs.clear()
+        shutil.rmtree(self.feed)
+        shutil.rmtree(self.cache_dir)
+
+    def test_queries(self):
+
+        tilts = catalog.get_catalog(self.feed, 'mrms')
+        path  = lambda name: os.path.join(self.feed, name)
+        time  = DT.datetime(2020, 3, 3, 6, 1, 30)
+
+        self.assertTrue(catalog.get_catalog(self.feed, 'mrms') is tilts)
+        self.assertEqual(len(tilts.between()), 4)
+
+        # the earlier file of a tie, None beyond max_dt
+
+        self.assertEqual(tilts.closest(time), path("20200303-060030.netcdf"))
+        self.assertEqual(tilts.closest(time + DT.timedelta(seconds=1)), path("20200303-060230.netcdf"))
+        self.assertEqual(tilts.closest(time, max_dt=59), None)
+        self.assertEqual(tilts.closest(DT.datetime(2020, 3, 4)), path("20200303-060430.netcdf"))
+        self.assertEqual(tilts.closest(time, start=DT.datetime(2020, 3, 3, 6, 1)), path("20200303-060230.netcdf"))
+
+        self.assertEqual(tilts.first(time - DT.timedelta(minutes=5), time + DT.timedelta(minutes=2)), \
+                         path("20200303-055830.netcdf"))
+        self.assertEqual(tilts.between(DT.datetime(2020, 3, 3, 6), DT.datetime(2020, 3, 3, 6, 4, 30)), \
+                         [path("20200303-060030.netcdf"), path("20200303-060230.netcdf")])
+
+        # a new file is found on the next query
+
+        open(path("20200303-060130.netcdf"), 'w').close()
+        self.assertEqual(tilts.closest(time), path("20200303-060130.netcdf"))
+
+    def test_catalog_on_disk(self):
+
+        tilts = catalog.get_catalog(self.feed, 'mrms', cache_dir=self.cache_dir)
+        self.assertEqual(len(tilts.between()), 4)
+
+        # a new process starts from the saved catalog, only new names are parsed
+
+        catalog._catalogs.clear()
+        saved = catalog.get_catalog(self.feed, 'mrms', cache_dir=self.cache_dir)
+
+        self.assertTrue(saved is not tilts)
+        self.assertEqual((saved.times, saved.names), (tilts.times, tilts.names))
+        self.assertEqual(saved.between(), tilts.between())
+
+if __name__ == '__main__':
+    unittest.main()
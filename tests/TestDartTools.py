@@ -0,0 +1,227 @@
+import unittest
+import os, shutil, tempfile
+import numpy as np
+import datetime as DT
+
+import utils.dart_tools as dart_tools
+from utils.dart_tools import beam_elv, beam_hgt, beam_hgt_grid, opaws_write_DART_ascii, mrms_write_DART_ascii
+from utils.dart_tools import merge_DART_obs_seq
+
+class Field(object):
+
+    def __init__(self, **kwargs):
+        for key in kwargs:  setattr(self, key, kwargs[key])
+
+class TestDartTools(unittest.TestCase):
+
+    def test_beam_hgt_inverts_beam_elv(self):
+
+        for sfc_range in [10000., 75000., 150000.]:
+            for elvang in [0.5, 3.1, 19.5]:
+                self.assertAlmostEqual(beam_elv(sfc_range, beam_hgt(sfc_range, elvang)), elvang, places=8)
+
+    def test_beam_hgt_grid(self):
+
+        xg = -150000. + 3000. * np.arange(101)
+        yg = -150000. + 3000. * np.arange(101)
+
+        zgrid = beam_hgt_grid(xg, yg, 0., 0., 0.5)
+
+        self.assertEqual(zgrid.shape, (101, 101))
+        self.assertTrue(zgrid.min() >= 0.0)
+        self.assertAlmostEqual(zgrid[50, 100], beam_hgt(150000., 0.5))
+        self.assertTrue(beam_hgt_grid(xg, yg, 0., 0., 0.5) is zgrid)
+
+    def test_write_DART_ascii(self):
+
+        np.random.seed(0)
+
+        xg   = -30000. + 3000. * np.arange(21)
+        yg   = -30000. + 3000. * np.arange(21)
+        zg   = np.stack([beam_hgt_grid(xg, yg, 0., 0., e) for e in [0.5, 1.5]])
+        data = np.ma.array(np.random.normal(0., 10., zg.shape), mask=np.random.random(zg.shape) > 0.3)
+
+        vel  = Field(field="velocity", data=data, zg=np.ma.array(zg, mask=data.mask), xg=xg, yg=yg,
+                     lats=np.linspace(35., 35.5, 21), lons=np.linspace(-98., -97.5, 21),
+                     radar_lat=35.25, radar_lon=-97.75, radar_hgt=390., nyquist=np.array([25., 27.]),
+                     time={'units': 'seconds since 2020-05-01T12:00:00Z'}, sweep_time=np.array([10., 25.]))
+
+        tmpdir = tempfile.mkdtemp()
+
+        try:
+            # the obs are formatted in blocks, the file must not depend on the block size
+
+            files = []
+            for chunk in [dart_tools._write_chunk, 7]:
+                dart_tools._write_chunk = chunk
+                opaws_write_DART_ascii(vel, filename=os.path.join(tmpdir, "vr%d" % chunk), obs_error=[3.])
+                with open(os.path.join(tmpdir, "obs_seq_vr%d.out" % chunk)) as f:  files.append(f.read())
+        finally:
+            dart_tools._write_chunk = 100000
+            shutil.rmtree(tmpdir)
+
+        nobs  = np.sum(data.mask == False)
+        lines = files[0].split("\n")
+
+        self.assertEqual(files[0], files[1])
+        self.assertTrue(" num_obs:       %d  max_num_obs:       %d" % (nobs, nobs) in lines)
+        self.assertEqual(files[0].count(" OBS "), nobs)
+        self.assertEqual(lines[lines.index(" OBS            1") + 3], " -1 2 -1")
+        self.assertEqual(lines[lines.index(" OBS            %d" % nobs) + 3], " %d -1 -1" % (nobs-1))
+
+    def test_mrms_write_DART_ascii(self):
+
+        np.random.seed(0)
+
+        data  = np.random.normal(20., 15., (3, 12, 17))
+        zeros = np.ma.zeros((12, 17))
+        zeros.mask = np.random.random((12, 17)) > 0.3
+
+        ref = Field(field="REFLECTIVITY", data=np.ma.array(data, mask=data < 18.), zg=np.array([1000., 2000., 3000.]),
+                    lats=np.linspace(35., 35.5, 12), lons=np.linspace(-98., -97.5, 17), radar_hgt=0.0,
+                    time=DT.datetime(2020, 5, 1, 12, 0),
+                    zero_dbz=Field(data=zeros, zg=[3000., 7000.], radar_hgt=0.0))
+
+        tmpdir = tempfile.mkdtemp()
+
+        try:
+            # blocks of rows are formatted at a time, the file must not depend on the block size
+
+            files = []
+            for chunk in [dart_tools._write_chunk, 20]:
+                dart_tools._write_chunk = chunk
+                mrms_write_DART_ascii(ref, filename=os.path.join(tmpdir, "rf%d" % chunk), obs_error=[7., 5.],
+                                      levels=range(3), QC_info=[[15., 5.], [20., 1.]], zero_levels=[3000., 7000.])
+                with open(os.path.join(tmpdir, "rf%d.out" % chunk)) as f:  files.append(f.read())
+        finally:
+            dart_tools._write_chunk = 100000
+            shutil.rmtree(tmpdir)
+
+        nobs  = np.sum(data >= 18.) + 2*np.sum(zeros.mask == False)
+        lines = files[0].split("\n")
+
+        self.assertEqual(files[0], files[1])
+        self.assertTrue(" num_obs:       %d  max_num_obs:       %d" % (nobs, nobs) in lines)
+        self.assertEqual(files[0].count(" OBS "), nobs)
+        self.assertEqual(lines[lines.index(" OBS            %d" % nobs) + 3], " %d -1 -1" % (nobs-1))
+
+    def test_write_DART_binary(self):
+
+        np.random.seed(0)
+
+        xg   = -30000. + 3000. * np.arange(21)
+        zg   = np.stack([beam_hgt_grid(xg, xg, 0., 0., e) for e in [0.5, 1.5]])
+        data = np.ma.array(np.random.normal(0., 10., zg.shape), mask=np.random.random(zg.shape) > 0.3)
+
+        vel  = Field(field="velocity", data=data, zg=np.ma.array(zg, mask=data.mask), xg=xg, yg=xg,
+                     lats=np.linspace(35., 35.5, 21), lons=np.linspace(-98., -97.5, 21),
+                     radar_lat=35.25, radar_lon=-97.75, radar_hgt=390., nyquist=np.array([25., 27.]),
+                     time={'units': 'seconds since 2020-05-01T12:00:00Z'}, sweep_time=np.array([10., 25.]))
+
+        tmpdir = tempfile.mkdtemp()
+
+        try:
+            opaws_write_DART_ascii(vel, filename=os.path.join(tmpdir, "vr"), obs_error=[3.], dart_format="binary")
+            with open(os.path.join(tmpdir, "obs_seq_vr.out"), "rb") as f:  buffer = f.read()
+        finally:
+            shutil.rmtree(tmpdir)
+
+        # split the file into its Fortran records, each is framed by its length
+
+        records = []
+        while len(buffer) > 0:
+            n = int(np.frombuffer(buffer[:4], dtype=np.int32)[0])
+            self.assertEqual(buffer[4+n:8+n], buffer[:4])
+            records.append(buffer[4:4+n])
+            buffer = buffer[8+n:]
+
+        nobs = np.sum(data.mask == False)
+
+        self.assertEqual(records[0], b"obs_sequence")
+        self.assertEqual(records[1], b"obs_kind_definitions")
+        self.assertEqual(np.frombuffer(records[4], dtype=np.int32).tolist(), [1, 1, nobs, nobs])
+        self.assertEqual(records[5].strip(), b"observations")
+
+        # 11 records per radial velocity ob, the first ob is the first good gate
+
+        obs = records[8:]
+        k, j, i = [a[0] for a in np.nonzero(data.mask == False)]
+
+        self.assertEqual(len(obs), 11*nobs)
+        self.assertEqual(np.frombuffer(obs[0], dtype=np.float64)[0], data[k,j,i])
+        self.assertEqual(np.frombuffer(obs[2], dtype=np.int32).tolist(), [-1, 2, -1])
+        self.assertEqual(np.frombuffer(obs[-2], dtype=np.int32).tolist()[0], 12*3600 + 25)
+        self.assertEqual(np.frombuffer(obs[-1], dtype=np.float64)[0], 9.)
+
+    def test_merge_DART_obs_seq(self):
+
+        np.random.seed(0)
+
+        xg   = -30000. + 3000. * np.arange(11)
+        zg   = np.stack([beam_hgt_grid(xg, xg, 0., 0., e) for e in [0.5, 1.5]])
+        data = np.ma.array(np.random.normal(0., 10., zg.shape), mask=np.random.random(zg.shape) > 0.3)
+
+        vel  = Field(field="velocity", data=data, zg=np.ma.array(zg, mask=data.mask), xg=xg, yg=xg,
+                     lats=np.linspace(35., 35.5, 11), lons=np.linspace(-98., -97.5, 11),
+                     radar_lat=35.25, radar_lon=-97.75, radar_hgt=390., nyquist=np.array([25., 27.]),
+                     time={'units': 'seconds since 2020-05-01T11:59:00Z'}, sweep_time=np.array([10., 85.]))
+
+        ref  = np.random.normal(20., 15., (2, 11, 11))
+        ref  = Field(field="REFLECTIVITY", data=np.ma.array(ref, mask=ref < 18.), zg=np.array([1000., 2000.]),
+                     lats=np.linspace(35., 35.5, 11), lons=np.linspace(-98., -97.5, 11), radar_hgt=0.0,
+                     time=DT.datetime(2020, 5, 1, 12, 0))
+
+        nvel = np.sum(data.mask == False)
+        nref = np.sum(ref.data.mask == False)
+
+        tmpdir = tempfile.mkdtemp()
+
+        try:
+            merged = {}
+            for dart_format in ["ascii", "binary"]:
+                files = [os.path.join(tmpdir, "%s_%s" % (name, dart_format)) for name in ["vr", "rf"]]
+                opaws_write_DART_ascii(vel, filename=files[0], obs_error=[3.], dart_format=dart_format)
+                mrms_write_DART_ascii(ref, filename=files[1], obs_error=[7.], levels=range(2),
+                                      QC_info=[[15., 5.], [20., 1.]], dart_format=dart_format)
+
+                files[0] = os.path.join(tmpdir, "obs_seq_vr_%s.out" % dart_format)
+                files[1] = files[1] + ".out"
+                merged[dart_format] = os.path.join(tmpdir, "merged_%s" % dart_format)
+
+                # the merged file must not depend on the number of obs read at a time
+
+                for chunk in [None, 7]:
+                    self.assertEqual(merge_DART_obs_seq(files, merged[dart_format], chunk=chunk), nvel + nref)
+                    with open(merged[dart_format], "rb") as f:  merged[(dart_format, chunk)] = f.read()
+
+                self.assertEqual(merged[(dart_format, None)], merged[(dart_format, 7)])
+
+            self.assertRaises(SystemExit, merge_DART_obs_seq, [files[0], os.path.join(tmpdir, "rf_ascii.out")], merged["ascii"])
+        finally:
+            shutil.rmtree(tmpdir)
+
+        text  = merged[("ascii", None)].decode()
+        lines = text.split("\n")
+
+        self.assertTrue(" num_obs:       %d  max_num_obs:       %d" % (nvel+nref, nvel+nref) in lines)
+        self.assertTrue(text.index("RADIAL_VELOCITY") < text.index("RADAR_REFLECTIVITY") < text.index(" OBS "))
+
+        # walk the linked list from the first ob, the obs are visited in time order
+
+        obs   = dict([(int(ob.split("\n")[0]), ob.rstrip().split("\n")) for ob in text.split("\n OBS")[1:]])
+        first = int(lines[[l.startswith("  first:") for l in lines].index(True)].split()[1])
+        seen  = []
+
+        n = first
+        while n != -1:
+            seen.append(n)
+            n = int(obs[n][3].split()[1])
+
+        times = [int(obs[n][-2].split()[0]) + 86400*(int(obs[n][-2].split()[1]) - 153157) for n in seen]
+
+        self.assertEqual(sorted(seen), list(range(1, nvel+nref+1)))
+        self.assertEqual(times, sorted(times))
+        self.assertEqual(times[0], 11*3600 + 59*60 + 10)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import unittest
+import shutil, tempfile
+import numpy as np
+
+from pyproj import Proj
+
+import utils.grid_cache as grid_cache
+
+class TestGridCache(unittest.TestCase):
+
+    def setUp(self):
+
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+
+        shutil.rmtree(self.cache_dir)
+
+    def test_grid_matches_proj(self):
+
+        grid = grid_cache.get_grid('lcc', 35.3, -97.5, 3000., -150000., -150000., 101, 101)
+
+        map  = Proj(proj='lcc', ellps='WGS84', datum='WGS84', lat_1=30.0, lat_2=60.0, lat_0=35.3, lon_0=-97.5)
+        xg   = -150000. + 3000. * np.arange(101)
+        lons, lats = map(xg, xg, inverse=True)
+
+        self.assertTrue(np.array_equal(grid.xg, xg))
+        self.assertTrue(np.array_equal(grid.lons, lons))
+        self.assertTrue(np.array_equal(grid.lats, lats))
+        self.assertEqual(grid.offset(36.0, -96.5), tuple([float(v) for v in map(-96.5, 36.0)]))
+        self.assertTrue(grid_cache.get_grid('lcc', 35.3, -97.5, 3000., -150000., -150000., 101, 101) is grid)
+
+    def test_memory_mapped_grid(self):
+
+        args = ('lcc', 36.1, -95.0, 3000., -450000., -450000., 301, 301)
+        grid = grid_cache.get_grid(*args, cache_dir=self.cache_dir)
+
+        # a new process (empty in-memory cache) maps the grid saved by the first one
+
+        grid_cache._grids.clear()
+        mapped = grid_cache.get_grid(*args, cache_dir=self.cache_dir)
+
+        self.assertTrue(mapped is not grid)
+        self.assertTrue(isinstance(mapped.lats, np.memmap))
+        self.assertTrue(np.array_equal(mapped.lats, grid.lats))
+        self.assertTrue(np.array_equal(mapped.lons, grid.lons))
+
+    def test_offsets_saved_with_grid(self):
+
+        args = ('lcc', 36.1, -95.0, 3000., -150000., -150000., 101, 101)
+        grid = grid_cache.get_grid(*args, cache_dir=self.cache_dir)
+
+        offset = grid.offset(36.0, -96.5)
+        grid.offset(35.3, -97.5)
+
+        # a new process reads the offsets saved by the first one instead of projecting them
+
+        grid_cache._grids.clear()
+        saved = grid_cache.get_grid(*args, cache_dir=self.cache_dir)
+        saved.map = lambda *a, **k: self.fail("offset was projected again")
+
+        self.assertEqual(saved.offset(36.0, -96.5), offset)
+        self.assertEqual(saved.offset(35.3, -97.5), grid.offset(35.3, -97.5))
+
+if __name__ == '__main__':
+    unittest.main()
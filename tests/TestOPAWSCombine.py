@@ -1,7 +1,10 @@
-import unittest, types, sys, os, glob, time
-import xarray as xr
+import unittest, types, sys, os, glob, time, shutil, tempfile
+import numpy as np
 import datetime as DT
 import netCDF4 as ncdf
+from utils.obs_seq_netcdf import open_obs_seq_netcdf, write_obs_seq_netcdf, obs_time
+from pyOPAWS.combine_VR_ncdf import combine_obs_seq_netcdf, watch_obs_seq_netcdf, thin_mask
+from utils.grid_cache import get_proj
 
 class TestOPAWSCombine(unittest.TestCase):
     def test_combine_outputs(self):
@@ -18,40 +21,134 @@ class TestOPAWSCombine(unittest.TestCase):
         tmp         = os.path.basename(files[0])
         netcdf_file = os.path.join(output_dir, "%s%s" % (tmp[0:7], tmp[12:]))
 
-        dataset = []
-        nobs_total = 0
-
         begin_time = time.time()
-            
-        for file in files:
-            try:
-                infile = xr.open_dataset(file)
-                nobs_total = nobs_total + len(infile.index)
-                print("%s has %d observations, total is now %d" % (file, len(infile.index), nobs_total))
-            except:
-                continue
-
-            if len(infile.index) > 0:
-                dataset.append(infile)
-            infile.close()
-                
+
+        nobs_total = combine_obs_seq_netcdf(files, netcdf_file)
+
         end_time = time.time()
 
-        print("\n Reading took {0} seconds since the loop started \n".format(end_time - begin_time))
+        print("\n Combining took {0} seconds \n".format(end_time - begin_time))
 
-        # Create an xarray dataset for file I/O
-        xa = xr.concat(dataset, dim='index')
+        # The combined file has every ob of the radar files
 
-        # Write the xarray file out (this is all there is, very nice guys!)
-        xa.to_netcdf(netcdf_file, mode='w')
+        nobs = 0
+        for file in files:
+            with ncdf.Dataset(file) as fnc:
+                nobs = nobs + len(fnc.dimensions['index'])
+
+        xa = open_obs_seq_netcdf(netcdf_file)
+        self.assertEqual(nobs_total, nobs)
+        self.assertEqual(xa.sizes['index'], nobs)
         xa.close()
 
-        #   Add attributes to the files
-        fnc = ncdf.Dataset(netcdf_file, mode = 'a')
-        fnc.history = "Created " + DT.datetime.today().strftime("%Y%m%d_%H:%M:%S")
+    def test_watch_publishes_at_deadline(self):
+
+        tmpdir = tempfile.mkdtemp()
+        date   = DT.datetime(2020, 3, 2, 22, 0)
+
+        utime, day, second = obs_time(date)
+
+        try:
+            for radar, nobs in (('KTLX', 100), ('KINX', 0)):
+                columns = [('value', np.arange(nobs, dtype=np.float64)), ('error_var', np.full((nobs,), 9.))]
+                write_obs_seq_netcdf(os.path.join(tmpdir, "obs_seq_%s_VR_20200302_2200.nc" % radar), nobs, columns, \
+                                     {'utime': utime, 'day': day, 'second': second}, date=date)
+
+            netcdf_file = os.path.join(tmpdir, "obs_seq_VR_20200302_2200.nc")
+            nobs, included, missing = watch_obs_seq_netcdf(os.path.join(tmpdir, "obs_seq_K*_VR_20200302_2200.nc"), \
+                                                           netcdf_file, 1, radars=['KTLX', 'KINX', 'KVNX'], poll=0.1)
+
+            self.assertEqual((nobs, included, missing), (100, ['KTLX', 'KINX'], ['KVNX']))
+            self.assertFalse(os.path.exists(netcdf_file + ".tmp"))
+
+            with ncdf.Dataset(netcdf_file) as fnc:
+                self.assertEqual(len(fnc.dimensions['index']), 100)
+                self.assertEqual(fnc.radars_included, "KTLX KINX")
+                self.assertEqual(fnc.radars_missing, "KVNX")
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_thin_keeps_closest_radar(self):
+
+        # two radars 30 km apart see the same 3 columns, the middle one at the same range
+
+        i     = np.array([0, 1, 2, 2, 0, 1, 2])
+        k     = np.array([0, 0, 0, 1, 0, 0, 0])
+        radar = np.array([0, 0, 0, 0, 1, 1, 1])
+        rng   = np.array([5., 15., 25., 26., 25., 15., 5.])
+
+        keep = thin_mask(i, np.zeros(7), k, np.zeros(7), radar, rng)
+        self.assertEqual(keep.tolist(), [True, True, False, True, False, False, True])
+
+        # obs of different types are never thinned against each other
+
+        keep = thin_mask(i, np.zeros(7), k, radar, radar, rng)
+        self.assertTrue(np.all(keep))
+
+    def test_combine_thinned(self):
+
+        tmpdir = tempfile.mkdtemp()
+        date   = DT.datetime(2020, 3, 2, 22, 0)
+
+        utime, day, second = obs_time(date)
+
+        # the radars share a row of grid columns between them, 1 ob per column and 2 heights
+
+        lons   = np.repeat(np.linspace(-98., -97., 11), 2)
+        files  = []
+
+        try:
+            for radar, lon in (('KTLX', -98.), ('KINX', -97.)):
+                columns = [('value', np.arange(22.)), ('lat', np.full((22,), 35.)), ('lon', lons), \
+                           ('height', np.tile([1000., 3000.], 11)), ('error_var', np.full((22,), 9.))]
+                files.append(os.path.join(tmpdir, "obs_seq_%s_VR_20200302_2200.nc" % radar))
+                write_obs_seq_netcdf(files[-1], 22, columns, {'utime': utime, 'day': day, 'second': second, \
+                                     'platform_lat': 35., 'platform_lon': lon, 'platform_hgt': 400.}, date=date)
+
+            netcdf_file = os.path.join(tmpdir, "obs_seq_VR_20200302_2200.nc")
+
+            self.assertEqual(combine_obs_seq_netcdf(files, netcdf_file, nprocs=0, thin=(3000., 500., (35., -97.5))), 22)
+
+            with ncdf.Dataset(netcdf_file) as fnc:
+                self.assertEqual(fnc.radars_kept, "KTLX:12/22 KINX:10/22")
+                lon = fnc.variables['platform_lon'][:]
+                self.assertTrue(np.all(lon[fnc.variables['lon'][:] <= -97.5] == -98.))
+                self.assertTrue(np.all(lon[fnc.variables['lon'][:] >  -97.5] == -97.))
+                self.assertEqual(fnc.variables['date'].shape, (22, 128))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_thin_on_model_grid(self):
+
+        tmpdir = tempfile.mkdtemp()
+        date   = DT.datetime(2020, 3, 2, 22, 0)
+        center = (35., -97.5)
+
+        utime, day, second = obs_time(date)
+
+        # obs 1400 m either side of the domain center are in the same model column, obs 1600 m
+        # away are in the next columns (the radars are not centered on the domain)
+
+        map    = get_proj('lcc', center[0], center[1], 30.0, 60.0)
+        files  = []
+
+        try:
+            for radar, lon, x in (('KTLX', -98.5, [-1400., 1600.]), ('KINX', -95.5, [1400., -1600.])):
+                lons, lats = map(np.array(x), np.zeros(2), inverse=True)
+                columns = [('value', np.arange(2.)), ('lat', lats), ('lon', lons), \
+                           ('height', np.full((2,), 1000.)), ('error_var', np.full((2,), 9.))]
+                files.append(os.path.join(tmpdir, "obs_seq_%s_VR_20200302_2200.nc" % radar))
+                write_obs_seq_netcdf(files[-1], 2, columns, {'utime': utime, 'day': day, 'second': second, \
+                                     'platform_lat': 35., 'platform_lon': lon, 'platform_hgt': 400.}, date=date)
+
+            netcdf_file = os.path.join(tmpdir, "obs_seq_VR_20200302_2200.nc")
+
+            self.assertEqual(combine_obs_seq_netcdf(files, netcdf_file, nprocs=0, thin=(3000., 500., center)), 3)
 
-        fnc.sync()  
-        fnc.close()
+            with ncdf.Dataset(netcdf_file) as fnc:
+                self.assertEqual(fnc.radars_kept, "KTLX:2/2 KINX:1/2")
+        finally:
+            shutil.rmtree(tmpdir)
 
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
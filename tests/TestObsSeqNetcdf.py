@@ -0,0 +1,118 @@
+import unittest
+import os, shutil, tempfile
+import datetime as DT
+import numpy as np
+import netCDF4 as ncdf
+
+from utils.obs_seq_netcdf import write_obs_seq_netcdf, open_obs_seq_netcdf, obs_time
+from utils.obs_seq_netcdf import read_obs_seq_netcdf, create_obs_seq_netcdf, append_obs_seq_netcdf
+from pyOPAWS.compress_ncdf import compress_file
+
+class TestObsSeqNetcdf(unittest.TestCase):
+
+    def setUp(self):
+
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, nobs):
+
+        filename = os.path.join(self.tmpdir, "obs_seq_%d.nc" % nobs)
+        date     = DT.datetime(2020, 5, 1, 12, 0, 30)
+
+        utime, day, second = obs_time(date)
+        constants = {'utime': utime, 'day': day, 'second': second, 'platform_lat': 35.3, 'platform_hgt': 390.}
+
+        def columns():
+            yield 'value',     np.arange(nobs, dtype=np.float64) + 0.123456
+            yield 'error_var', np.full((nobs,), 9., dtype=np.float32)
+
+        write_obs_seq_netcdf(filename, nobs, columns(), constants, date=date, version="test")
+
+        return filename
+
+    def test_constants_are_scalars(self):
+
+        with ncdf.Dataset(self.write(5)) as f:
+            self.assertEqual(f.variables['value'].shape, (5,))
+            self.assertEqual(f.variables['platform_lat'].shape, ())
+            self.assertEqual(int(f.variables['second'][...]), 12*3600 + 30)
+            self.assertEqual(f.date, "2020-05-01 12:00:30")
+            self.assertEqual(f.version, "test")
+
+    def test_open_broadcasts_constants(self):
+
+        ds = open_obs_seq_netcdf(self.write(5))
+
+        try:
+            self.assertEqual(ds['platform_hgt'].dims, ('index',))
+            self.assertTrue(np.all(ds['platform_hgt'].values == 390.))
+            self.assertTrue(np.all(ds['date'].values == b"2020-05-01 12:00:30"))
+            self.assertTrue(np.allclose(ds['value'].values, np.arange(5.) + 0.123456, rtol=0., atol=0.01))
+        finally:
+            ds.close()
+
+        ds = open_obs_seq_netcdf(self.write(0))
+        self.assertEqual(ds.sizes['index'], 0)
+        ds.close()
+
+    def test_compressed_and_quantized(self):
+
+        with ncdf.Dataset(self.write(50000)) as f:
+            filters = f.variables['value'].filters()
+            self.assertTrue(filters['zlib'] and filters['shuffle'])
+            self.assertEqual(f.variables['value'].chunking(), [16384])
+            self.assertEqual(f.variables['value'].least_significant_digit, 2)
+            self.assertTrue(f.variables['error_var'].filters()['zlib'])
+            self.assertFalse(hasattr(f.variables['error_var'], 'least_significant_digit'))
+
+    def test_compress_file(self):
+
+        filename = self.write(1000)
+        newfname = os.path.join(self.tmpdir, "compressed.nc")
+
+        with ncdf.Dataset(filename, 'a') as f:
+            f.createDimension('other', 3)
+            f.createVariable('other', 'f8', ('other',))[:] = [1., 2., 3.]
+
+        self.assertTrue(compress_file(filename, newfname, complevel=6).startswith(newfname))
+        self.assertTrue(compress_file(os.path.join(self.tmpdir, "missing.nc"), newfname).startswith("Skipping"))
+
+        with ncdf.Dataset(filename) as f, ncdf.Dataset(newfname) as g:
+            self.assertEqual(f.ncattrs(), g.ncattrs())
+            self.assertEqual(g.variables['value'].filters()['complevel'], 6)
+            self.assertEqual(g.variables['other'].filters()['complevel'], 6)
+            for name in f.variables:
+                self.assertTrue(np.array_equal(f.variables[name][...], g.variables[name][...]))
+
+    def test_append(self):
+
+        filename = os.path.join(self.tmpdir, "combined.nc")
+        counts   = (20000, 0, 5)
+        inputs   = [self.write(n) for n in counts]
+
+        nobs, columns, attributes, gattrs = read_obs_seq_netcdf(inputs[0])
+
+        fnc = create_obs_seq_netcdf(filename, columns, attributes, gattrs)
+        try:
+            self.assertTrue(fnc.dimensions['index'].isunlimited())
+            for file, n in zip(inputs, counts):
+                self.assertEqual(append_obs_seq_netcdf(fnc, read_obs_seq_netcdf(file)[1]), n)
+        finally:
+            fnc.close()
+
+        ds = open_obs_seq_netcdf(filename)
+        try:
+            self.assertEqual(ds.sizes['index'], 20005)
+            self.assertEqual(ds['platform_lat'].dims, ('index',))
+            self.assertTrue(np.all(ds['date'].values == b"2020-05-01 12:00:30"))
+            self.assertTrue(np.allclose(ds['value'].values[20000:], np.arange(5.) + 0.123456, rtol=0., atol=0.01))
+            self.assertEqual(ds['utime'].values[0], np.datetime64('2020-05-01T12:00:30'))
+        finally:
+            ds.close()
+
+if __name__ == '__main__':
+    unittest.main()
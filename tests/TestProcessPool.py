@@ -0,0 +1,34 @@
+import unittest
+import numpy as np
+
+from utils.process_pool import shared_array, map_processes
+
+class TestProcessPool(unittest.TestCase):
+
+    def test_workers_write_shared_arrays(self):
+
+        grid = shared_array((6, 4, 5))
+        mask = shared_array((6, 4, 5), bool, True)
+
+        def grid_sweep(n):
+            grid[n] = n + np.arange(20.).reshape(4, 5)
+            mask[n] = grid[n] < 10.
+            return n*n
+
+        for nprocs in [1, 3]:
+            grid[...] = 0.
+            mask[...] = True
+
+            self.assertEqual(map_processes(grid_sweep, range(6), nprocs), [n*n for n in range(6)])
+
+            for n in range(6):
+                self.assertTrue(np.array_equal(grid[n], n + np.arange(20.).reshape(4, 5)))
+                self.assertTrue(np.array_equal(mask[n], grid[n] < 10.))
+
+    def test_empty(self):
+
+        self.assertEqual(shared_array((0, 4, 5)).shape, (0, 4, 5))
+        self.assertEqual(map_processes(lambda n: n, [], 4), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import unittest
+import os, shutil, tempfile
+import numpy as np
+import netCDF4 as ncdf
+
+import utils.subdomain_cache as subdomain_cache
+
+class TestSubdomainCache(unittest.TestCase):
+
+    def setUp(self):
+
+        self.cache_dir = tempfile.mkdtemp()
+        self.filename  = os.path.join(self.cache_dir, "mrms.netcdf")
+
+        with ncdf.Dataset(self.filename, 'w') as f:
+            f.createDimension('Lat', 50)
+            f.createDimension('Lon', 80)
+            f.Latitude, f.Longitude, f.LatGridSpacing, f.LonGridSpacing = 40., -100., 0.01, 0.01
+
+        self.builds = 0
+
+    def tearDown(self):
+
+        subdomain_cache._subdomains.clear()
+        shutil.rmtree(self.cache_dir)
+
+    def build(self):
+
+        self.builds = self.builds + 1
+
+        return subdomain_cache.Subdomain(10, 30, 5, 25, 40. - 0.01*np.arange(5, 25), -100. + 0.01*np.arange(10, 30))
+
+    def test_window_is_built_once(self):
+
+        with ncdf.Dataset(self.filename) as f:
+            signature = subdomain_cache.grid_signature(f)
+
+        self.assertEqual(signature, (50, 80, 40., -100., 0.01, 0.01))
+
+        window = subdomain_cache.get_subdomain(signature, (39.9, -99.8), 20, 20, self.build, cache_dir=self.cache_dir)
+
+        self.assertTrue(subdomain_cache.get_subdomain(signature, (39.9, -99.8), 20, 20, self.build) is window)
+        self.assertEqual(self.builds, 1)
+
+        # a new process reads the window saved by the first one, another center is built again
+
+        subdomain_cache._subdomains.clear()
+        saved = subdomain_cache.get_subdomain(signature, (39.9, -99.8), 20, 20, self.build, cache_dir=self.cache_dir)
+
+        self.assertTrue(saved is not window)
+        self.assertEqual((saved.i0, saved.i1, saved.j0, saved.j1), (10, 30, 5, 25))
+        self.assertTrue(np.array_equal(saved.lats, window.lats))
+        self.assertTrue(np.array_equal(saved.lons, window.lons))
+        self.assertEqual(self.builds, 1)
+
+        subdomain_cache.get_subdomain(signature, (39.8, -99.8), 20, 20, self.build, cache_dir=self.cache_dir)
+        self.assertEqual(self.builds, 2)
+
+    def test_signature_without_attributes(self):
+
+        # without the grid attributes the grid is known by a hash of the Lat/Lon vectors
+
+        filename = os.path.join(self.cache_dir, "latlon.netcdf")
+
+        with ncdf.Dataset(filename, 'w') as f:
+            f.createDimension('Lat', 50)
+            f.createDimension('Lon', 80)
+            f.createVariable('Lat', 'f4', ('Lat',))[:] = 40. - 0.01*np.arange(50)
+            f.createVariable('Lon', 'f4', ('Lon',))[:] = -100. + 0.01*np.arange(80)
+
+        with ncdf.Dataset(filename) as f:
+            signature = subdomain_cache.grid_signature(f)
+
+        self.assertEqual(signature[0:2], (50, 80))
+        self.assertEqual(len(signature), 3)
+
+        with ncdf.Dataset(filename, 'a') as f:
+            f.variables['Lon'][0] = -101.
+
+        with ncdf.Dataset(filename) as f:
+            self.assertNotEqual(subdomain_cache.grid_signature(f), signature)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+import unittest
+import numpy as np
+
+from utils.superob import obs_2_grid2d, obs_2_grid2d_binned, superob_weights, active_window, in_reach, \
+                          _fortran_obs_2_grid2d
+
+class TestSuperob(unittest.TestCase):
+
+    def setUp(self):
+
+        np.random.seed(0)
+
+        self.dx = 3000.
+        self.xg = -150000. + self.dx * np.arange(101)
+        self.yg = -165000. + self.dx * np.arange(111)
+
+        nobs = 50000
+        self.xob = np.random.uniform(-160000., 160000., nobs)
+        self.yob = np.random.uniform(-175000., 175000., nobs)
+        self.obs = np.random.normal(20., 10., nobs)
+
+        self.ix = np.searchsorted(self.xg, self.xob)
+        self.iy = np.searchsorted(self.yg, self.yob)
+
+    def test_constant_field(self):
+
+        obs = np.full(self.obs.shape, 35.)
+
+        for method in [1, 2]:
+            field = obs_2_grid2d(obs, self.xob, self.yob, self.xg, self.yg, self.ix, self.iy, \
+                                 method, 3, 0.2, 0., 2.0*self.dx, -99999.)
+            self.assertEqual(field.shape, (self.yg.size, self.xg.size))
+            self.assertTrue(np.allclose(field[field > -99999.], 35.))
+
+    def test_min_count(self):
+
+        obs = self.obs[:20]
+        field = obs_2_grid2d(obs, self.xob[:20], self.yob[:20], self.xg, self.yg, self.ix[:20], self.iy[:20], \
+                             1, 10000, 0.2, 0., 2.0*self.dx, -99999.)
+        self.assertTrue(np.all(field == -99999.))
+
+    def test_binned_matches_exact_for_smooth_field(self):
+
+        obs = 30. + 20.*np.sin(self.xob/40000.)*np.cos(self.yob/25000.)
+
+        for method in [1, 2]:
+            args  = (obs, self.xob, self.yob, self.xg, self.yg, self.ix, self.iy, \
+                     method, 3, 0.2, 0., 2.0*self.dx, -99999.)
+            exact  = obs_2_grid2d(*args)
+            binned = obs_2_grid2d_binned(*args)
+            valid  = (exact > -99999.) & (binned > -99999.)
+            self.assertTrue(valid.sum() > 0.95*exact.size)
+            self.assertTrue(np.abs(exact - binned)[valid].max() < 1.0)
+
+    def test_active_window(self):
+
+        # radar 100 km off the east edge of the grid, 150 km of gates
+
+        xr, yr = 250000., 0.
+        rng = np.random.uniform(0., 150000., 20000)
+        az  = np.random.uniform(0., 2.*np.pi, 20000)
+        xob, yob = xr + rng*np.sin(az), yr + rng*np.cos(az)
+        obs = np.random.normal(20., 10., 20000)
+
+        ix, iy = np.searchsorted(self.xg, xob), np.searchsorted(self.yg, yob)
+        full   = obs_2_grid2d(obs, xob, yob, self.xg, self.yg, ix, iy, 1, 3, 0.2, 0., 2.0*self.dx, -99999.)
+
+        rows, cols = active_window(self.xg, self.yg, xr, yr, 150000., 1, 2.0*self.dx)
+        xs, ys = self.xg[cols], self.yg[rows]
+        self.assertTrue(xs.size < self.xg.size)
+
+        ix, iy = np.searchsorted(xs, xob), np.searchsorted(ys, yob)
+        keep   = in_reach(xob, yob, xs, ys, 1, 2.0*self.dx)
+        self.assertTrue(0 < keep.sum() < keep.size)
+        window = np.full(full.shape, -99999.)
+        window[rows, cols] = obs_2_grid2d(obs[keep], xob[keep], yob[keep], xs, ys, ix[keep], iy[keep], \
+                                          1, 3, 0.2, 0., 2.0*self.dx, -99999.)
+
+        self.assertTrue(np.array_equal(full, window))
+        self.assertTrue(active_window(self.xg, self.yg, 900000., 0., 150000., 1, 2.0*self.dx) is None)
+
+    def test_in_reach(self):
+
+        # gates far off each side of the grid are dropped, gates just outside the grid are kept
+
+        xob = np.array([-1.0e6, 2.0e6, 0., 0., 153000., -156000., 0.])
+        yob = np.array([0., 0., 3.0e6, -1.0e6, 0., 0., 170000.])
+
+        for method in [1, 2]:
+            keep = in_reach(xob, yob, self.xg, self.yg, method, 2.0*self.dx)
+            self.assertEqual(keep.tolist(), [False, False, False, False, True, True, True])
+
+        # the gates out of reach only get empty columns in the weights
+
+        xob, yob = np.concatenate((self.xob, xob)), np.concatenate((self.yob, yob))
+        ix, iy   = np.searchsorted(self.xg, xob), np.searchsorted(self.yg, yob)
+        weights  = superob_weights(xob, yob, self.xg, self.yg, ix, iy, 1, 0., 2.0*self.dx)
+        keep     = in_reach(xob, yob, self.xg, self.yg, 1, 2.0*self.dx)
+
+        self.assertEqual(weights.shape[1], xob.size)
+        self.assertEqual(weights.getnnz(axis=0)[keep == False].sum(), 0)
+
+    @unittest.skipIf(_fortran_obs_2_grid2d is None, "utils/cressman has not been compiled")
+    def test_matches_fortran(self):
+
+        for method in [1, 2]:
+            args = (self.obs, self.xob, self.yob, self.xg, self.yg, self.ix, self.iy, \
+                    method, 3, 0.2, 10000., 2.0*self.dx, -99999.)
+            self.assertTrue(np.allclose(obs_2_grid2d(*args), _fortran_obs_2_grid2d(*args), rtol=0., atol=1.0e-8))
+
+if __name__ == '__main__':
+    unittest.main()
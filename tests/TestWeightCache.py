@@ -0,0 +1,119 @@
+import unittest
+import shutil, tempfile
+import numpy as np
+
+from utils.superob import obs_2_grid2d, superob_weights, apply_superob_weights
+from utils.weight_cache import WeightCache
+
+class TestWeightCache(unittest.TestCase):
+
+    def setUp(self):
+
+        self.cache_dir = tempfile.mkdtemp()
+
+        self.dx = 3000.
+        self.xg = -90000. + self.dx * np.arange(61)
+        self.yg = -90000. + self.dx * np.arange(61)
+
+        # polar gates:  360 rays x 400 gates of 250 m
+
+        self.azimuth   = 0.5 + np.arange(360.)
+        self.elevation = np.full((360,), 0.5)
+        self.x, self.y = self.gates(self.azimuth, self.elevation)
+
+        np.random.seed(0)
+        self.data  = np.random.normal(20., 10., self.x.shape)
+        self.valid = np.random.random(self.x.shape) > 0.5
+
+    def tearDown(self):
+
+        shutil.rmtree(self.cache_dir)
+
+    def gates(self, azimuth, elevation):
+
+        rng = 250. * np.arange(400)[np.newaxis,:] * np.cos(np.deg2rad(elevation))[:,np.newaxis]
+
+        return rng * np.sin(np.deg2rad(azimuth))[:,np.newaxis], rng * np.cos(np.deg2rad(azimuth))[:,np.newaxis]
+
+    def build(self, x=None, y=None):
+
+        x = self.x if x is None else x
+        y = self.y if y is None else y
+
+        return superob_weights(x, y, self.xg, self.yg, np.searchsorted(self.xg, x.ravel()), \
+                               np.searchsorted(self.yg, y.ravel()), 1, 0., 2.0*self.dx)
+
+    def analysis(self, data, valid):
+
+        return obs_2_grid2d(data[valid], self.x[valid], self.y[valid], self.xg, self.yg, \
+                            np.searchsorted(self.xg, self.x[valid]), np.searchsorted(self.yg, self.y[valid]), \
+                            1, 3, 0.2, 0., 2.0*self.dx, -99999.)
+
+    def test_disk_cache_and_ray_order(self):
+
+        key = ('KTST', '212', 0)
+
+        weights, order = WeightCache(cache_dir=self.cache_dir).get(key, self.azimuth, self.elevation, self.build)
+
+        # a new cache (new job) reads the weights from disk; the next sweep starts 90 rays later
+
+        shift   = np.roll(np.arange(360), -90)
+        weights, order = WeightCache(cache_dir=self.cache_dir).get(key, self.azimuth[shift], self.elevation[shift], \
+                                                                    lambda: self.fail("weights were rebuilt"))
+
+        field = apply_superob_weights(weights, self.data[shift][order], self.valid[shift][order], \
+                                      self.yg.size, self.xg.size, 3, 0.2, -99999.)
+
+        self.assertTrue(np.allclose(field, self.analysis(self.data, self.valid), rtol=0., atol=1.0e-8))
+
+    def test_azimuth_mismatch_rebuilds(self):
+
+        cache = WeightCache()
+        cache.get(('KTST', '212', 0), self.azimuth, self.elevation, self.build)
+
+        self.rebuilt = 0
+        def build():
+            self.rebuilt = self.rebuilt + 1
+            return self.build()
+
+        cache.get(('KTST', '212', 0), self.azimuth + 0.5, self.elevation, build)
+        self.assertEqual(self.rebuilt, 1)
+
+        # the elevation of the rays is checked as well
+
+        cache.get(('KTST', '212', 0), self.azimuth + 0.5, self.elevation + 0.5, build)
+        self.assertEqual(self.rebuilt, 2)
+
+    def test_error_within_tolerance(self):
+
+        # Cached weights are re-applied to rays that are up to 0.1 deg off in azimuth and
+        # elevation.  Against weights built fresh for those rays, the analysis of a smooth
+        # field (gradient <= 1.5 dBZ/km) is off by < 0.2 dBZ (the gates move <= 175 m).
+
+        def field(x, y):
+            return 20. + 30. * np.sin(x / 20000.) * np.cos(y / 15000.)
+
+        cache = WeightCache()
+
+        for tilt in [0.5, 10.0, 19.5]:
+
+            elevation = np.full((360,), tilt)
+            cache.get(('KTST', '212', tilt), self.azimuth, elevation, \
+                      lambda: self.build(*self.gates(self.azimuth, elevation)))
+
+            azimuth    = self.azimuth + np.random.uniform(-0.1, 0.1, 360)
+            elevation  = elevation    + np.random.uniform(-0.1, 0.1, 360)
+            x, y       = self.gates(azimuth, elevation)
+            valid      = np.full(x.shape, True)
+
+            weights, order = cache.get(('KTST', '212', tilt), azimuth, elevation, \
+                                       lambda: self.fail("weights were rebuilt"))
+
+            cached = apply_superob_weights(weights, field(x, y)[order], valid, self.yg.size, self.xg.size, 3, 0.2, -99999.)
+            fresh  = apply_superob_weights(self.build(x, y), field(x, y), valid, self.yg.size, self.xg.size, 3, 0.2, -99999.)
+
+            self.assertTrue(np.array_equal(cached == -99999., fresh == -99999.))
+            self.assertTrue(np.abs(cached - fresh).max() < 0.2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+#############################################################
+# bench_dart_tools:  throughput (obs/sec) of the DART       #
+#                    writers in utils/dart_tools.py.        #
+#                                                           #
+#    python -m utils.bench_dart_tools --nx 500 --ny 500     #
+#                                                           #
+#    Synthetic MRMS reflectivity cubes (with zero layers)   #
+#    and OPAWS radial velocity sweeps are written to a      #
+#    temporary directory and the best of --repeat runs is   #
+#    reported.                                              #
+#############################################################
+from __future__ import print_function
+
+import os
+import sys
+import shutil
+import tempfile
+import time as timeit
+import datetime as DT
+
+import numpy as np
+from optparse import OptionParser
+
+import utils.dart_tools as dart_tools
+from utils.dart_tools import beam_hgt_grid, mrms_write_DART_ascii, opaws_write_DART_ascii
+
+class Field(object):
+
+    def __init__(self, **kwargs):
+        for key in kwargs:  setattr(self, key, kwargs[key])
+
+########################################################################
+
+def mrms_field(nx, ny, nz, coverage):
+
+    data  = np.random.normal(20., 15., (nz, ny, nx))
+    zeros = np.ma.zeros((ny, nx))
+    zeros.mask = np.random.random((ny, nx)) > coverage
+
+    ref = Field(field='REFLECTIVITY', data=np.ma.array(data, mask=data < 18.),
+                zg=np.linspace(500., 10000., nz), radar_hgt=0.0,
+                lats=np.linspace(30., 40., ny), lons=np.linspace(-105., -90., nx),
+                time=DT.datetime(2020, 5, 1, 12, 0))
+
+    ref.zero_dbz = Field(data=zeros, zg=[3000., 7000.], radar_hgt=0.0)
+
+    return ref
+
+def opaws_field(nx, ny, nz, coverage):
+
+    xg   = 3000. * (np.arange(nx) - nx//2)
+    yg   = 3000. * (np.arange(ny) - ny//2)
+    zg   = np.stack([beam_hgt_grid(xg, yg, 0., 0., e) for e in np.linspace(0.5, 19.5, nz)])
+    data = np.random.normal(0., 10., zg.shape)
+    mask = np.random.random(zg.shape) > coverage
+
+    return Field(field='velocity', data=np.ma.array(data, mask=mask), zg=np.ma.array(zg, mask=mask),
+                 xg=xg, yg=yg, lats=np.linspace(33., 37., ny), lons=np.linspace(-100., -95., nx),
+                 radar_lat=35., radar_lon=-97.5, radar_hgt=390., nyquist=np.full(nz, 25.),
+                 time={'units': 'seconds since 2020-05-01T12:00:00Z'}, sweep_time=np.arange(nz)*20.)
+
+########################################################################
+
+def bench(name, writer, nobs, repeat):
+
+    best = None
+    for n in range(repeat):
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        try:
+            tic = timeit.time()
+            filename = writer()
+            toc = timeit.time() - tic
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        best = toc if best is None else min(best, toc)
+
+    print(" %-24s %10d obs  %8.3f sec  %12.0f obs/sec  %8.1f MB" % \
+          (name, nobs, best, nobs/best, os.path.getsize(filename)/1.0e6))
+
+########################################################################
+
+if __name__ == "__main__":
+    parser = OptionParser()
+
+    parser.add_option(      "--nx",       dest="nx",       default=300,  type="int",   \
+                                          help = "Number of grid points in x")
+
+    parser.add_option(      "--ny",       dest="ny",       default=300,  type="int",   \
+                                          help = "Number of grid points in y")
+
+    parser.add_option(      "--nz",       dest="nz",       default=13,   type="int",   \
+                                          help = "Number of MRMS levels / OPAWS tilts")
+
+    parser.add_option(      "--coverage", dest="coverage", default=0.3,  type="float", \
+                                          help = "Fraction of OPAWS gates and MRMS columns with data")
+
+    parser.add_option(      "--chunk",    dest="chunk",    default=dart_tools._write_chunk, type="int", \
+                                          help = "Number of obs formatted per block")
+
+    parser.add_option(      "--dart_format", dest="dart_format", default="ascii", type="string", \
+                                          help = "Format of the DART obs_seq files:  ascii or binary")
+
+    parser.add_option(      "--repeat",   dest="repeat",   default=3,    type="int",   \
+                                          help = "Number of times each writer is run, the best time is reported")
+
+    (options, args) = parser.parse_args()
+
+    np.random.seed(0)
+    dart_tools._write_chunk = options.chunk
+
+    ref = mrms_field(options.nx, options.ny, options.nz, options.coverage)
+    vel = opaws_field(options.nx, options.ny, options.nz, options.coverage)
+
+    tmpdir = tempfile.mkdtemp()
+
+    print("\n bench_dart_tools:  %d x %d x %d grid, %d obs per block, %s files\n" % \
+          (options.nz, options.ny, options.nx, options.chunk, options.dart_format))
+
+    def mrms_writer():
+        mrms_write_DART_ascii(ref, filename=os.path.join(tmpdir, "obs_seq_RF"), obs_error=[7.0, 5.0],
+                              levels=range(options.nz), QC_info=[[15., 5.], [20., 1.]], zero_levels=[3000., 7000.],
+                              dart_format=options.dart_format)
+        return os.path.join(tmpdir, "obs_seq_RF.out")
+
+    def opaws_writer():
+        opaws_write_DART_ascii(vel, filename=os.path.join(tmpdir, "VR"), obs_error=[3.0], dart_format=options.dart_format)
+        return os.path.join(tmpdir, "obs_seq_VR.out")
+
+    try:
+        bench("mrms_write_DART_ascii",  mrms_writer,  np.sum(~ref.data.mask) + 2*np.sum(~ref.zero_dbz.data.mask), \
+              options.repeat)
+        bench("opaws_write_DART_ascii", opaws_writer, np.sum(~vel.data.mask), options.repeat)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print("")
@@ -0,0 +1,255 @@
+from __future__ import print_function
+
+#############################################################
+#
+# Time-indexed catalogs of the radar feed directories:  the
+# files of one directory (a radar, product or tilt) sorted by
+# the time in their names, so the file closest to a time is
+# found with a binary search.
+#
+# A directory is listed again only when its mtime changes,
+# and only the names not seen before are parsed.  If a cache
+# directory is set (settings.default_catalog) the catalogs
+# are also kept there, so the next job (or cycle) starts from
+# the last listing instead of parsing a full day of names.
+#
+#############################################################
+import os
+import time
+import bisect
+import calendar
+import hashlib
+import threading
+import datetime as DT
+
+import numpy as np
+
+from Config import settings
+
+# The time in the file names (YYYYMMDD?HHMMSS):  offset in the name and date/time separator
+
+_name_formats = {
+                 'nexrad':     (4, '_'),    # AWS level-II:  KTLX20200302_220012_V06
+                 'nexrad_ldm': (5, '_'),    # LDM level-II
+                 'mrms':       (0, '-'),    # MRMS and RASS tilts:  20200303-060030.netcdf
+                }
+
+# The mtime of a directory modified less than _mtime_slack seconds before it was listed is not
+# kept (a file written in the same mtime tick would be missed), it is listed again next time
+
+_mtime_slack = 2.0
+
+_cache_dir   = settings.default_catalog or None
+
+########################################################################
+
+def to_seconds(date):
+    """
+        Returns the (integer) seconds since 1970-01-01 of the datetime date
+    """
+
+    return calendar.timegm(date.timetuple())
+
+def parse_time(name, name_format):
+    """
+        Returns the time (seconds since 1970) in the file name, or None if the name has none
+    """
+
+    i0, sep = _name_formats[name_format]
+    stamp   = name[i0:i0+15]
+
+    if len(stamp) != 15 or stamp[8] != sep or not (stamp[0:8] + stamp[9:15]).isdigit():
+        return None
+
+    try:
+        return to_seconds(DT.datetime(int(stamp[0:4]), int(stamp[4:6]),   int(stamp[6:8]), \
+                                      int(stamp[9:11]), int(stamp[11:13]), int(stamp[13:15])))
+    except ValueError:
+        return None
+
+########################################################################
+
+class FileCatalog(object):
+    """
+        The files of a directory sorted by the time in their names (see _name_formats).  The
+        queries return full paths, each query first refreshes the catalog if the directory
+        has changed.
+    """
+
+    def __init__(self, directory, name_format, cache_dir=None):
+
+        self.directory   = directory
+        self.name_format = name_format
+        self.cache_dir   = cache_dir
+        self.times       = []
+        self.names       = []
+        self.mtime       = None
+
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """
+            Lists the directory again if its mtime has changed, returns True if it was listed
+        """
+
+        try:
+            mtime = os.stat(self.directory).st_mtime_ns
+        except OSError:
+            mtime = None
+
+        if mtime is not None and mtime == self.mtime:
+            return False
+
+        listed = time.time()
+
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            names = []
+
+        known   = dict(zip(self.names, self.times))
+        entries = []
+
+        for name in names:
+            seconds = known.get(name)
+            if seconds is None:
+                seconds = parse_time(name, self.name_format)
+            if seconds is not None:
+                entries.append((seconds, name))
+
+        entries.sort()
+
+        self.times = [e[0] for e in entries]
+        self.names = [e[1] for e in entries]
+        self.mtime = mtime if mtime is not None and mtime < 1.0e9*(listed - _mtime_slack) else None
+
+        if self.cache_dir:
+            _save(self)
+
+        return True
+
+    def _range(self, start, stop):
+
+        lo = 0               if start is None else bisect.bisect_left(self.times, to_seconds(start))
+        hi = len(self.times) if stop  is None else bisect.bisect_left(self.times, to_seconds(stop))
+
+        return lo, hi
+
+    def between(self, start=None, stop=None):
+        """
+            Returns the files with start <= time < stop, in time order
+        """
+
+        with self._lock:
+            self.refresh()
+            lo, hi = self._range(start, stop)
+            return [os.path.join(self.directory, name) for name in self.names[lo:hi]]
+
+    def first(self, start=None, stop=None):
+        """
+            Returns the earliest file with start <= time < stop, or None
+        """
+
+        with self._lock:
+            self.refresh()
+            lo, hi = self._range(start, stop)
+            return os.path.join(self.directory, self.names[lo]) if lo < hi else None
+
+    def closest(self, date, start=None, stop=None, max_dt=None):
+        """
+            Returns the file closest in time to date (the earlier one of a tie), only the files
+            with start <= time < stop and at most max_dt seconds from date are searched.
+            Returns None if there is none.
+        """
+
+        with self._lock:
+            self.refresh()
+
+            lo, hi  = self._range(start, stop)
+            seconds = to_seconds(date)
+            i       = min(max(bisect.bisect_left(self.times, seconds, lo, hi), lo), hi)
+
+            candidates = []
+            if i > lo:
+                candidates.append(bisect.bisect_left(self.times, self.times[i-1], lo, hi))
+            if i < hi:
+                candidates.append(i)
+
+            if len(candidates) == 0:
+                return None
+
+            n = min(candidates, key = lambda n: (abs(self.times[n] - seconds), self.times[n]))
+
+            if max_dt is not None and abs(self.times[n] - seconds) > max_dt:
+                return None
+
+            return os.path.join(self.directory, self.names[n])
+
+########################################################################
+#
+# Catalogs on disk:  one .npz file per directory and name format
+
+def _filename(cache_dir, key):
+
+    name = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+    return os.path.join(cache_dir, "catalog_%s.npz" % name)
+
+def _load(catalog):
+
+    filename = _filename(catalog.cache_dir, (catalog.directory, catalog.name_format))
+
+    if not os.path.exists(filename):
+        return
+
+    try:
+        with np.load(filename) as f:
+            catalog.times = f['times'].tolist()
+            catalog.names = f['names'].tolist()
+            catalog.mtime = int(f['mtime']) if int(f['mtime']) >= 0 else None
+    except Exception as e:
+        print("\n CATALOG:  Cannot read %s:  %s\n" % (filename, str(e)))
+        catalog.times, catalog.names, catalog.mtime = [], [], None
+
+def _save(catalog):
+
+    filename = _filename(catalog.cache_dir, (catalog.directory, catalog.name_format))
+    tmpfile  = "%s.%d.%d.tmp" % (filename, os.getpid(), threading.get_ident())
+
+    try:
+        if not os.path.isdir(catalog.cache_dir):
+            os.makedirs(catalog.cache_dir)
+        with open(tmpfile, 'wb') as f:
+            np.savez(f, times=np.array(catalog.times, dtype=np.int64), names=np.array(catalog.names, dtype=str), \
+                     mtime=np.int64(-1 if catalog.mtime is None else catalog.mtime))
+        os.replace(tmpfile, filename)
+    except Exception as e:
+        print("\n CATALOG:  Cannot write %s:  %s\n" % (filename, str(e)))
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+
+########################################################################
+
+_catalogs      = {}
+_catalogs_lock = threading.Lock()
+
+def get_catalog(directory, name_format, cache_dir=None):
+    """
+        Returns the (shared) FileCatalog of directory, name_format is a key of _name_formats.
+        The catalog is kept in cache_dir (default settings.default_catalog, None = in memory
+        only).
+    """
+
+    directory = os.path.abspath(directory)
+    cache_dir = cache_dir or _cache_dir
+    key       = (directory, name_format)
+
+    with _catalogs_lock:
+        catalog = _catalogs.get(key)
+        if catalog is None:
+            catalog = FileCatalog(directory, name_format, cache_dir=cache_dir)
+            if cache_dir:
+                _load(catalog)
+            _catalogs[key] = catalog
+
+    return catalog
@@ -164,6 +164,8 @@ SUBROUTINE OBS_2_GRID2D(obs, xob, yob, xc, yc, ii, jj, method, min_count, min_we
   real(kind=4),    INTENT(IN)  :: min_weight, min_range
   INTEGER(kind=8), INTENT(IN)  :: min_count, method
 
+!f2py threadsafe
+
 
 ! Local variables
 
@@ -5,11 +5,14 @@ from __future__ import print_function
 # Create for NEWSe processing
 #
 #############################################################
+import io
 import os
 import sys
 import glob
 import time as timeit
 import datetime as DT
+import threading
+import collections
 import numpy as np
 import netCDF4 as ncdf
 
@@ -23,6 +26,11 @@ _write_grid_indices = False
 
 _zero_dbz_obtype = True
 
+# Format of the obs_seq files:  "ascii", or "binary" for DART's unformatted obs sequence
+# (Fortran sequential-unformatted records, written with the native byte order)
+
+_dart_format = "ascii"
+
 
 #=========================================================================================
 # DART obs definitions (handy for writing out DART files)
@@ -142,7 +150,7 @@ def beam_elv(sfc_range, z):
 ########################################################################
 #
 #     INPUT:
-#       sfc_range:    Distance (meters) along ground from radar 
+#       sfc_range:    Distance (meters) along ground from radar (scalar or array)
 #       z        :    Height above radar
 #
 #     OUTPUT
@@ -154,6 +162,16 @@ def beam_elv(sfc_range, z):
    eighthre=(8.*eradius/3.)
    fthsq=(frthrde*frthrde)
 
+   if np.ndim(sfc_range) > 0:      # arrays of ranges and heights
+       sfc_range = np.asarray(sfc_range, dtype=np.float64)
+       hgtdb = frthrde + z
+       rngdb = sfc_range/frthrde
+
+       with np.errstate(divide='ignore', invalid='ignore'):
+           elvrad = np.arctan((hgtdb*np.cos(rngdb) - frthrde)/(hgtdb * np.sin(rngdb)))
+
+       return np.where(sfc_range > 0.0, np.rad2deg(elvrad), -999.)
+
    if sfc_range > 0.0:
        hgtdb = frthrde + z
        rngdb = sfc_range/frthrde
@@ -166,7 +184,203 @@ def beam_elv(sfc_range, z):
        return -999.
 
 
-def opaws_write_DART_ascii(obs, filename=None, obs_error=None, zero_dbz_obtype=True, grid_dict=None):
+def beam_hgt(sfc_range, elvang):
+
+########################################################################
+#
+#     PURPOSE:
+#
+#     Calculate the height above the radar of a radar beam with
+#     elevation angle elvang at the given along-ground distance.
+#     This is the inverse of beam_elv (same 4/3 earth radius beam
+#     model) and works on arrays of ranges.
+#
+########################################################################
+#
+#     INPUT:
+#       sfc_range:    Distance (meters) along ground from radar
+#       elvang   :    Elevation angle (degrees) of radar beam
+#
+#     OUTPUT
+#       z        :    Height (meters) above radar
+#
+########################################################################
+   eradius=6371000.
+   frthrde=(4.*eradius/3.)
+
+   elvrad = np.deg2rad(elvang)
+   rngdb  = np.asarray(sfc_range, dtype=np.float64)/frthrde
+
+   return frthrde*np.cos(elvrad)/np.cos(elvrad + rngdb) - frthrde
+
+# Beam heights on the analysis grid, one entry per (grid, radar location, elevation)
+
+_beam_hgt_cache = collections.OrderedDict()
+_beam_hgt_lock  = threading.Lock()
+
+def beam_hgt_grid(xg, yg, xoffset, yoffset, elvang, max_entries=128):
+
+########################################################################
+#
+#     PURPOSE:
+#
+#     Height above the radar (meters, >= 0) of the beam with elevation
+#     angle elvang at every point of the 2D grid (xg, yg) for a radar
+#     located at (xoffset, yoffset).  Results are cached per elevation
+#     (to 0.01 deg) since the same tilts repeat every volume.
+#
+########################################################################
+
+   key = (round(float(elvang), 2), float(xg[0]), float(yg[0]), float(xg[-1]), float(yg[-1]),
+          len(xg), len(yg), round(float(xoffset), 1), round(float(yoffset), 1))
+
+   with _beam_hgt_lock:
+       if key in _beam_hgt_cache:
+           _beam_hgt_cache.move_to_end(key)
+           return _beam_hgt_cache[key]
+
+   sfc_range = np.sqrt((xg[np.newaxis,:] - xoffset)**2 + (yg[:,np.newaxis] - yoffset)**2)
+
+   zgrid = np.clip(beam_hgt(sfc_range, key[0]), 0.0, None)
+   zgrid.flags.writeable = False
+
+   with _beam_hgt_lock:
+       _beam_hgt_cache[key] = zgrid
+       while len(_beam_hgt_cache) > max_entries:
+           _beam_hgt_cache.popitem(last=False)
+
+   return zgrid
+
+
+########################################################################
+#
+# Helpers for the DART ascii writers:  the header is written first (the obs count is
+# known from the mask), then the obs are formatted _write_chunk at a time
+
+_write_chunk = 100000
+
+def _header_kinds(field, clearair):
+
+    # Deal with case that for reflectivity, 2 types of observations might have been created
+
+    kinds = [ObType_LookUp(field.upper(), DART_name=True)]
+    if clearair:
+        kinds.append(ObType_LookUp("RADAR_CLEARAIR_REFLECTIVITY", DART_name=True))
+
+    return kinds
+
+def _write_DART_sequence_header(fi, kinds, nobs, first=1, last=None, copies=["observations"], qcs=["QC radar"]):
+
+    fi.write(" obs_sequence\n")
+    fi.write("obs_kind_definitions\n")
+
+    fi.write("       %d\n" % len(kinds))
+    for akind, DART_name in kinds:
+        fi.write("    %d          %s   \n" % (akind, DART_name) )
+
+    fi.write("  num_copies:            %d  num_qc:            %d\n" % (len(copies), len(qcs)))
+    
+    fi.write(" num_obs:       %d  max_num_obs:       %d\n" % (nobs, nobs) )
+        
+    for name in copies + qcs:
+        fi.write("%s\n" % name)
+            
+    fi.write("  first:            %d  last:       %d\n" % (first, nobs if last is None else last) )
+
+def _write_DART_header(fi, field, nobs, clearair):
+
+    _write_DART_sequence_header(fi, _header_kinds(field, clearair), nobs)
+
+def _obs_links(nobs, n0=0, n1=None):
+    """
+        Previous / next / -1 link numbers of obs n0+1..n1 (default all) in a linked DART
+        obs sequence of nobs obs
+    """
+
+    n = np.arange(n0+1, (nobs if n1 is None else n1)+1)
+
+    prev = np.where(n == 1, -1, n-1)
+    next = np.where((n == nobs) & (n != 1), -1, n+1)
+
+    return prev, next, np.full(n.shape, -1)
+
+def _write_DART_obs(fi, record, columns, chunk=None):
+    """
+        Writes one record per ob:  record is the %-format of an ob, and columns are the
+        arrays (one value per ob) that fill it in order.  Obs are formatted chunk at a time.
+    """
+
+    chunk = chunk or _write_chunk
+    nobs  = len(columns[0])
+
+    for n0 in range(0, nobs, chunk):
+        n1   = min(n0 + chunk, nobs)
+        flat = [v for ob in zip(*[c[n0:n1].tolist() for c in columns]) for v in ob]
+        fi.write((record * (n1 - n0)) % tuple(flat))
+
+########################################################################
+#
+# Helpers for the DART binary writers:  each Fortran write is one record, framed by its
+# length in bytes (4 byte markers).  Integers are written as int32 and reals as float64,
+# the character items are blank padded to the lengths DART reads them with.
+
+def _fortran_record(fi, *items):
+
+    body   = b''.join([i.encode('ascii') if isinstance(i, str) else np.asarray(i).tobytes() for i in items])
+    marker = np.int32(len(body)).tobytes()
+
+    fi.write(marker + body + marker)
+
+def _write_DART_binary_sequence_header(fi, kinds, nobs, first=1, last=None, copies=["observations"], qcs=["QC radar"]):
+
+    _fortran_record(fi, "obs_sequence")
+    _fortran_record(fi, "obs_kind_definitions")
+    _fortran_record(fi, np.int32(len(kinds)))
+
+    for akind, DART_name in kinds:
+        _fortran_record(fi, np.int32(akind), DART_name.ljust(32))
+
+    _fortran_record(fi, np.array([len(copies), len(qcs), nobs, nobs], dtype=np.int32))
+    for name in copies + qcs:
+        _fortran_record(fi, name.ljust(64))
+    _fortran_record(fi, np.array([first, nobs if last is None else last], dtype=np.int32))
+
+def _write_DART_binary_header(fi, field, nobs, clearair):
+
+    _write_DART_binary_sequence_header(fi, _header_kinds(field, clearair), nobs)
+
+def _write_DART_binary_obs(fi, records, nobs, chunk=None):
+    """
+        Writes nobs obs as Fortran records:  records is the list of records of an ob, each a
+        list of arrays (one value per ob) or constants.  The obs are packed into a structured
+        array chunk at a time.
+    """
+
+    chunk  = chunk or _write_chunk
+    fields = []
+    items  = []
+
+    for r, record in enumerate(records):
+        types  = ['i4' if np.asarray(v).dtype.kind in 'iu' else 'f8' for v in record]
+        fields.append(('len%d' % r, 'i4'))
+        for n, (t, v) in enumerate(zip(types, record)):
+            fields.append(('r%d_%d' % (r, n), t))
+            items.append(('r%d_%d' % (r, n), v))
+        fields.append(('end%d' % r, 'i4'))
+        size   = sum([np.dtype(t).itemsize for t in types])
+        items += [('len%d' % r, size), ('end%d' % r, size)]
+
+    dtype = np.dtype(fields)
+
+    for n0 in range(0, nobs, chunk):
+        n1  = min(n0 + chunk, nobs)
+        obs = np.empty((n1 - n0,), dtype=dtype)
+        for name, v in items:
+            obs[name] = v[n0:n1] if np.ndim(v) > 0 else v
+        fi.write(obs.tobytes())
+
+def opaws_write_DART_ascii(obs, filename=None, obs_error=None, zero_dbz_obtype=True, grid_dict=None,
+                           dart_format=None):
     ####################################################################################### 
     #
     # write_DART_ascii is a program to dump radar data to DART ascii files.
@@ -185,6 +399,8 @@ def opaws_write_DART_ascii(obs, filename=None, obs_error=None, zero_dbz_obtype=T
     #               this is NOT the variance, the stddev!
     #               YOU MUST SPECIFY the obs_error, or program will quit.
     #
+    #   dart_format:  "ascii" or "binary" (DART unformatted obs sequence), default is _dart_format
+    #
     #   obs object spec:  The obs object must have the following  attributes...
     #
     #       obs.data:       3D masked numpy array of radar data on a grid.
@@ -231,12 +447,12 @@ def opaws_write_DART_ascii(obs, filename=None, obs_error=None, zero_dbz_obtype=T
         print("write_DART_ascii:  No obs error defined for observation, exiting")
         raise SystemExit
 
-    # Open ASCII file for DART obs to be written into.  We will add header info afterward
-    fi = open(filename, "w")
-  
-    # This is why I love python - they think of everything.  Here Numpy has an interator over 
-    #      an array, and it will extract the indices for you automatically..so create a single 
-    #      loop over a MD array is very simple....
+    if dart_format == None:
+        dart_format = _dart_format
+
+    if dart_format not in ["ascii", "binary"]:
+        print("write_DART_ascii:  Unknown DART file format %s, valid formats are ascii or binary, exiting" % dart_format)
+        raise SystemExit
 
     print("\n Writing %s to file...." % obs.field.upper())
     
@@ -279,168 +495,139 @@ def opaws_write_DART_ascii(obs, filename=None, obs_error=None, zero_dbz_obtype=T
     # Set up the time stamping for dat
     vol_time = DT.datetime.strptime(obs.time['units'], "seconds since %Y-%m-%dT%H:%M:%SZ")
     dt_time  = vol_time - DT.datetime(1601,1,1,0,0,0)
-  
-    # Print the number of value gates
-    #  mask_check = data.mask && numpy.isnan().any()
-    data_length = np.sum(data.mask[:]==False)
+
+    # The good obs in (k,j,i) order, the count is known before anything is written
+    kk, jj, ii  = np.nonzero(np.ma.getmaskarray(data) == False)
+    data_length = kk.size
     print("\n Number of good observations:  %d" % data_length)
-  
-    # Create a multidimension iterator to move through 3D array creating obs
-    it = np.nditer(data, flags=['multi_index'])
-    nobs = 0
-    nobs_clearair = 0
 
-    while not it.finished:
-        k = it.multi_index[0]
-        j = it.multi_index[1]
-        i = it.multi_index[2]
-        
-        if data.mask[k,j,i] == True:   # bad values
-            pass
-        else:          
-            nobs += 1
-
-            # time of observations is the mean time of each sweep
-          
-            try:
-                sw_time = dt_time + DT.timedelta(seconds=obs.sweep_time[k])
-            except:
-                sw_time = dt_time + DT.timedelta(seconds=obs.sweep_time.max())
-
-            days    = sw_time.days
-            seconds = sw_time.seconds
-    
-            if _write_grid_indices:
-                fi.write(" OBS            %d     %d     %d    %d\n" % (nobs,k,j,i) )
-            else:
-                fi.write(" OBS            %d\n" % (nobs) )
-                
-            fi.write("   %20.14f\n" % data[k,j,i]  )
-            fi.write("   %20.14f\n" % truth )
-                
-            if nobs == 1: 
-                fi.write(" %d %d %d\n" % (-1, nobs+1, -1) ) # First obs.
-            elif nobs == data_length:
-                fi.write(" %d %d %d\n" % (nobs-1, -1, -1) ) # Last obs.
-            else:
-                fi.write(" %d %d %d\n" % (nobs-1, nobs+1, -1) ) 
-        
-            fi.write("obdef\n")
-            fi.write("loc3d\n")
+    values = np.ma.getdata(data)[kk,jj,ii].astype(np.float64)
+    z      = np.ma.filled(np.ma.asarray(hgts)[kk,jj,ii].astype(np.float64), np.nan)
 
-            fi.write("    %20.14f          %20.14f          %20.14f     %d\n" % 
-                    (lons[i], lats[j], hgts[k,j,i], vert_coord))
-        
-            fi.write("kind\n")
-
-            # If we created zeros, and 0dbz_obtype == True, write them out as a separate data type
-            # IF MRMS_zeros == True, we assume that is what you want anyway.
-
-            if (kind == ObType_LookUp("REFLECTIVITY") and data[k,j,i] <= 0.1) and \
-                (grid_dict['0dbz_obtype'] or grid_dict['MRMS_zeros'][0]):
-                
-                fi.write("     %d     \n" % ObType_LookUp("RADAR_CLEARAIR_REFLECTIVITY") )
-                nobs_clearair += 1
-                o_error = obs_error[1]
-            else:     
-                fi.write("     %d     \n" % kind )
-                o_error = obs_error[0]
-
-            # If this GEOS cloud pressure observation, write out extra information (NOTE - NOT TESTED FOR HDF2ASCII LJW 04/13/15)
-            # 
-            #       if kind == ObType_LookUp("GOES_CWP_PATH"):
-            #           fi.write("    %20.14f          %20.14f  \n" % (row["satellite"][0], row["satellite"][1]) )
-            #           fi.write("    %20.14f  \n" % (row["satellite"][2]) )
-
-            # Check to see if its radial velocity and add platform informationp...need BETTER CHECK HERE!
-        
-            if kind == ObType_LookUp("VR"):
-            
-                R_xy            = np.sqrt(obs.xg[i]**2 + obs.yg[j]**2)
-                elevation_angle = beam_elv(R_xy, obs.zg[k,j,i])
+    # If we created zeros, and 0dbz_obtype == True, write them out as a separate data type
+    # IF MRMS_zeros == True, we assume that is what you want anyway.
 
-                platform_dir1 = (obs.xg[i] / R_xy) * np.cos(np.deg2rad(elevation_angle))
-                platform_dir2 = (obs.yg[j] / R_xy) * np.cos(np.deg2rad(elevation_angle))
-                platform_dir3 = np.sin(np.deg2rad(elevation_angle))
-                
-                fi.write("platform\n")
-                fi.write("loc3d\n")
+    clearair = np.full((data_length,), False)
 
-                if platform_lon < 0.0:  platform_lon = platform_lon+2.0*np.pi
+    if kind == ObType_LookUp("REFLECTIVITY") and np.any(values <= 0.1):
+        if grid_dict['0dbz_obtype'] or grid_dict['MRMS_zeros'][0]:
+            clearair = (values <= 0.1)
 
-                fi.write("    %20.14f          %20.14f        %20.14f    %d\n" % 
-                        (platform_lon, platform_lat, platform_hgt, platform_vert_coord) )
-            
-                fi.write("dir3d\n")
-            
-                fi.write("    %20.14f          %20.14f        %20.14f\n" % (platform_dir1, platform_dir2, platform_dir3) )
-                fi.write("    %20.14f     \n" % obs.nyquist[k] )
-                fi.write("    %d          \n" % platform_key )
+    nobs_clearair = int(np.sum(clearair))
 
-                # Done with special radial velocity obs back to dumping out time, day, error variance info
-        
-            fi.write("    %d          %d     \n" % (seconds, days) )
+    obkind  = np.where(clearair, ObType_LookUp("RADAR_CLEARAIR_REFLECTIVITY"), kind)
+    if nobs_clearair > 0:
+        o_error = np.where(clearair, obs_error[1], obs_error[0])
+    else:
+        o_error = np.full((data_length,), obs_error[0])
 
-            # Logic for command line override of observational error variances
+    # time of observations is the mean time of each sweep
 
-            fi.write("    %20.14f  \n" % o_error**2 )
+    days    = np.zeros((data.shape[0],), dtype=np.int64)
+    seconds = np.zeros((data.shape[0],), dtype=np.int64)
 
-            if nobs % 1000 == 0: print(" write_DART_ascii:  Processed observation # %d" % nobs)
-  
-        it.iternext()
-      
-    fi.close()
-    
-    # To write out header information AFTER we know how big the observation data set is, we have
-    # to read back in the entire contents of the obs-seq file, store it, rewrite the file
-    # with header information first, and then dump the contents of obs-seq back inp.  Yuck.
+    for k in np.arange(data.shape[0]):
+        try:
+            sw_time = dt_time + DT.timedelta(seconds=obs.sweep_time[k])
+        except:
+            sw_time = dt_time + DT.timedelta(seconds=obs.sweep_time.max())
+        days[k]    = sw_time.days
+        seconds[k] = sw_time.seconds
+
+    # Format of an ob, the fields that are the same for every ob are written into the format.
+    # The binary records hold the same fields as the ascii lines (less the labels and OBS number)
+
+    links  = _obs_links(data_length)
+
+    record = [" OBS            %d     %d     %d    %d\n" if _write_grid_indices else " OBS            %d\n",
+              "   %20.14f\n",
+              ("   %20.14f\n" % truth).replace('%', '%%'),
+              " %d %d %d\n",
+              "obdef\n",
+              "loc3d\n",
+              "    %%20.14f          %%20.14f          %%20.14f     %d\n" % vert_coord,
+              "kind\n",
+              "     %d     \n"]
+
+    columns = [np.arange(1, data_length+1)]
+    if _write_grid_indices:
+        columns += [kk, jj, ii]
+    columns += [values]
+    columns += list(links)
+    columns += [lons[ii], lats[jj], z, obkind]
+
+    records = [[values], [truth], list(links), [lons[ii], lats[jj], z, vert_coord], [obkind]]
+
+    # Check to see if its radial velocity and add platform information...need BETTER CHECK HERE!
 
-    with open(filename, 'r') as f: f_obs_seq = f.read()
+    if kind == ObType_LookUp("VR"):
 
-    fi = open(filename, "w")
-    
-    fi.write(" obs_sequence\n")
-    fi.write("obs_kind_definitions\n")
+        xg   = np.asarray(obs.xg, dtype=np.float64)[ii]
+        yg   = np.asarray(obs.yg, dtype=np.float64)[jj]
+        zg   = np.ma.filled(np.ma.asarray(obs.zg)[kk,jj,ii].astype(np.float64), np.nan)
 
-    # Deal with case that for reflectivity, 2 types of observations might have been created
+        with np.errstate(divide='ignore', invalid='ignore'):
+            R_xy            = np.sqrt(xg**2 + yg**2)
+            elevation_angle = beam_elv(R_xy, zg)
 
-    if kind == ObType_LookUp("REFLECTIVITY") and zero_dbz_obtype and nobs_clearair > 0:
-        fi.write("       %d\n" % 2)
-        akind, DART_name = ObType_LookUp(obs.field.upper(), DART_name=True)
-        fi.write("    %d          %s   \n" % (akind, DART_name) )
-        akind, DART_name = ObType_LookUp("RADAR_CLEARAIR_REFLECTIVITY", DART_name=True) 
-        fi.write("    %d          %s   \n" % (akind, DART_name) )
-    else:
-        fi.write("       %d\n" % 1)
-        akind, DART_name = ObType_LookUp(obs.field.upper(), DART_name=True)
-        fi.write("    %d          %s   \n" % (akind, DART_name) )
+            platform_dir1 = (xg / R_xy) * np.cos(np.deg2rad(elevation_angle))
+            platform_dir2 = (yg / R_xy) * np.cos(np.deg2rad(elevation_angle))
+            platform_dir3 = np.sin(np.deg2rad(elevation_angle))
 
-    fi.write("  num_copies:            %d  num_qc:            %d\n" % (1, 1))
-    
-    fi.write(" num_obs:       %d  max_num_obs:       %d\n" % (nobs, nobs) )
-        
-    fi.write("observations\n")
-    fi.write("QC radar\n")
-            
-    fi.write("  first:            %d  last:       %d\n" % (1, nobs) )
+        platform_lon = float(platform_lon)
+        if platform_lon < 0.0:  platform_lon = platform_lon+2.0*np.pi
 
-    # Now write back in all the actual DART obs data
+        record += ["platform\n",
+                   "loc3d\n",
+                   ("    %20.14f          %20.14f        %20.14f    %d\n" % 
+                    (platform_lon, float(platform_lat), float(platform_hgt), platform_vert_coord)).replace('%', '%%'),
+                   "dir3d\n",
+                   "    %20.14f          %20.14f        %20.14f\n",
+                   "    %20.14f     \n",
+                   ("    %d          \n" % platform_key).replace('%', '%%')]
+
+        columns += [platform_dir1, platform_dir2, platform_dir3, np.asarray(platform_nyquist, dtype=np.float64)[kk]]
+
+        records += [[platform_lon, float(platform_lat), float(platform_hgt), platform_vert_coord],
+                    [platform_dir1, platform_dir2, platform_dir3],
+                    [np.asarray(platform_nyquist, dtype=np.float64)[kk]],
+                    [platform_key]]
+
+    # Done with special radial velocity obs back to dumping out time, day, error variance info
+
+    record  += ["    %d          %d     \n",
+                "    %20.14f  \n"]
+
+    columns += [seconds[kk], days[kk], o_error**2]
+
+    records += [[seconds[kk], days[kk]], [o_error**2]]
+
+    # Open the DART file for the obs to be written into, the header goes first
+
+    clearair_type = (kind == ObType_LookUp("REFLECTIVITY") and zero_dbz_obtype and nobs_clearair > 0)
+
+    if dart_format == "binary":
+        fi = open(filename, "wb")
+        _write_DART_binary_header(fi, obs.field, data_length, clearair_type)
+        _write_DART_binary_obs(fi, records, data_length)
+    else:
+        fi = open(filename, "w")
+        _write_DART_header(fi, obs.field, data_length, clearair_type)
+        _write_DART_obs(fi, ''.join(record), columns)
 
-    fi.write(f_obs_seq)
-    
     fi.close()
     
-    print("\n write_DART_ascii:  Created ascii DART file, N = %d written" % nobs)
+    print("\n write_DART_ascii:  Created %s DART file, N = %d written" % (dart_format, data_length))
     
     if kind == ObType_LookUp("REFLECTIVITY") and zero_dbz_obtype and nobs_clearair > 0:
         print(" write_DART_ascii:  Number of clear air obs:             %d" % nobs_clearair)
-        print(" write_DART_ascii:  Number of non-zero reflectivity obs: %d" % (nobs - nobs_clearair))
+        print(" write_DART_ascii:  Number of non-zero reflectivity obs: %d" % (data_length - nobs_clearair))
 
     return
  
 
 def mrms_write_DART_ascii(obs, filename=None, obs_error=None, zero_dbz_obtype=_zero_dbz_obtype,
-                     levels = [], QC_info=[], zero_levels=[]):
+                     levels = [], QC_info=[], zero_levels=[], dart_format=None):
     ####################################################################################### 
     #
     # write_DART_ascii is a program to dump radar data to DART ascii files.
@@ -459,6 +646,8 @@ def mrms_write_DART_ascii(obs, filename=None, obs_error=None, zero_dbz_obtype=_z
     #               this is NOT the variance, the stddev!
     #               YOU MUST SPECIFY the obs_error, or program will quit.
     #
+    #   dart_format:  "ascii" or "binary" (DART unformatted obs sequence), default is _dart_format
+    #
     #   obs object spec:  The obs object must have the following  attributes...
     #
     #       obs.data:       3D masked numpy array of radar data on a grid.
@@ -506,9 +695,12 @@ def mrms_write_DART_ascii(obs, filename=None, obs_error=None, zero_dbz_obtype=_z
         print("write_DART_ascii:  No obs error defined for observation, exiting")
         raise SystemExit
 
-    # Open ASCII file for DART obs to be written into.  We will add header info afterward
+    if dart_format == None:
+        dart_format = _dart_format
 
-    fi = open(filename, "w")
+    if dart_format not in ["ascii", "binary"]:
+        print("write_DART_ascii:  Unknown DART file format %s, valid formats are ascii or binary, exiting" % dart_format)
+        raise SystemExit
 
     print("\n Writing %s to DART file...." % obs.field.upper())
 
@@ -530,7 +722,11 @@ def mrms_write_DART_ascii(obs, filename=None, obs_error=None, zero_dbz_obtype=_z
 
     lons       = np.where(lons > 0.0, lons, lons+(2.0*np.pi))
 
-    # extra information
+    # The levels to write, each is (2D data, height, dtype, level):  the data levels and
+    # then the 0-DBZ levels, which all reuse the zero_dbz field (no 3D copy of the cube).
+    # With the 0-DBZ type the data and heights are written as float32.
+
+    nz = data.shape[0]
 
     if kind == ObType_LookUp("VR"):
         platform_nyquist    = obs.nyquist
@@ -539,29 +735,16 @@ def mrms_write_DART_ascii(obs, filename=None, obs_error=None, zero_dbz_obtype=_z
         platform_hgt        = obs.radar_hgt
         platform_key        = 1
         platform_vert_coord = 3
+        layers = [(data[k], hgts[k], np.float64, k) for k in range(nz)]
     else:
         try:
-            nz, ny, nx     = data.shape
-            if len(levels) == 0:
-                nz2        = nz + len(zero_levels)
-            else:
-                nz2        = len(levels) + len(zero_levels)
-                
-            new_data       = np.ma.zeros((nz2, ny, nx), dtype=np.float32)
-            new_hgts       = np.ma.zeros((nz2), dtype=np.float32)
-            
-            for n, k in enumerate(levels):
-                new_data[n,...] = data[n]
-                new_hgts[n]     = hgts[n]
-            
-            for n, lvl in enumerate(zero_levels):
-                new_data[nz+n] = obs.zero_dbz.data
-                new_hgts[nz+n] = lvl
-                
-            data = new_data
-            hgts = new_hgts
+            zero_dbz = obs.zero_dbz.data
+            dlevels  = range(len(levels)) if len(levels) > 0 else range(nz)
+            layers   = [(data[n], hgts[n], np.float32, n) for n in dlevels] \
+                     + [(zero_dbz, lvl, np.float32, None) for lvl in zero_levels]
             print("\n write_DART_ascii:  0-DBZ separate type added to reflectivity output\n")
         except AttributeError:
+            layers   = [(data[k], hgts[k], np.float64, k) for k in range(nz)]
             print("\n write_DART_ascii:  No 0-DBZ separate type found\n")
 
     # Use the volume mean time for the time of the volume
@@ -572,172 +755,165 @@ def mrms_write_DART_ascii(obs, filename=None, obs_error=None, zero_dbz_obtype=_z
         dtime   = obs.time
         
     days    = ncdf.date2num(dtime, units = "days since 1601-01-01 00:00:00")
-    seconds = np.int(86400.*(days - np.floor(days)))
+    seconds = int(86400.*(days - np.floor(days)))
 
-    # Print the number of value gates
+    # The obs are handled in blocks of rows holding at most _write_chunk grid points,
+    # so memory stays bounded whatever the size of the domain
 
-    #  mask_check = data.mask && numpy.isnan().any()
+    rows = max(1, _write_chunk // data.shape[-1])
 
-    data_length = np.sum(data.mask[:]==False)
-    print("\n Number of good observations:  %d" % data_length)
+    def blocks():
+        for layer in layers:
+            for r0 in range(0, layer[0].shape[0], rows):
+                yield layer, r0, min(r0 + rows, layer[0].shape[0])
 
-    # This is why I love python - they think of everything.  Here Numpy has an interator over 
-    #      an array, and it will extract the indices for you automatically..so create a single 
-    #      loop over a MD array is very simple....  
-    #      Creating a multidimension iterator to move through 3D array creating obs
+    def block_obs(layer, r0, r1):
+        d, h, dtype, k = layer
+        jj, ii = np.nonzero(np.ma.getmaskarray(d[r0:r1]) == False)
+        values = np.ma.getdata(d[r0:r1])[jj,ii].astype(dtype).astype(np.float64)
+        if np.ndim(h) == 0:
+            z = np.full(values.shape, np.float64(np.asarray(h).astype(dtype)))
+        else:
+            z = np.ma.filled(np.ma.asarray(h[r0:r1])[jj,ii].astype(dtype).astype(np.float64), np.nan)
+        return jj + r0, ii, values, z
 
-    it = np.nditer(data, flags=['multi_index'])
-    nobs = 0
+    def is_clearair(values):
+        return (values <= 0.1) if (kind == ObType_LookUp("REFLECTIVITY") and zero_dbz_obtype) \
+                               else np.full(values.shape, False)
+
+    # First pass:  number of obs and clear air obs for the header
+
+    data_length   = 0
     nobs_clearair = 0
 
-    while not it.finished:
-        k = it.multi_index[0]
-        j = it.multi_index[1]
-        i = it.multi_index[2]
-        
-        if data.mask[k,j,i] == True:   # bad values
-            pass
-        else:          
-            nobs += 1
+    for layer, r0, r1 in blocks():
+        jj, ii, values, z = block_obs(layer, r0, r1)
+        data_length      += values.size
+        nobs_clearair    += int(np.sum(is_clearair(values)))
 
-            if _write_grid_indices:
-                fi.write(" OBS            %d     %d     %d    %d\n" % (nobs,k,j,i) )
-            else:
-                fi.write(" OBS            %d\n" % (nobs) )
-                
-            fi.write("   %20.14f\n" % data[k,j,i]  )
-
-    # Special QC flag processing so we can use low-reflectivity for additive noise
-
-            if ( (kind == ObType_LookUp("REFLECTIVITY")) ):
-                if ( ( QC_info != None ) and (data[k,j,i] >= QC_info[0][0]) 
-                                        and (data[k,j,i]  < QC_info[1][0])):
-                    fi.write("   %20.14f\n" % QC_info[0][1] )
-                else:
-                    fi.write("   %20.14f\n" % QC_info[1][1] )
-            else:
-                    fi.write("   %20.14f\n" % QC_default )
-            
-            if nobs == 1: 
-                fi.write(" %d %d %d\n" % (-1, nobs+1, -1) ) # First obs.
-            elif nobs == data_length:
-                fi.write(" %d %d %d\n" % (nobs-1, -1, -1) ) # Last obs.
-            else:
-                fi.write(" %d %d %d\n" % (nobs-1, nobs+1, -1) ) 
-        
-            fi.write("obdef\n")
-            fi.write("loc3d\n")
+    print("\n Number of good observations:  %d" % data_length)
 
-    # dont know why I needed to have the next set of logic.           
-            if ( (kind == ObType_LookUp("REFLECTIVITY")) and (data[k,j,i] <= 0.1) and zero_dbz_obtype):
-                z = hgts[k]
-            else:
-                z = hgts[k]
-                
-            try:
-                fi.write("    %20.14f          %20.14f          %20.14f     %d\n" % 
-                            (lons[i], lats[j], z, vert_coord))
-            except:
-                fi.write("    %20.14f          %20.14f          %20.14f     %d\n" % 
-                            (lons[i], lats[j], z, vert_coord))
-        
-            fi.write("kind\n")
+    # Open the DART file for the obs to be written into, the header goes first
 
-    # If we created zeros, and 0dbz_obtype == True, write them out as a separate data type
+    clearair_type = (kind == ObType_LookUp("REFLECTIVITY") and zero_dbz_obtype and nobs_clearair > 0)
 
-            if ( (kind == ObType_LookUp("REFLECTIVITY")) and (data[k,j,i] <= 0.1) and zero_dbz_obtype):             
-                fi.write("     %d     \n" % ObType_LookUp("RADAR_CLEARAIR_REFLECTIVITY") )
-                nobs_clearair += 1
-                o_error = obs_error[1]
-            else:     
-                fi.write("     %d     \n" % kind )
-                o_error = obs_error[0]
+    if dart_format == "binary":
+        fi = open(filename, "wb")
+        _write_DART_binary_header(fi, obs.field, data_length, clearair_type)
+    else:
+        fi = open(filename, "w")
+        _write_DART_header(fi, obs.field, data_length, clearair_type)
 
-    # If this GEOS cloud pressure observation, write out extra information (NOTE - NOT TESTED FOR HDF2ASCII LJW 04/13/15)
-    # 
-    #       if kind == ObType_LookUp("GOES_CWP_PATH"):
-    #           fi.write("    %20.14f          %20.14f  \n" % (row["satellite"][0], row["satellite"][1]) )
-    #           fi.write("    %20.14f  \n" % (row["satellite"][2]) )
+    # Format of an ob, the fields that are the same for every ob are written into the format
 
-    # Check to see if its radial velocity and add platform informationp...need BETTER CHECK HERE!
-        
-            if kind == ObType_LookUp("VR"):
-            
-                R_xy            = np.sqrt(obs.xg[i]**2 + obs.yg[j]**2)
-                elevation_angle = beam_elv(R_xy, obs.zg[k,j,i])
+    record = [" OBS            %d     %d     %d    %d\n" if _write_grid_indices else " OBS            %d\n",
+              "   %20.14f\n",
+              "   %20.14f\n",
+              " %d %d %d\n",
+              "obdef\n",
+              "loc3d\n",
+              "    %%20.14f          %%20.14f          %%20.14f     %d\n" % vert_coord,
+              "kind\n",
+              "     %d     \n"]
 
-                platform_dir1 = (obs.xg[i] / R_xy) * np.cos(np.deg2rad(elevation_angle))
-                platform_dir2 = (obs.yg[j] / R_xy) * np.cos(np.deg2rad(elevation_angle))
-                platform_dir3 = np.sin(np.deg2rad(elevation_angle))
-                
-                fi.write("platform\n")
-                fi.write("loc3d\n")
+    if kind == ObType_LookUp("VR"):
 
-                if platform_lon < 0.0:  platform_lon = platform_lon+2.0*np.pi
+        platform_lon = float(platform_lon)
+        if platform_lon < 0.0:  platform_lon = platform_lon+2.0*np.pi
 
-                fi.write("    %20.14f          %20.14f        %20.14f    %d\n" % 
-                        (platform_lon, platform_lat, platform_hgt, platform_vert_coord) )
-            
-                fi.write("dir3d\n")
-            
-                fi.write("    %20.14f          %20.14f        %20.14f\n" % (platform_dir1, platform_dir2, platform_dir3) )
-                fi.write("    %20.14f     \n" % obs.nyquist[k] )
-                fi.write("    %d          \n" % platform_key )
+        record += ["platform\n",
+                   "loc3d\n",
+                   ("    %20.14f          %20.14f        %20.14f    %d\n" % 
+                    (platform_lon, float(platform_lat), float(platform_hgt), platform_vert_coord)).replace('%', '%%'),
+                   "dir3d\n",
+                   "    %20.14f          %20.14f        %20.14f\n",
+                   "    %20.14f     \n",
+                   ("    %d          \n" % platform_key).replace('%', '%%')]
 
-        # Done with special radial velocity obs back to dumping out time, day, error variance info
-        
-            fi.write("    %d          %d     \n" % (seconds, days) )
+    record += [("    %d          %d     \n" % (seconds, days)).replace('%', '%%'),
+               "    %20.14f  \n"]
 
-        # Logic for command line override of observational error variances
+    record = ''.join(record)
 
-            fi.write("    %20.14f  \n" % o_error**2 )
+    # Second pass:  format and write the obs block by block
 
-            if nobs % 10000 == 0: print(" write_DART_ascii:  Processed observation # %d" % nobs)
+    nobs = 0
 
-        it.iternext()
-        
-    fi.close()
+    for layer, r0, r1 in blocks():
 
-    # To write out header information AFTER we know how big the observation data set is, we have
-    # to read back in the entire contents of the obs-seq file, store it, rewrite the file
-    # with header information first, and then dump the contents of obs-seq back inp.  Yuck.
+        jj, ii, values, z = block_obs(layer, r0, r1)
 
-    with open(filename, 'r') as f: f_obs_seq = f.read()
+        if values.size == 0:
+            continue
 
-    fi = open(filename, "w")
+        n0, nobs = nobs, nobs + values.size
+        k        = layer[3]
+        clearair = is_clearair(values)
 
-    fi.write(" obs_sequence\n")
-    fi.write("obs_kind_definitions\n")
+        # Special QC flag processing so we can use low-reflectivity for additive noise
 
-    # Deal with case that for reflectivity, 2 types of observations might have been created
+        if kind == ObType_LookUp("REFLECTIVITY"):
+            if QC_info != None:
+                qc = np.where((values >= QC_info[0][0]) & (values < QC_info[1][0]), QC_info[0][1], QC_info[1][1])
+            else:
+                qc = np.full(values.shape, QC_default)
+        else:
+            qc = np.full(values.shape, QC_default)
 
-    if kind == ObType_LookUp("REFLECTIVITY") and zero_dbz_obtype and nobs_clearair > 0:
-        fi.write("       %d\n" % 2)
-        akind, DART_name = ObType_LookUp(obs.field.upper(), DART_name=True)
-        fi.write("    %d          %s   \n" % (akind, DART_name) )
-        akind, DART_name = ObType_LookUp("RADAR_CLEARAIR_REFLECTIVITY", DART_name=True) 
-        fi.write("    %d          %s   \n" % (akind, DART_name) )
-    else:
-        fi.write("       %d\n" % 1)
-        akind, DART_name = ObType_LookUp(obs.field.upper(), DART_name=True)
-        fi.write("    %d          %s   \n" % (akind, DART_name) )
+        # If we created zeros, and 0dbz_obtype == True, write them out as a separate data type
 
-    fi.write("  num_copies:            %d  num_qc:            %d\n" % (1, 1))
+        obkind  = np.where(clearair, ObType_LookUp("RADAR_CLEARAIR_REFLECTIVITY"), kind)
+        if clearair.any():
+            o_error = np.where(clearair, obs_error[1], obs_error[0])
+        else:
+            o_error = np.full(values.shape, obs_error[0])
 
-    fi.write(" num_obs:       %d  max_num_obs:       %d\n" % (nobs, nobs) )
-        
-    fi.write("observations\n")
-    fi.write("QC radar\n")
-            
-    fi.write("  first:            %d  last:       %d\n" % (1, nobs) )
+        links   = _obs_links(data_length, n0, nobs)
 
-    # Now write back in all the actual DART obs data
+        columns = [np.arange(n0+1, nobs+1)]
+        if _write_grid_indices:
+            columns += [np.full(values.shape, -1 if k is None else k), jj, ii]
+        columns += [values, qc]
+        columns += list(links)
+        columns += [lons[ii], lats[jj], z, obkind]
+
+        records = [[values], [qc], list(links), [lons[ii], lats[jj], z, vert_coord], [obkind]]
+
+        # Check to see if its radial velocity and add platform information
+
+        if kind == ObType_LookUp("VR"):
+
+            xg = np.asarray(obs.xg, dtype=np.float64)[ii]
+            yg = np.asarray(obs.yg, dtype=np.float64)[jj]
+            zg = np.ma.filled(np.ma.asarray(obs.zg)[k][jj,ii].astype(np.float64), np.nan)
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                R_xy            = np.sqrt(xg**2 + yg**2)
+                elevation_angle = beam_elv(R_xy, zg)
+
+                platform_dir1 = (xg / R_xy) * np.cos(np.deg2rad(elevation_angle))
+                platform_dir2 = (yg / R_xy) * np.cos(np.deg2rad(elevation_angle))
+                platform_dir3 = np.sin(np.deg2rad(elevation_angle))
 
-    fi.write(f_obs_seq)
+            columns += [platform_dir1, platform_dir2, platform_dir3, np.full(values.shape, float(platform_nyquist[k]))]
+
+            records += [[platform_lon, float(platform_lat), float(platform_hgt), platform_vert_coord],
+                        [platform_dir1, platform_dir2, platform_dir3],
+                        [float(platform_nyquist[k])],
+                        [platform_key]]
+
+        columns += [o_error**2]
+
+        records += [[seconds, int(days)], [o_error**2]]
+
+        if dart_format == "binary":
+            _write_DART_binary_obs(fi, records, values.size)
+        else:
+            _write_DART_obs(fi, record, columns)
 
     fi.close()
 
-    print("\n write_DART_ascii:  Created ascii DART file, N = %d written" % nobs)
+    print("\n write_DART_ascii:  Created %s DART file, N = %d written" % (dart_format, nobs))
 
     if kind == ObType_LookUp("REFLECTIVITY") and zero_dbz_obtype and nobs_clearair > 0:
         print(" write_DART_ascii:  Number of clear air obs:             %d" % nobs_clearair)
@@ -745,6 +921,263 @@ def mrms_write_DART_ascii(obs, filename=None, obs_error=None, zero_dbz_obtype=_z
 
     return
   
+#####################################################################################################
+#
+# Merging DART obs_seq files (e.g. the obs_seq_KXXX_VR files of a cycle and the MRMS obs_seq_RF file)
+#
+# The obs of each file are copied as they are, only the OBS numbers and the linked-list records are
+# rewritten:  the obs are numbered file after file and linked in time order (as DART expects).  The
+# obs of a file must all have the same layout (one kind family), which the writers above ensure.
+
+# Kinds which have the platform records (location, direction, nyquist, key) in their definition
+
+_platform_kinds = [ObType_LookUp("VR")]
+
+class _DART_obs_file(object):
+    """
+        An obs_seq file written by the writers above (ascii or binary):  the header is read when
+        the object is created, obs are read chunk at a time by blocks()
+    """
+
+    def __init__(self, filename):
+
+        self.filename = filename
+
+        with open(filename, "rb") as fi:
+            self.binary = (fi.read(4) == np.int32(len("obs_sequence")).tobytes())
+
+        if self.binary:
+            self._read_binary_header()
+        else:
+            self._read_ascii_header()
+
+    # Headers
+
+    def _read_ascii_header(self):
+
+        with open(self.filename, "rb") as fi:
+            lines = [fi.readline() for n in range(3)]
+            nkinds = int(lines[2])
+            kinds  = [fi.readline().decode('ascii').split() for n in range(nkinds)]
+            counts = fi.readline().split()
+            nobs   = int(fi.readline().split()[1])
+            names  = [fi.readline().decode('ascii').strip() for n in range(int(counts[1]) + int(counts[3]))]
+            fi.readline()
+            self.offset = fi.tell()
+
+            # Number of lines of an ob:  from the first OBS line to the second one
+
+            self.nlines = 0
+            self.nbytes = 0
+            for line in fi:
+                if line.startswith(b" OBS") and self.nlines > 0:
+                    break
+                self.nlines += 1
+                self.nbytes += len(line)
+
+        self.kinds  = [(int(k[0]), k[1]) for k in kinds]
+        self.nobs   = nobs
+        self.copies = names[:int(counts[1])]
+        self.qcs    = names[int(counts[1]):]
+
+    def _read_binary_header(self):
+
+        def record(fi):
+            n    = int(np.frombuffer(fi.read(4), dtype=np.int32)[0])
+            body = fi.read(n)
+            fi.read(4)
+            return body
+
+        with open(self.filename, "rb") as fi:
+            record(fi); record(fi)
+            nkinds = int(np.frombuffer(record(fi), dtype=np.int32)[0])
+            kinds  = [record(fi) for n in range(nkinds)]
+            counts = np.frombuffer(record(fi), dtype=np.int32)
+            names  = [record(fi).decode('ascii').strip() for n in range(counts[0] + counts[1])]
+            record(fi)
+            self.offset = fi.tell()
+
+            # Layout of an ob:  the records of the first ob give the offsets of the links, kind
+            # and time records and the size of an ob (the platform records depend on the kind)
+
+            fields = []
+            size   = 0
+            nrecs  = 7
+            n      = 0
+            while n < nrecs and counts[2] > 0:
+                body = record(fi)
+                if n == 2:  fields.append(('links', 'i4', (3,), size + 4))
+                if n == 4:
+                    fields.append(('kind', 'i4', (), size + 4))
+                    if int(np.frombuffer(body, dtype=np.int32)[0]) in _platform_kinds:
+                        nrecs = nrecs + 4
+                if n == nrecs - 2:  fields.append(('time', 'i4', (2,), size + 4))
+                size = size + len(body) + 8
+                n    = n + 1
+
+        self.kinds  = [(int(np.frombuffer(k[:4], dtype=np.int32)[0]), k[4:].decode('ascii').strip()) for k in kinds]
+        self.nobs   = int(counts[2])
+        self.copies = names[:counts[0]]
+        self.qcs    = names[counts[0]:]
+        self.dtype  = np.dtype({'names':   [f[0] for f in fields],
+                                'formats': [(f[1], f[2]) for f in fields],
+                                'offsets': [f[3] for f in fields],
+                                'itemsize': max(size, 1)})
+
+    # Obs
+
+    def blocks(self, chunk=None):
+        """
+            Yields the obs chunk at a time, for ascii files a list of obs (the bytes of each ob after
+            " OBS", without the last newline), for
+            binary files a structured array with the links, kind and time fields of each ob
+        """
+
+        chunk = chunk or _write_chunk
+
+        if self.binary:
+            with open(self.filename, "rb") as fi:
+                fi.seek(self.offset)
+                for n0 in range(0, self.nobs, chunk):
+                    n   = min(chunk, self.nobs - n0)
+                    obs = np.frombuffer(bytearray(fi.read(n*self.dtype.itemsize)), dtype=self.dtype)
+                    platform = np.isin(obs['kind'], _platform_kinds)
+                    if obs.size != n or platform.any() != platform.all():
+                        print("merge_DART_obs_seq:  %s is not a sequence of obs of one layout, exiting" % self.filename)
+                        raise SystemExit
+                    yield obs
+        else:
+            with open(self.filename, "rb") as fi:
+                fi.seek(self.offset)
+                obs  = []
+                tail = b'\n'
+                for n0 in range(0, self.nobs, chunk):
+                    n = min(chunk, self.nobs - n0)
+
+                    # the file is split on the OBS lines, in pieces of about the size of the obs
+                    # still needed (the size of the first ob is known).  The last piece read is
+                    # only complete once the next OBS line (or the end of the file) is read.
+
+                    while len(obs) < n and tail is not None:
+                        data = fi.read(max(1 << 16, (n - len(obs) + 1)*self.nbytes))
+                        if data:
+                            obs += (tail + data).split(b'\n OBS')
+                            tail = obs.pop()
+                        else:
+                            obs.append(tail.rstrip(b'\n'))
+                            tail = None
+                        if obs and obs[0] == b'':
+                            obs.pop(0)
+
+                    block, obs = obs[:n], obs[n:]
+
+                    if len(block) != n or (n0 == 0 and self.nlines != block[0].count(b'\n') + 1):
+                        print("merge_DART_obs_seq:  %s is not a sequence of obs of one layout, exiting" % self.filename)
+                        raise SystemExit
+                    yield block
+
+    def times(self, block):
+        """
+            DART time (seconds since 1601-01-01) of the obs of a block
+        """
+
+        if self.binary:
+            time = block['time'].astype(np.int64)
+        else:
+            time = np.array(b' '.join([ob.rsplit(b'\n', 2)[1] for ob in block]).split()).astype(np.int64).reshape(-1, 2)
+
+        return time[:,1]*86400 + time[:,0]
+
+    def renumber(self, block, numbers, prev, next):
+        """
+            Returns the bytes of the block (as written to the file) with the obs numbered numbers
+            and linked to prev and next
+        """
+
+        if self.binary:
+            block['links'][:,0] = prev
+            block['links'][:,1] = next
+            block['links'][:,2] = -1
+            return block.data              # all the bytes of the obs (tobytes() drops the other records)
+
+        nc  = 1 + len(self.copies) + len(self.qcs)
+        out = []
+
+        for ob, n, p, q in zip(block, numbers.tolist(), prev.tolist(), next.tolist()):
+            lines     = ob.split(b'\n', nc + 1)
+            lines[0]  = b' OBS            %d%s' % (n, lines[0].lstrip(b' ').lstrip(b'0123456789'))
+            lines[nc] = b' %d %d -1' % (p, q)
+            out.append(b'\n'.join(lines))
+
+        return b'\n'.join(out) + b'\n'
+
+def merge_DART_obs_seq(files, filename, chunk=None):
+    """
+        Merges the DART obs_seq files into one obs_seq file filename (with the union of the obs
+        kinds of the files).  The files must all be ascii or all binary (see _dart_format), and
+        the merged file is written in the same format.  The files are read twice:  first for the
+        times of the obs, which give the links, then to write the obs in one sequential pass.
+        Returns the number of obs written.
+    """
+
+    obs_files = [_DART_obs_file(f) for f in files]
+
+    if len(obs_files) == 0:
+        print("merge_DART_obs_seq:  No files to merge, exiting")
+        raise SystemExit
+
+    binary = obs_files[0].binary
+
+    for f in obs_files:
+        if f.binary != binary or (len(f.copies), len(f.qcs)) != (len(obs_files[0].copies), len(obs_files[0].qcs)):
+            print("merge_DART_obs_seq:  %s is not of the same format as %s, exiting" % (f.filename, obs_files[0].filename))
+            raise SystemExit
+
+    kinds = []
+    for f in obs_files:
+        kinds += [k for k in f.kinds if k[0] not in [kind[0] for kind in kinds]]
+
+    # The obs are numbered file after file, the links follow the (stable) time order
+
+    times = np.concatenate([np.zeros((0,), dtype=np.int64)] + \
+                           [f.times(block) for f in obs_files for block in f.blocks(chunk)])
+    nobs  = times.size
+
+    order = np.argsort(times, kind='stable')
+    prev  = np.full((nobs,), -1, dtype=np.int64)
+    next  = np.full((nobs,), -1, dtype=np.int64)
+
+    prev[order[1:]]  = order[:-1] + 1
+    next[order[:-1]] = order[1:] + 1
+
+    first = int(order[0]) + 1 if nobs > 0 else -1
+    last  = int(order[-1]) + 1 if nobs > 0 else -1
+
+    print("\n merge_DART_obs_seq:  Merging %d obs from %d files into %s" % (nobs, len(obs_files), filename))
+
+    fi = open(filename, "wb")
+
+    if binary:
+        _write_DART_binary_sequence_header(fi, kinds, nobs, first, last, obs_files[0].copies, obs_files[0].qcs)
+    else:
+        header = io.StringIO()
+        _write_DART_sequence_header(header, kinds, nobs, first, last, obs_files[0].copies, obs_files[0].qcs)
+        fi.write(header.getvalue().encode('ascii'))
+
+    n0 = 0
+
+    for f in obs_files:
+        for block in f.blocks(chunk):
+            n1 = n0 + len(block)
+            fi.write(f.renumber(block, np.arange(n0+1, n1+1), prev[n0:n1], next[n0:n1]))
+            n0 = n1
+
+    fi.close()
+
+    print(" merge_DART_obs_seq:  Created %s DART file, N = %d written" % ("binary" if binary else "ascii", nobs))
+
+    return nobs
+
 #####################################################################################################
 def write_netcdf_radar_file(ref, vel, filename=None):
     
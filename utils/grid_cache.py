@@ -0,0 +1,185 @@
+from __future__ import print_function
+
+#############################################################
+#
+# Cache of the analysis grid geometry:  map projection, grid
+# coordinates, grid lat/lons and radar offsets.
+#
+# A grid is defined by its projection, center lat/lon, grid
+# spacing and extent.  The Proj objects and grids are kept for
+# the life of the process, and if a cache directory is given
+# the grid arrays are also kept there as .npy files that later
+# jobs memory-map instead of recomputing, next to a .npy file
+# of the radar offsets computed on the grid so far.
+#
+#############################################################
+import os
+import hashlib
+import threading
+
+import numpy as np
+from pyproj import Proj
+
+_grid_arrays = ['xg', 'yg', 'lons', 'lats']
+
+########################################################################
+#
+# Proj objects for each projection / center
+
+_projs      = {}
+_projs_lock = threading.Lock()
+
+def get_proj(projection, lat_0, lon_0, lat_1=30.0, lat_2=60.0):
+    """
+        Returns the (shared) Proj for the projection centered at lat_0, lon_0
+    """
+
+    key = (projection, float(lat_0), float(lon_0), float(lat_1), float(lat_2))
+
+    with _projs_lock:
+        if key not in _projs:
+            _projs[key] = Proj(proj=projection, ellps='WGS84', datum='WGS84', lat_1=lat_1, lat_2=lat_2, \
+                               lat_0=lat_0, lon_0=lon_0)
+        return _projs[key]
+
+########################################################################
+
+def _load_offsets(filename):
+    """
+        Returns the radar offsets {(lat, lon): (x, y)} saved in filename (rows of lat, lon, x, y)
+    """
+
+    if not os.path.exists(filename):
+        return {}
+
+    try:
+        rows = np.load(filename)
+    except Exception as e:
+        print("\n GRID_CACHE:  Cannot read offsets %s:  %s\n" % (filename, str(e)))
+        return {}
+
+    return dict([((float(r[0]), float(r[1])), (float(r[2]), float(r[3]))) for r in rows.reshape(-1, 4)])
+
+def _save_offsets(filename, offsets):
+
+    tmpfile = "%s.%d.%d.tmp" % (filename, os.getpid(), threading.get_ident())
+
+    try:
+        with open(tmpfile, 'wb') as f:
+            np.save(f, np.array([k + v for k, v in sorted(offsets.items())], dtype=np.float64).reshape(-1, 4))
+        os.replace(tmpfile, filename)
+    except Exception as e:
+        print("\n GRID_CACHE:  Cannot write %s:  %s\n" % (filename, str(e)))
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+
+class GridGeometry(object):
+    """
+        Geometry of an analysis grid:  map (the Proj), xg/yg (m from the grid center),
+        lons/lats (from map(xg, yg, inverse=True)), and offset(lat, lon) which returns the
+        x/y location (m) of a radar on the grid.  If offsets_file is set the offsets are
+        read from and added to that file.
+    """
+
+    def __init__(self, map, xg, yg, lons, lats, offsets_file=None):
+
+        self.map  = map
+        self.xg   = xg
+        self.yg   = yg
+        self.lons = lons
+        self.lats = lats
+
+        self._offsets_file = offsets_file
+        self._offsets      = _load_offsets(offsets_file) if offsets_file else {}
+        self._lock         = threading.Lock()
+
+    def offset(self, lat, lon):
+
+        key = (float(lat), float(lon))
+
+        with self._lock:
+            if key not in self._offsets:
+                xoffset, yoffset = self.map(key[1], key[0])
+                self._offsets[key] = (float(xoffset), float(yoffset))
+                if self._offsets_file:
+                    # keep the offsets saved by other jobs since this grid was read
+                    offsets = _load_offsets(self._offsets_file)
+                    offsets.update(self._offsets)
+                    _save_offsets(self._offsets_file, offsets)
+            return self._offsets[key]
+
+########################################################################
+
+_grids      = {}
+_grids_lock = threading.Lock()
+
+def _filenames(cache_dir, key, arrays=_grid_arrays):
+
+    name = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+    return dict([(a, os.path.join(cache_dir, "grid_%s_%s.npy" % (name, a))) for a in arrays])
+
+def _load(cache_dir, key):
+
+    files = _filenames(cache_dir, key)
+
+    if not all([os.path.exists(f) for f in files.values()]):
+        return None
+
+    try:
+        return dict([(a, np.load(files[a], mmap_mode='r')) for a in _grid_arrays])
+    except Exception as e:
+        print("\n GRID_CACHE:  Cannot read grid %s:  %s\n" % (files['xg'], str(e)))
+        return None
+
+def _save(cache_dir, key, arrays):
+
+    files = _filenames(cache_dir, key)
+
+    for a in _grid_arrays:
+        tmpfile = "%s.%d.tmp" % (files[a], os.getpid())
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            with open(tmpfile, 'wb') as f:
+                np.save(f, np.asarray(arrays[a]))
+            os.replace(tmpfile, files[a])
+        except Exception as e:
+            print("\n GRID_CACHE:  Cannot write %s:  %s\n" % (files[a], str(e)))
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+            return
+
+def get_grid(projection, lat_0, lon_0, dx, x0, y0, nx, ny, lat_1=30.0, lat_2=60.0, cache_dir=None):
+    """
+        Returns the GridGeometry of the grid centered at lat_0, lon_0 with nx by ny points
+        spaced dx apart, starting at x0, y0 (m).  If cache_dir is set the grid arrays are
+        read from (memory-mapped) or written to that directory, and so are the radar offsets.
+    """
+
+    key = (projection, float(lat_0), float(lon_0), float(lat_1), float(lat_2), \
+           float(dx), float(x0), float(y0), int(nx), int(ny))
+
+    with _grids_lock:
+        grid = _grids.get(key)
+
+    if grid is not None:
+        return grid
+
+    map    = get_proj(projection, float(lat_0), float(lon_0), lat_1, lat_2)
+
+    arrays = _load(cache_dir, key) if cache_dir else None
+
+    if arrays is None:
+        xg = x0 + dx * np.arange(nx)
+        yg = y0 + dx * np.arange(ny)
+        lons, lats = list(map(xg, yg, inverse=True))
+        arrays = {'xg': xg, 'yg': yg, 'lons': np.asarray(lons), 'lats': np.asarray(lats)}
+        if cache_dir:
+            _save(cache_dir, key, arrays)
+
+    grid = GridGeometry(map, arrays['xg'], arrays['yg'], arrays['lons'], arrays['lats'], \
+                        offsets_file=_filenames(cache_dir, key, ['offsets'])['offsets'] if cache_dir else None)
+
+    with _grids_lock:
+        return _grids.setdefault(key, grid)
@@ -0,0 +1,295 @@
+from __future__ import print_function
+
+#############################################################
+#
+# netCDF4 obs_seq files:  the obs of one radar volume (or
+# MRMS cube) written straight from the column arrays.
+#
+# Each ob has the variables in _obs_variables along the
+# "index" dimension.  The fields that are the same for every
+# ob of a file (time, platform location) are scalar
+# variables and the date of the obs is a global attribute.
+#
+#############################################################
+import os
+import datetime as DT
+
+import numpy as np
+import netCDF4 as ncdf
+
+_time_units = 'seconds since 1970-01-01 00:00:00'
+_day_units  = 'days since 1601-01-01 00:00:00'
+
+# Per ob variables:  name, type, units, description, least significant digit kept
+# (the values are quantized to 10**-digit before compression, None = exact)
+
+_obs_variables = [
+                  ('value',            'f8', None,      None,                                    2),
+                  ('lat',              'f8', 'degrees', 'latitude of observation',               5),
+                  ('lon',              'f8', 'degrees', 'longitude of observation (deg. west)',  5),
+                  ('height',           'f8', 'meters',  'height above sea level',                1),
+                  ('error_var',        'f4', None,      None,                                    None),
+                  ('platform_dir1',    'f8', None,      None,                                    4),
+                  ('platform_dir2',    'f8', None,      None,                                    4),
+                  ('platform_dir3',    'f8', None,      None,                                    4),
+                  ('platform_nyquist', 'f8', None,      None,                                    2),
+                 ]
+
+# Compression of the per ob variables:  zlib level (0 = off), byte shuffle, quantization
+# (least_significant_digit above) and the number of obs in a chunk, which is also the
+# unit the files are appended in
+
+_compression = {
+                'complevel'  : 4,
+                'shuffle'    : True,
+                'quantize'   : True,
+                'chunk_size' : 16384,
+               }
+
+# Number of chunks of each variable cached when appending to a file
+
+_append_cache = 4
+
+# Per file constants
+
+_obs_constants = [
+                  ('utime',            'f8', _time_units, 'time of observation'),
+                  ('day',              'i8', None,        'DART day (days since 1601-01-01) of observation'),
+                  ('second',           'i8', None,        'DART second of the day of observation'),
+                  ('platform_lat',     'f8', 'degrees',   'latitude of the radar'),
+                  ('platform_lon',     'f8', 'degrees',   'longitude of the radar'),
+                  ('platform_hgt',     'f8', 'meters',    'height of the radar above sea level'),
+                 ]
+
+########################################################################
+
+def variable_options(name, nobs=None):
+    """
+        Returns the createVariable keywords (compression, quantization and chunking) of the
+        per ob variable name, for a file of nobs obs (None = unlimited index)
+    """
+
+    digits = dict([(v[0], v[4]) for v in _obs_variables]).get(name)
+
+    if _compression['complevel'] <= 0:
+        return {}
+
+    options = {'zlib':       True,
+               'complevel':  _compression['complevel'],
+               'shuffle':    _compression['shuffle'],
+               'chunksizes': (max(1, min(_compression['chunk_size'], nobs)) if nobs is not None \
+                                                                            else _compression['chunk_size'],)}
+
+    if _compression['quantize'] and digits is not None:
+        options['least_significant_digit'] = digits
+
+    return options
+
+def obs_time(date):
+    """
+        Returns the (utime, day, second) constants of obs at date
+    """
+
+    utime   = ncdf.date2num(date, units = _time_units)
+    days    = ncdf.date2num(date, units = _day_units)
+    seconds = int(86400.*(days - np.floor(days)))
+
+    return utime, int(days), seconds
+
+def write_obs_seq_netcdf(filename, nobs, columns, constants, date=None, version=None):
+    """
+        Writes nobs obs to the netCDF4 file filename:  columns is an iterable of (name, array)
+        pairs, each column is written to the file (compressed, see _compression) as it is
+        produced so only one is held at a time.  constants is a dict of the per-file values,
+        and date is kept as a global attribute.  The file is written under a temporary name
+        and renamed when complete, so a reader never sees a partial file.
+    """
+
+    variables = dict([(v[0], v[1:4]) for v in _obs_variables + _obs_constants])
+    tmpfile   = "%s.tmp" % filename
+
+    fnc = ncdf.Dataset(tmpfile, 'w', format='NETCDF4')
+
+    fnc.history = "Created " + DT.datetime.today().strftime("%Y%m%d_%H%M")
+    fnc.version = version or "Version 1.0a by Lou Wicker and Thomas Jones (NSSL)"
+    if date != None:
+        fnc.date = str(date)
+
+    fnc.createDimension('index', nobs)
+
+    try:
+        for name, value in constants.items():
+            dtype, units, description = variables[name]
+            var = fnc.createVariable(name, dtype)
+            if units:        var.units = units
+            if description:  var.description = description
+            var.assignValue(value)
+
+        for name, column in columns:
+            dtype, units, description = variables[name]
+            var = fnc.createVariable(name, dtype, ('index',), **variable_options(name, nobs))
+            if units:        var.units = units
+            if description:  var.description = description
+            if nobs > 0:
+                var[:] = column
+        fnc.close()
+    except:
+        fnc.close()
+        os.remove(tmpfile)
+        raise
+
+    os.replace(tmpfile, filename)
+
+def read_obs_seq_netcdf(filename):
+    """
+        Reads an obs_seq netCDF file with netCDF4 (no decoding) and returns (nobs, columns,
+        attributes, global_attributes):  columns is a list of (name, array) pairs with the
+        per-file constants (and the date) broadcast along index like open_obs_seq_netcdf,
+        attributes the variable attributes (including _FillValue) of each column.
+    """
+
+    columns    = []
+    attributes = {}
+
+    with ncdf.Dataset(filename, 'r') as fnc:
+
+        fnc.set_auto_maskandscale(False)
+
+        nobs   = len(fnc.dimensions['index']) if 'index' in fnc.dimensions else 0
+        gattrs = dict([(a, fnc.getncattr(a)) for a in fnc.ncattrs()])
+
+        for name, var in fnc.variables.items():
+
+            if var.ndim == 0:
+                column = np.full((nobs,), var.getValue(), dtype=var.dtype)
+            elif var.dimensions[0] != 'index':
+                continue
+            elif var.ndim == 2 and var.dtype == 'S1':
+                # character arrays written by xarray (e.g. date in the combined files)
+                column = np.ascontiguousarray(var[...]).view('S%d' % var.shape[1]).reshape(nobs)
+            else:
+                column = var[...]
+
+            columns.append((name, column))
+            attributes[name] = dict([(a, var.getncattr(a)) for a in var.ncattrs()])
+
+    if 'date' in gattrs and 'date' not in attributes:
+        columns.append(('date', np.full((nobs,), gattrs['date'], dtype='S128')))
+        attributes['date'] = {}
+
+    return nobs, columns, attributes, gattrs
+
+def create_obs_seq_netcdf(filename, columns, attributes, global_attributes=None):
+    """
+        Creates the netCDF4 file filename with an unlimited index dimension and the (empty,
+        compressed) variables of columns, a list of (name, array) pairs as returned by
+        read_obs_seq_netcdf.  Returns the open Dataset, obs are added with append_obs_seq_netcdf.
+    """
+
+    fnc = ncdf.Dataset(filename, 'w', format='NETCDF4')
+
+    try:
+        if global_attributes:
+            fnc.setncatts(global_attributes)
+
+        fnc.createDimension('index', None)
+
+        for name, column in columns:
+
+            attrs = dict(attributes.get(name, {}))
+            fill  = attrs.pop('_FillValue', None)
+
+            if column.dtype.kind == 'S':
+                dim = 'string%d' % column.dtype.itemsize
+                if dim not in fnc.dimensions:
+                    fnc.createDimension(dim, column.dtype.itemsize)
+                var = fnc.createVariable(name, 'S1', ('index', dim), zlib=_compression['complevel'] > 0, \
+                                         chunksizes=(_compression['chunk_size'], column.dtype.itemsize))
+            else:
+                var = fnc.createVariable(name, column.dtype, ('index',), fill_value=fill, \
+                                         **variable_options(name))
+            var.setncatts(attrs)
+
+            # the obs are only appended, the (default 64 MB) chunk cache only needs the last chunks
+
+            if var.chunking() != 'contiguous':
+                var.set_var_chunk_cache(size=_append_cache*int(np.prod(var.chunking()))*var.dtype.itemsize)
+
+        fnc.set_auto_maskandscale(False)
+
+    except:
+        fnc.close()
+        raise
+
+    return fnc
+
+def append_obs_seq_netcdf(fnc, columns):
+    """
+        Appends the obs in columns (list of (name, array) pairs) at the end of the index
+        dimension of the open Dataset fnc, one chunk at a time.  Returns the number of obs added.
+    """
+
+    n0    = len(fnc.dimensions['index'])
+    nobs  = 0
+    chunk = max(1, _compression['chunk_size'])
+
+    for name, column in columns:
+
+        var  = fnc.variables[name]
+        nobs = column.shape[0]
+
+        for m in range(0, nobs, chunk):
+            block = column[m:m+chunk]
+            if var.dtype == 'S1':
+                block = np.ascontiguousarray(block, dtype='S%d' % var.shape[1]).view('S1').reshape(-1, var.shape[1])
+            var[n0+m:n0+m+block.shape[0]] = block
+
+    return nobs
+
+def copy_obs_seq_netcdf(src, dst, keep=None):
+    """
+        Appends the obs of the open Dataset src (only those where the boolean array keep is True)
+        to the open Dataset dst, as created by create_obs_seq_netcdf, one chunk at a time.
+        Returns the number of obs added.
+    """
+
+    nobs  = len(src.dimensions['index'])
+    chunk = max(1, _compression['chunk_size'])
+    names = [name for name, var in dst.variables.items() if var.dimensions[:1] == ('index',)]
+    added = 0
+
+    for m in range(0, nobs, chunk):
+
+        select  = slice(None) if keep is None else keep[m:m+chunk]
+        columns = []
+
+        for name in names:
+            var   = src.variables[name]
+            block = var[m:m+chunk]
+            if var.ndim == 2 and var.dtype == 'S1':
+                block = np.ascontiguousarray(block).view('S%d' % var.shape[1]).reshape(-1)
+            columns.append((name, block[select]))
+
+        added = added + append_obs_seq_netcdf(dst, columns)
+
+    return added
+
+def open_obs_seq_netcdf(filename):
+    """
+        Opens an obs_seq netCDF file as an xarray Dataset with the per-file constants (and the
+        date) broadcast along index, so the files of several radars can be concatenated.
+    """
+
+    import xarray as xr
+
+    ds   = xr.open_dataset(filename)
+    nobs = ds.sizes.get('index', 0)
+
+    for name in list(ds.data_vars):
+        if ds[name].ndim == 0:
+            ds[name] = ds[name].expand_dims({'index': nobs})
+
+    if 'date' in ds.attrs and 'date' not in ds:
+        ds['date'] = ('index', np.full((nobs,), ds.attrs['date'], dtype='S128'))
+
+    return ds
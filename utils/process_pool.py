@@ -0,0 +1,81 @@
+from __future__ import print_function
+
+#############################################################
+#
+# Pool of forked processes for gridding the sweeps (or tilts)
+# of a volume on several cpus.
+#
+# The numpy superob engine holds the GIL (np.bincount and the
+# small per-offset ops), so threads do not run the sweeps in
+# parallel.  The workers here are forked after the volume,
+# grid and sweep function are set up, so they inherit them
+# and only the sweep numbers are sent through the pipes; the
+# gridded fields are written by the workers straight into
+# output arrays in shared memory (shared_array).
+#
+#############################################################
+import multiprocessing as mp
+from multiprocessing import sharedctypes
+
+import numpy as np
+
+########################################################################
+
+def shared_array(shape, dtype=np.float64, fill=0):
+    """
+        Returns a numpy array of shape and dtype in shared memory (filled with fill), the
+        writes of the processes forked by map_processes are seen by the parent
+    """
+
+    dtype = np.dtype(dtype)
+    size  = int(np.prod(shape))
+    raw   = sharedctypes.RawArray('b', max(1, size*dtype.itemsize))
+    array = np.frombuffer(raw, dtype=np.uint8)[:size*dtype.itemsize].view(dtype).reshape(shape)
+
+    array[...] = fill
+
+    return array
+
+########################################################################
+#
+# The function run by the workers, set before the pool is forked (it is a closure of
+# grid_fields, which cannot be pickled)
+
+_task = None
+
+def _run_task(item):
+
+    return _task(item)
+
+def map_processes(func, items, nprocs):
+    """
+        Returns [func(item) for item in items], computed by nprocs forked processes
+        (one item at a time per process).  The items and the results go through pipes,
+        so they should be small:  the large outputs go to shared_array arrays.  Runs in
+        this process if nprocs <= 1, fork is not available or this is a pool worker.
+    """
+
+    global _task
+
+    items  = list(items)
+    nprocs = min(int(nprocs or 1), len(items))
+
+    if nprocs <= 1 or 'fork' not in mp.get_all_start_methods() or mp.current_process().daemon:
+        return [func(item) for item in items]
+
+    _task = func
+
+    try:
+        pool = mp.get_context('fork').Pool(processes=nprocs)
+        try:
+            results = pool.map(_run_task, items, chunksize=1)
+        except:
+            pool.terminate()
+            pool.join()
+            raise
+        pool.close()
+        pool.join()
+    finally:
+        _task = None
+
+    return results
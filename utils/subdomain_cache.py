@@ -0,0 +1,132 @@
+from __future__ import print_function
+
+#############################################################
+#
+# Cache of the MRMS subdomain of a WoFS domain:  the index
+# window (i0:i1, j0:j1) of the MRMS grid that is read for
+# the domain and the lat/lon vectors of that window.
+#
+# The window only depends on the MRMS grid, the domain
+# center and the domain size, which are the same for every
+# level file, cycle and backfill of a day.  The windows are
+# kept for the life of the process, and if a cache directory
+# is given also as .npz files there, so the full MRMS
+# lat/lon vectors are only read and searched once.
+#
+#############################################################
+import os
+import hashlib
+import threading
+
+import numpy as np
+
+# Global attributes of the MRMS files that define the lat/lon grid (NW corner and spacing)
+
+_grid_attributes = ['Latitude', 'Longitude', 'LatGridSpacing', 'LonGridSpacing']
+
+########################################################################
+
+class Subdomain(object):
+    """
+        Window of the MRMS grid read for a domain:  the data are f[j0:j1, i0:i1] and
+        lats/lons are the lat/lon vectors of the window.
+    """
+
+    def __init__(self, i0, i1, j0, j1, lats, lons):
+
+        self.i0   = int(i0)
+        self.i1   = int(i1)
+        self.j0   = int(j0)
+        self.j1   = int(j1)
+        self.lats = lats
+        self.lons = lons
+
+def grid_signature(f):
+    """
+        Returns a key of the lat/lon grid of the open MRMS netCDF file f:  the grid size and
+        the grid attributes.  Only if an attribute is missing are the Lat/Lon vectors read,
+        and their hash is used instead.
+    """
+
+    signature = [len(f.dimensions['Lat']), len(f.dimensions['Lon'])]
+
+    try:
+        signature.extend([float(f.getncattr(a)) for a in _grid_attributes])
+    except (AttributeError, ValueError):
+        sha1 = hashlib.sha1()
+        for name in ['Lat', 'Lon']:
+            if name in f.variables:
+                sha1.update(np.ascontiguousarray(f.variables[name][...], dtype=np.float64).tobytes())
+        signature.append(sha1.hexdigest())
+
+    return tuple(signature)
+
+########################################################################
+
+_subdomains      = {}
+_subdomains_lock = threading.Lock()
+
+def _filename(cache_dir, key):
+
+    name = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+    return os.path.join(cache_dir, "subdomain_%s.npz" % name)
+
+def _load(cache_dir, key):
+
+    filename = _filename(cache_dir, key)
+
+    if not os.path.exists(filename):
+        return None
+
+    try:
+        with np.load(filename) as f:
+            return Subdomain(*(list(f['window']) + [f['lats'], f['lons']]))
+    except Exception as e:
+        print("\n SUBDOMAIN_CACHE:  Cannot read %s:  %s\n" % (filename, str(e)))
+        return None
+
+def _save(cache_dir, key, subdomain):
+
+    filename = _filename(cache_dir, key)
+    tmpfile  = "%s.%d.%d.tmp" % (filename, os.getpid(), threading.get_ident())
+
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        with open(tmpfile, 'wb') as f:
+            np.savez(f, window=np.array([subdomain.i0, subdomain.i1, subdomain.j0, subdomain.j1], dtype=np.int64), \
+                     lats=np.asarray(subdomain.lats), lons=np.asarray(subdomain.lons))
+        os.replace(tmpfile, filename)
+    except Exception as e:
+        print("\n SUBDOMAIN_CACHE:  Cannot write %s:  %s\n" % (filename, str(e)))
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+
+def get_subdomain(signature, loc, nx, ny, build, cache_dir=None):
+    """
+        Returns the Subdomain of the nx by ny domain centered at loc (lat, lon, or None) on
+        the MRMS grid with the key signature (see grid_signature).  If it is not cached,
+        build() is called to compute it, and if cache_dir is set it is read from or written
+        to that directory.
+    """
+
+    key = (signature, None if loc is None else (float(loc[0]), float(loc[1])), int(nx), int(ny))
+
+    with _subdomains_lock:
+        subdomain = _subdomains.get(key)
+
+    if subdomain is not None:
+        return subdomain
+
+    subdomain = _load(cache_dir, key) if cache_dir else None
+
+    if subdomain is None:
+        subdomain = build()
+        subdomain = Subdomain(subdomain.i0, subdomain.i1, subdomain.j0, subdomain.j1, \
+                              np.asarray(subdomain.lats), np.asarray(subdomain.lons))
+        if cache_dir:
+            _save(cache_dir, key, subdomain)
+
+    with _subdomains_lock:
+        return _subdomains.setdefault(key, subdomain)
@@ -0,0 +1,375 @@
+from __future__ import print_function
+
+#############################################################
+#
+# Vectorized superob (Cressman / Barnes) analysis of radar
+# gates onto a regular 2D grid.  This is a pure numpy
+# version of OBS_2_GRID2D in utils/cressman.f90 and takes
+# the same arguments, so the two can be swapped freely.
+#
+#############################################################
+import numpy as np
+import scipy.sparse as sparse
+import scipy.signal as signal
+
+try:
+    from utils.cressman import obs_2_grid2d as _fortran_obs_2_grid2d
+except ImportError:
+    _fortran_obs_2_grid2d = None
+
+# Pauley and Wu (1990) scaling used by the Barnes weights in cressman.f90
+
+_hsp0 = np.float32(1.33)
+
+########################################################################
+#
+# Stencil parameters - these mirror the setup section of OBS_2_GRID2D,
+# including the mixed real(4) / real(8) arithmetic, so that the weights
+# come out the same as the Fortran.
+
+def _stencil(xc, yc, method, roi):
+
+    dx  = np.float64(xc[1] - xc[0])
+    dy  = np.float64(yc[1] - yc[0])
+    dxy = np.sqrt(dx*dy)
+
+    roi = np.float32(roi)
+
+    if method == 1:
+        R2  = np.float64(roi*roi)
+        idx = 1 + int(np.floor(np.float64(np.float32(2.0)*roi)/dx + 0.5))
+        jdx = 1 + int(np.floor(np.float64(np.float32(2.0)*roi)/dy + 0.5))
+    else:
+        hsp = _hsp0*roi/np.float32(1000.)
+        R2  = np.float64(hsp*hsp)
+        idx = 1 + int(np.floor(np.float64(np.float32(7.0)*roi)/dx + 0.5))
+        jdx = 1 + int(np.floor(np.float64(np.float32(7.0)*roi)/dy + 0.5))
+
+    return R2, dxy, idx, jdx
+
+########################################################################
+#
+# Obs that can reach column offset di of their stencil:  the x-distance alone
+# has to be inside the radius where the weights are non-zero.
+
+def _column_obs(xc, xob, ii, di, method, roi, R2):
+
+    nx = xc.size
+    ci = ii + di - 1
+
+    valid = (ci >= 0) & (ci < nx)
+
+    ddx = xc[np.clip(ci, 0, nx-1)] - xob
+
+    if method == 1:
+        valid &= (np.float64(ddx*ddx) < R2)
+    else:
+        valid &= (np.abs(ddx) <= np.float32(5.0)*np.float32(roi))
+
+    return np.nonzero(valid)[0], ci[valid], ddx[valid]
+
+########################################################################
+#
+# Weights for every (ob, grid point) pair that one stencil offset connects.
+# Returns the flat grid index, the weight, and which obs actually contribute.
+
+def _offset_weights(yc, yob, jj, ci, ddx, dj, nx, method, min_range, roi, R2, dxy):
+
+    ny = yc.size
+    cj = jj + dj - 1
+
+    valid = (cj >= 0) & (cj < ny)
+
+    cj  = np.clip(cj, 0, ny-1)
+    ddy = yc[cj] - yob
+
+    if method == 1:    # Cressman
+        dis = np.float64(ddx*ddx + ddy*ddy)
+        wgt = (R2 - dis) / (R2 + dis)
+        valid &= (wgt > 0.0)
+    else:              # Barnes 1-pass
+        dis = np.float64(np.sqrt(ddx*ddx + ddy*ddy))
+        valid &= (dis <= np.float64(np.float32(5.0)*np.float32(roi))) & (dis >= np.float64(np.float32(min_range)))
+        wgt = np.exp(-(dis/dxy)**2 / R2)
+
+    return cj*nx + ci, wgt, valid
+
+########################################################################
+#
+# Generator over the stencil offsets, yielding for each offset the obs that
+# contribute, the flat (j*nx + i) grid cell they contribute to, and the weight.
+
+def _stencil_pairs(xob, yob, xc, yc, ii, jj, method, min_range, roi):
+
+    nx = xc.size
+
+    R2, dxy, idx, jdx = _stencil(xc, yc, method, roi)
+
+    for di in np.arange(-idx, idx+1):
+
+        n, ci, ddx = _column_obs(xc, xob, ii, di, method, roi, R2)
+
+        if n.size == 0:
+            continue
+
+        yob_n, jj_n = yob[n], jj[n]
+
+        for dj in np.arange(-jdx, jdx+1):
+
+            cell, wgt, valid = _offset_weights(yc, yob_n, jj_n, ci, ddx, dj, nx, method, min_range, roi, R2, dxy)
+
+            if not valid.any():
+                continue
+
+            yield n[valid], cell[valid], wgt[valid]
+
+########################################################################
+#
+# Final analysis from the accumulated sums, same tests as OBS_2_GRID2D
+
+def _finish(sum, wgt_sum, count, ny, nx, min_count, min_weight, missing):
+
+    field = np.full((ny*nx,), np.float64(np.float32(missing)))
+
+    good        = (wgt_sum > np.float64(np.float32(min_weight)))
+    field[good] = sum[good] / wgt_sum[good]
+    field[count < min_count] = np.float64(np.float32(missing))
+
+    return field.reshape(ny, nx)
+
+########################################################################
+
+def _as_inputs(xob, yob, xc, yc, ii, jj):
+
+    return (np.asarray(xob, dtype=np.float32).ravel(), np.asarray(yob, dtype=np.float32).ravel(),
+            np.asarray(xc,  dtype=np.float32),         np.asarray(yc,  dtype=np.float32),
+            np.asarray(ii,  dtype=np.int64).ravel(),   np.asarray(jj,  dtype=np.int64).ravel())
+
+########################################################################
+
+def obs_2_grid2d(obs, xob, yob, xc, yc, ii, jj, method, min_count, min_weight, min_range, roi, missing):
+    """
+        Numpy replacement for the f2py routine cressman.obs_2_grid2d.
+
+        Instead of looping over every ob and its stencil, the weights, weighted sums and
+        counts are scatter-accumulated with np.bincount one stencil offset at a time, so
+        the work per offset is a handful of array operations over all obs.
+
+        Inputs are cast to the real(4) kinds used by the Fortran, and the index arrays
+        ii/jj are the np.searchsorted indices passed to the Fortran (1-based there), so
+        the Cressman/Barnes analyses match the Fortran to round-off.
+
+        Returns a (ny, nx) float64 analysis with "missing" where the analysis is invalid.
+    """
+
+    xob, yob, xc, yc, ii, jj = _as_inputs(xob, yob, xc, yc, ii, jj)
+
+    ob64 = np.asarray(obs, dtype=np.float32).ravel().astype(np.float64)
+
+    nx, ny = xc.size, yc.size
+
+    wgt_sum = np.zeros((ny*nx,), dtype=np.float64)
+    sum     = np.zeros((ny*nx,), dtype=np.float64)
+    count   = np.zeros((ny*nx,), dtype=np.int64)
+
+    for n, cell, wgt in _stencil_pairs(xob, yob, xc, yc, ii, jj, method, min_range, roi):
+
+        sum     += np.bincount(cell, weights=wgt*ob64[n], minlength=ny*nx)
+        wgt_sum += np.bincount(cell, weights=wgt,         minlength=ny*nx)
+        count   += np.bincount(cell,                      minlength=ny*nx)
+
+    return _finish(sum, wgt_sum, count, ny, nx, min_count, min_weight, missing)
+
+########################################################################
+
+def superob_weights(xob, yob, xc, yc, ii, jj, method, min_range, roi):
+    """
+        Sparse (ny*nx, nobs) CSR matrix of the obs_2_grid2d weights.  Row j*nx+i holds
+        the weight every ob gives grid point (i,j).  Since the weights only depend on
+        where the gates are, a matrix built once for all gates of a sweep can be reused
+        for any field and any gate mask with apply_superob_weights.
+    """
+
+    xob, yob, xc, yc, ii, jj = _as_inputs(xob, yob, xc, yc, ii, jj)
+
+    # only the gates that can reach the grid get weights, the others are empty columns
+
+    gates = np.nonzero(in_reach(xob, yob, xc, yc, method, roi))[0]
+
+    rows, cols, wgts = [], [], []
+
+    for n, cell, wgt in _stencil_pairs(xob[gates], yob[gates], xc, yc, ii[gates], jj[gates], method, min_range, roi):
+        rows.append(cell)
+        cols.append(gates[n])
+        wgts.append(wgt)
+
+    if len(wgts) > 0:
+        rows, cols, wgts = np.concatenate(rows), np.concatenate(cols), np.concatenate(wgts)
+    else:
+        rows, cols, wgts = np.zeros((0,), dtype=np.int64), np.zeros((0,), dtype=np.int64), np.zeros((0,))
+
+    return sparse.csr_matrix((wgts, (rows, cols)), shape=(yc.size*xc.size, xob.size))
+
+########################################################################
+
+def apply_superob_weights(weights, obs, valid, ny, nx, min_count, min_weight, missing):
+    """
+        Superob analysis from a superob_weights matrix:  one sparse mat-vec for the
+        weighted sums and one for the weights, using only the gates where valid is True.
+        Gives the obs_2_grid2d result for the valid gates (to round-off).
+    """
+
+    valid = np.asarray(valid, dtype=bool).ravel()
+    obs   = np.where(valid, np.asarray(obs, dtype=np.float32).ravel(), np.float32(0.0)).astype(np.float64)
+
+    sum     = weights.dot(obs)
+    wgt_sum = weights.dot(valid.astype(np.float64))
+
+    # count of valid gates in each row (every stored entry is a gate inside the stencil)
+
+    count = np.concatenate(([0], np.cumsum(valid[weights.indices])))[weights.indptr]
+    count = np.diff(count)
+
+    return _finish(sum, wgt_sum, count, ny, nx, min_count, min_weight, missing)
+
+########################################################################
+
+def obs_2_grid2d_binned(obs, xob, yob, xc, yc, ii, jj, method, min_count, min_weight, min_range, roi, missing):
+    """
+        Fast approximate Cressman/Barnes analysis for regular grids ("Cressman-binned" and
+        "Barnes-binned" anal_method options).  Same arguments and return as obs_2_grid2d.
+
+        Each ob is moved to its nearest grid point, the ob sums and counts are histogrammed
+        on the grid (np.bincount), and the histograms are convolved (FFT) with the weight
+        kernel evaluated at the grid point separations.  The cost is O(nobs + grid) rather
+        than O(nobs x stencil), which matters for dense data on 1 km grids.
+
+        Error bounds against the exact method (obs_2_grid2d):
+
+          - an ob moves at most dmax = sqrt(dx**2 + dy**2)/2 (= 0.707*dx on square grids), so
+            its weight changes by at most |dw/dr|max * dmax:
+              Cressman:  |dw/dr|max = 1.30/roi                -> 0.92*dx/roi (0.46 for roi = 2*dx)
+              Barnes:    |dw/dr|max = 0.858/L, L = dxy*sqrt(R2) -> 0.61*dx/L
+          - obs within dmax of the edge of the weight footprint (roi for Cressman, min_range
+            and 5*roi for Barnes) can be counted in or out differently, which changes the
+            min_count test only at the edges of the data.
+          - the analysis is still a weighted mean of obs within roi + dmax of the grid point,
+            so it never leaves the range of those obs, and for data that vary linearly on the
+            grid scale the error is second order in dmax.  For smooth fields (e.g. MRMS
+            reflectivity on 1 km grids) differences are typically a few tenths of a dBZ.
+    """
+
+    obs = np.asarray(obs, dtype=np.float64).ravel()
+    xob = np.asarray(xob, dtype=np.float64).ravel()
+    yob = np.asarray(yob, dtype=np.float64).ravel()
+    xc  = np.asarray(xc,  dtype=np.float64)
+    yc  = np.asarray(yc,  dtype=np.float64)
+
+    nx, ny = xc.size, yc.size
+
+    R2, dxy, idx, jdx = _stencil(xc.astype(np.float32), yc.astype(np.float32), method, roi)
+
+    dx, dy = xc[1] - xc[0], yc[1] - yc[0]
+
+    # weight kernel on the grid point separations
+
+    kx, ky   = np.meshgrid(dx*np.arange(-idx, idx+1), dy*np.arange(-jdx, jdx+1))
+    dis      = np.sqrt(kx**2 + ky**2)
+
+    if method == 1:    # Cressman
+        kernel = (R2 - dis**2) / (R2 + dis**2)
+        inside = (kernel > 0.0)
+    else:              # Barnes 1-pass
+        kernel = np.exp(-(dis/dxy)**2 / R2)
+        inside = (dis <= 5.0*np.float32(roi)) & (dis >= min_range)
+
+    kernel = np.where(inside, kernel, 0.0)
+
+    # histogram onto the grid, padded by the kernel half width so obs just off the grid count
+
+    ib = np.rint((xob - xc[0]) / dx).astype(np.int64) + idx
+    jb = np.rint((yob - yc[0]) / dy).astype(np.int64) + jdx
+
+    nxp, nyp = nx + 2*idx, ny + 2*jdx
+
+    keep = (ib >= 0) & (ib < nxp) & (jb >= 0) & (jb < nyp)
+    bins = jb[keep]*nxp + ib[keep]
+
+    ob_sum = np.bincount(bins, weights=obs[keep], minlength=nxp*nyp).reshape(nyp, nxp)
+    ob_num = np.bincount(bins,                    minlength=nxp*nyp).reshape(nyp, nxp).astype(np.float64)
+
+    sum     = signal.fftconvolve(ob_sum, kernel, mode='valid').ravel()
+    wgt_sum = signal.fftconvolve(ob_num, kernel, mode='valid').ravel()
+    count   = np.rint(signal.fftconvolve(ob_num, inside.astype(np.float64), mode='valid')).ravel()
+
+    return _finish(sum, wgt_sum, count, ny, nx, min_count, min_weight, missing)
+
+########################################################################
+
+def in_reach(xob, yob, xc, yc, method, roi):
+    """
+        True for the obs at xob/yob whose obs_2_grid2d stencil can touch a point of the
+        grid xc/yc:  the obs within the stencil reach (idx*dx, jdx*dy) of the grid edges.
+        The stencil reach is beyond the radius of non-zero weights, so dropping the other
+        obs does not change the analysis.
+    """
+
+    R2, dxy, idx, jdx = _stencil(np.asarray(xc, dtype=np.float32), np.asarray(yc, dtype=np.float32), method, roi)
+
+    xreach = idx*abs(np.float64(xc[1]) - np.float64(xc[0]))
+    yreach = jdx*abs(np.float64(yc[1]) - np.float64(yc[0]))
+
+    xob, yob = np.asarray(xob), np.asarray(yob)
+
+    return (xob >= min(xc[0], xc[-1]) - xreach) & (xob <= max(xc[0], xc[-1]) + xreach) & \
+           (yob >= min(yc[0], yc[-1]) - yreach) & (yob <= max(yc[0], yc[-1]) + yreach)
+
+########################################################################
+
+def active_window(xc, yc, xr, yr, max_range, method, roi):
+    """
+        Returns (rows, cols) slices of the grid xc/yc that gates within max_range of a radar
+        at (xr, yr) can reach, or None if none of the grid can be reached.
+
+        Gridding on xc[cols], yc[rows] and placing the result into the full grid gives the
+        same analysis as gridding on the full grid:  the window covers every point the
+        stencils can reach, and its edges are far enough from the gates that the
+        searchsorted indices on the window are the full grid indices shifted by the
+        window origin.
+    """
+
+    R2, dxy, idx, jdx = _stencil(np.asarray(xc, dtype=np.float32), np.asarray(yc, dtype=np.float32), method, roi)
+
+    dx, dy = abs(xc[1] - xc[0]), abs(yc[1] - yc[0])
+
+    cols = np.nonzero(np.abs(xc - xr) <= max_range + (idx+1)*dx)[0]
+    rows = np.nonzero(np.abs(yc - yr) <= max_range + (jdx+1)*dy)[0]
+
+    if cols.size == 0 or rows.size == 0:
+        return None
+
+    # need at least two points in each direction for the grid spacing
+
+    i0, i1 = min(cols[0], len(xc)-2), max(cols[-1], 1)
+    j0, j1 = min(rows[0], len(yc)-2), max(rows[-1], 1)
+
+    return slice(j0, j1+1), slice(i0, i1+1)
+
+########################################################################
+
+def get_superob_engine(name='numpy'):
+    """
+        Returns the obs_2_grid2d routine to use for gridding:  "numpy" (this module)
+        or "fortran" (f2py build of utils/cressman.f90).  If the compiled module cannot
+        be imported, the numpy engine is used instead.
+    """
+
+    if name == 'fortran':
+        if _fortran_obs_2_grid2d is not None:
+            return _fortran_obs_2_grid2d
+        print("\n SUPEROB:  utils/cressman could not be imported, using the numpy superob engine\n")
+
+    elif name != 'numpy':
+        print("\n SUPEROB:  Unknown superob engine %s, using the numpy superob engine\n" % name)
+
+    return obs_2_grid2d
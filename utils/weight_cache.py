@@ -0,0 +1,242 @@
+from __future__ import print_function
+
+#############################################################
+#
+# LRU cache (in memory, and optionally on disk) of the sparse
+# superob weight matrices built by utils/superob.superob_weights.
+#
+# For a given radar, VCP and tilt the gate locations repeat from
+# volume to volume, only the data and the masks change, so the
+# weights for a sweep can be built once and re-applied each cycle.
+#
+# This is an approximation:  the rays of a sweep are not at the
+# same angles in every volume, and cached weights are re-applied
+# as long as each ray's azimuth and elevation are within
+# _ray_tolerance of the ones they were built with (else they are
+# rebuilt).  A gate at range r is then off by up to r*tolerance,
+# 175 m at 100 km for 0.1 deg, and the analysis by about that
+# distance times the field gradient (< 0.2 dBZ for 1.5 dBZ/km in
+# TestWeightCache).  The cache is off by default in opaws2d and
+# rass/mrms ('weight_cache').
+#
+#############################################################
+import os
+import hashlib
+import threading
+import collections
+
+import numpy as np
+import scipy.sparse as sparse
+
+# Max difference (deg) between cached and current ray azimuths or elevations before the weights are rebuilt
+
+_ray_tolerance = 0.1
+
+########################################################################
+#
+# Cache key for a sweep:  radar, VCP, sweep, scan geometry and the grid/analysis spec.
+
+def sweep_key(radar, sweep, grid_spec):
+    """
+        Builds the cache key for a sweep from a pyart-style radar object.  grid_spec is a
+        tuple describing the grid and analysis (grid origin, spacing, size, radar offset,
+        method, roi, min_range).
+    """
+
+    begin, end = radar.get_start_end(sweep)
+
+    metadata   = radar.metadata if radar.metadata is not None else {}
+
+    rng        = radar.range['data']
+
+    key = (str(metadata.get('instrument_name', '')),
+           str(metadata.get('vcp_pattern', '')),
+           round(float(np.ravel(radar.latitude['data'])[0]),  4),
+           round(float(np.ravel(radar.longitude['data'])[0]), 4),
+           int(sweep),
+           round(float(radar.fixed_angle['data'][sweep]), 2),
+           int(end - begin + 1),
+           int(rng.size),
+           round(float(rng[0]), 1),
+           round(float(rng[1] - rng[0]), 1) if rng.size > 1 else 0.0) \
+        + tuple([round(float(g), 1) if isinstance(g, float) else g for g in grid_spec])
+
+    return key
+
+########################################################################
+
+def _ray_order(cached, azimuth, tolerance, cached_elevation, elevation):
+    """
+        Returns the index of the current ray that matches each cached ray, or None if
+        the two sets of azimuths, or the elevations of the matched rays, do not line up
+        to within the tolerance.  Volumes do not always start a sweep at the same
+        azimuth, so the rays are matched after sorting.
+    """
+
+    if cached.size != azimuth.size or cached_elevation is None or cached_elevation.size != elevation.size:
+        return None
+
+    cs = np.argsort(cached)
+    ns = np.argsort(azimuth)
+
+    diff = np.abs(cached[cs] - azimuth[ns]) % 360.
+    diff = np.minimum(diff, 360. - diff)
+
+    if diff.size > 0 and diff.max() > tolerance:
+        return None
+
+    if diff.size > 0 and np.abs(cached_elevation[cs] - elevation[ns]).max() > tolerance:
+        return None
+
+    order     = np.zeros((cached.size,), dtype=np.int64)
+    order[cs] = ns
+
+    return order
+
+########################################################################
+
+class WeightCache(object):
+    """
+        LRU cache of sparse superob weight matrices.
+
+        get(key, azimuth, elevation, build) returns (weights, order):  weights is the CSR
+        matrix from build() (called on a miss, or if the rays are not within tolerance
+        of the cached ones), and order re-arranges the rays of the current sweep to the
+        ray order the matrix was built with, i.e. data[order].ravel() lines up with the
+        matrix columns.
+
+        max_entries matrices are kept in memory, and if cache_dir is set, the newest
+        max_files matrices are also kept on disk as .npz files so later jobs can use them.
+    """
+
+    def __init__(self, cache_dir=None, max_entries=32, max_files=1024, tolerance=_ray_tolerance):
+
+        self.cache_dir   = cache_dir
+        self.max_entries = max_entries
+        self.max_files   = max_files
+        self.tolerance   = tolerance
+
+        self._entries = collections.OrderedDict()
+        self._lock    = threading.Lock()
+
+        if self.cache_dir and not os.path.exists(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                if not os.path.isdir(self.cache_dir):
+                    print("\n WEIGHT_CACHE:  Cannot create %s, weights will only be cached in memory\n" % self.cache_dir)
+                    self.cache_dir = None
+
+    def _filename(self, key):
+
+        return os.path.join(self.cache_dir, "weights_%s.npz" % hashlib.sha1(repr(key).encode('utf-8')).hexdigest())
+
+    def _load(self, key):
+
+        if not self.cache_dir:
+            return None
+
+        filename = self._filename(key)
+
+        if not os.path.exists(filename):
+            return None
+
+        try:
+            with np.load(filename) as f:
+                weights = sparse.csr_matrix((f['data'], f['indices'], f['indptr']), shape=tuple(f['shape']))
+                azimuth   = f['azimuth']
+                elevation = f['elevation'] if 'elevation' in f.files else None
+            os.utime(filename, None)
+        except Exception as e:
+            print("\n WEIGHT_CACHE:  Cannot read %s:  %s\n" % (filename, str(e)))
+            return None
+
+        return weights, azimuth, elevation
+
+    def _save(self, key, weights, azimuth, elevation):
+
+        if not self.cache_dir:
+            return
+
+        filename = self._filename(key)
+        tmpfile  = "%s.%d.tmp" % (filename, os.getpid())
+
+        try:
+            with open(tmpfile, 'wb') as f:
+                np.savez(f, data=weights.data, indices=weights.indices, indptr=weights.indptr,
+                         shape=np.array(weights.shape), azimuth=azimuth, elevation=elevation)
+            os.replace(tmpfile, filename)
+        except Exception as e:
+            print("\n WEIGHT_CACHE:  Cannot write %s:  %s\n" % (filename, str(e)))
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+            return
+
+        # Least recently used files are removed first
+
+        files = [os.path.join(self.cache_dir, f) for f in os.listdir(self.cache_dir) if f.endswith('.npz')]
+
+        if len(files) > self.max_files:
+            files.sort(key=lambda f: os.path.getmtime(f))
+            for f in files[:len(files) - self.max_files]:
+                try:
+                    os.remove(f)
+                except OSError:
+                    pass
+
+    def _remember(self, key, weights, azimuth, elevation):
+
+        with self._lock:
+            self._entries[key] = (weights, azimuth, elevation)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, key, azimuth, elevation, build):
+
+        azimuth   = np.asarray(azimuth,   dtype=np.float64)
+        elevation = np.asarray(elevation, dtype=np.float64)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+
+        if entry is None:
+            entry = self._load(key)
+            if entry is not None:
+                self._remember(key, *entry)
+
+        if entry is not None:
+            order = _ray_order(entry[1], azimuth, self.tolerance, entry[2], elevation)
+            if order is not None:
+                return entry[0], order
+
+        weights = build()
+
+        self._remember(key, weights, azimuth, elevation)
+        self._save(key, weights, azimuth, elevation)
+
+        return weights, np.arange(azimuth.size)
+
+    def clear(self):
+
+        with self._lock:
+            self._entries.clear()
+
+########################################################################
+#
+# One cache per cache directory for the process
+
+_caches      = {}
+_caches_lock = threading.Lock()
+
+def get_weight_cache(cache_dir=None):
+    """
+        Returns the process-wide WeightCache for cache_dir (None = memory only)
+    """
+
+    with _caches_lock:
+        if cache_dir not in _caches:
+            _caches[cache_dir] = WeightCache(cache_dir=cache_dir)
+        return _caches[cache_dir]